@@ -10,6 +10,7 @@ import sys
 
 import pony.orm
 
+import suapp.orm
 from suapp.jandw import *
 from suapp.logdecorator import *
 from suapp.moduleloader import *
@@ -251,6 +252,7 @@ class SuApp(object):
         except KeyError:
             self.db.bind("sqlite", ":memory:")
         self.db.generate_mapping(create_tables=True)
+        suapp.orm.track_data_versions(self.db)
 
     def configure_log(self):
         """
@@ -422,6 +424,10 @@ class SuApp(object):
         )
         if len(self.flow.flow[""]) == 0:
             raise ConfigurationError("Could not load correct flow configuration.")
+        if "query_cache" in self.configuration:
+            self.flow.query_cache.max_size = int(
+                self.configuration["query_cache"].get("max_size", 256)
+            )
         if "modules" in self.configuration:
             for module in self.configuration["modules"]:
                 subflow = self.read_flow(os.path.join("modules", "%s.flow" % (module)))
@@ -5,14 +5,17 @@
 """
 Copyright (C), 2013, The Schilduil Team. All rights reserved.
 """
+import collections
 import sys
+import threading
+import time
 import pony.orm
 
 import suapp.orm
 from suapp.logdecorator import loguse, logging
 
 
-__all__ = ["Wooster", "Drone", "Jeeves"]
+__all__ = ["Wooster", "Drone", "Jeeves", "QueryCache"]
 
 
 class FlowException(Exception):
@@ -75,6 +78,153 @@ class Drone(object):
         return "Drone %s > %s" % (self.name, self.tovertex)
 
 
+class QueryCache:
+    """
+    Cache of the results of the named queries.
+
+    An entry is used until its ttl (in seconds) passes or until a change
+    of an entity the query depends on is saved in this process (see
+    suapp.orm.data_version). Beyond max_size entries (256 by default) the
+    least recently used entry is dropped.
+
+    Only plain data is cached (see Jeeves.do_query) and never the PonyORM
+    objects as those belong to the db_session they were loaded in.
+    """
+
+    # No @loguse as it would show up in the logging of the Jeeves.__init__.
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = 256
+        self.max_size = int(max_size)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # No @loguse as this is called for every cached query.
+    def get(self, key, entities=None):
+        """
+        Returns the cached result or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                (expires, versions, result) = entry
+                if expires > time.monotonic():
+                    fresh = versions == suapp.orm.data_version(entities)
+                else:
+                    fresh = False
+                if fresh:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    # No @loguse as this is called for every cached query.
+    def put(self, key, ttl, versions, result):
+        """
+        Caches the result for ttl seconds.
+
+        The versions are the data versions from before running the query.
+        """
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, versions, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    @loguse
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    @loguse
+    def stats(self):
+        """
+        Returns the size and hit/miss counters of the cache.
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def raw_pkval(orm_object):
+    """
+    Returns the primary key of the PonyORM object as a tuple of plain values.
+
+    An object in the primary key is replaced by its own (raw) primary key.
+    """
+    values = orm_object.get_pk()
+    if len(orm_object._pk_attrs_) == 1:
+        values = (values,)
+    pkval = []
+    for value in values:
+        if isinstance(value, pony.orm.core.Entity):
+            value = raw_pkval(value)
+            if len(value) == 1:
+                value = value[0]
+        pkval.append(value)
+    return tuple(pkval)
+
+
+def fetch_many_query(entity, pkvals):
+    """
+    Returns the query for the objects of the entity with the primary keys.
+
+    The pkvals are tuples with a value for every primary key attribute.
+    """
+    pk_attrs = entity._pk_attrs_
+    if len(pk_attrs) == 1:
+        return entity.select(
+            "lambda o: o.%s in keys" % (pk_attrs[0].name),
+            {},
+            {"keys": [pkval[0] for pkval in pkvals]},
+        )
+    # No IN for tuples in PonyORM: (a = ? AND b = ?) OR (a = ? AND b = ?) ...
+    params = {}
+    conditions = []
+    for i, pkval in enumerate(pkvals):
+        parts = []
+        for j, (attr, value) in enumerate(zip(pk_attrs, pkval)):
+            params["key_%d_%d" % (i, j)] = value
+            parts.append("o.%s == key_%d_%d" % (attr.name, i, j))
+        conditions.append("(%s)" % (" and ".join(parts)))
+    return entity.select("lambda o: %s" % (" or ".join(conditions)), {}, params)
+
+
+def set_order(entity, order_by):
+    """
+    Returns the attributes (or desc of them) to order the entity by.
+
+    The order_by is a comma separated list of attribute names, preceded by -
+    for descending order. The primary key is added so the order is stable.
+    """
+    order = []
+    names = set()
+    for name in (order_by or "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        attr = entity._adict_.get(name.lstrip("-"))
+        if attr is None or attr.is_collection:
+            raise ValueError("Can not order %s by %s." % (entity.__name__, name))
+        names.add(attr.name)
+        order.append(pony.orm.desc(attr) if name.startswith("-") else attr)
+    for attr in entity._pk_attrs_:
+        if attr.name not in names:
+            order.append(attr)
+    return order
+
+
 class Jeeves(object):
     """
     Jeeves is the controller that determins the flow.
@@ -86,6 +236,9 @@ class Jeeves(object):
     MODE_REPLACE = 2
     MODE_MODAL = 1
 
+    # The maximum number of parameters in one query of do_fetch_many.
+    fetch_many_chunk = 500
+
     @loguse
     def __init__(self, app=None):
         """
@@ -95,6 +248,7 @@ class Jeeves(object):
         self.app = app
         self.views = {}
         self.queries = {}
+        self.query_cache = QueryCache()
         # TODO: I have no idea why I added ormscope: get rid of it?
         self.ormscope = {}
 
@@ -155,7 +309,7 @@ class Jeeves(object):
         """
         if scope is None:
             scope = {}
-        query_template, defaults = self.queries[name]
+        query_template, defaults = self.queries[name][:2]
         # Start with the default defined.
         parameters = defaults.copy()
         parameters.update(params)
@@ -180,18 +334,126 @@ class Jeeves(object):
 
         The result is always a UiOrmObject by using UiOrmObject.uize on the
         results of the query.
+
+        The result of a query with a ttl is cached (see query_options) as
+        the entity and primary key of every object, which are fetched again
+        in the db_session of the caller.
         """
         query_template, parameters = self.pre_query(name, scope, params)
+        options = self.query_options(name)
+        ttl = options.get("ttl")
+        if ttl:
+            entities = options.get("entities")
+            key = (name, tuple(sorted((k, repr(v)) for k, v in parameters.items())))
+            rows = self.query_cache.get(key, entities)
+            if rows is not None:
+                return (r for r in self._fetch_rows(rows))
+            versions = suapp.orm.data_version(entities)
+            result = list(self._run_query(query_template, scope, parameters))
+            rows = []
+            for r in result:
+                if isinstance(r, pony.orm.core.Entity):
+                    rows.append((r.__class__, raw_pkval(r)))
+                else:
+                    rows.append((None, r))
+            self.query_cache.put(key, ttl, versions, rows)
+            return (suapp.orm.UiOrmObject.uize(r) for r in result)
+        result = self._run_query(query_template, scope, parameters)
+        return (suapp.orm.UiOrmObject.uize(r) for r in result)
+
+    @loguse("@")  # Not logging the return value.
+    def _fetch_rows(self, rows):
+        """
+        Returns the UiOrmObjects of cached rows (see do_query).
+
+        The objects are fetched with one query per entity and an object
+        that no longer exists is left out.
+        """
+        pkvals = collections.defaultdict(list)
+        for entity, pkval in rows:
+            if entity is not None:
+                pkvals[entity].append(
+                    tuple(
+                        attr.validate(value)
+                        for attr, value in zip(entity._pk_attrs_, pkval)
+                    )
+                )
+        found = {}
+        for entity, entity_pkvals in pkvals.items():
+            for pkval, orm_object in self._fetch_pkvals(entity, entity_pkvals):
+                found[(entity, raw_pkval(orm_object))] = orm_object
+        results = []
+        for entity, pkval in rows:
+            if entity is None:
+                results.append(suapp.orm.UiOrmObject.uize(pkval))
+            elif (entity, pkval) in found:
+                results.append(suapp.orm.UiOrmObject.uize(found[(entity, pkval)]))
+        return results
+
+    # No @loguse as it is logged by do_fetch_many and _fetch_rows.
+    def _fetch_pkvals(self, entity, pkvals):
+        """
+        Yields (primary key, object) for the objects with the primary keys.
+
+        The pkvals are validated primary key tuples without duplicates.
+        They are looked up in chunks of at most fetch_many_chunk parameters.
+        """
+        pk_attrs = entity._pk_attrs_
+        chunk = max(1, self.fetch_many_chunk // len(pk_attrs))
+        for start in range(0, len(pkvals), chunk):
+            for orm_object in fetch_many_query(entity, pkvals[start : start + chunk]):
+                pkval = orm_object._pkval_
+                if len(pk_attrs) == 1:
+                    pkval = (pkval,)
+                yield (pkval, orm_object)
+
+    @loguse("@")  # Not logging the return value.
+    def _run_query(self, query_template, scope, parameters):
+        """
+        Runs the query and returns the (raw) result.
+        """
         if callable(query_template):
             # A callable, so just call it.
-            result = query_template(params=parameters)
-        else:
-            # DEPRECATED: python code as a string.
-            result = self._do_query_str(query_template, scope, parameters)
-        return (suapp.orm.UiOrmObject.uize(r) for r in result)
+            return query_template(params=parameters)
+        # DEPRECATED: python code as a string.
+        return self._do_query_str(query_template, scope, parameters)
+
+    @loguse
+    def query_options(self, name):
+        """
+        Returns the options of the query.
+
+        A query in view_definitions() can have a dict with options as third
+        element:
+            "individual.adults": (
+                adults,
+                {"pagenum": 1, "pagesize": 10},
+                {"ttl": 60, "entities": ["Individual"]},
+            )
+        Options:
+         - ttl: Seconds the result is cached, not cached if not set.
+         - entities: The names of the entities the query depends on. A
+                     change of one of those saved in this process drops the
+                     cached results. If not set any change drops them.
+                     Changes saved by other processes only show after the
+                     ttl (see suapp.orm.track_data_versions).
+        """
+        query = self.queries[name]
+        if len(query) > 2 and query[2]:
+            return query[2]
+        return {}
 
     @loguse
-    def do_fetch_set(self, module, table, primarykey, link):
+    def do_fetch_set(
+        self,
+        module,
+        table,
+        primarykey,
+        link,
+        pagenum=None,
+        pagesize=None,
+        order_by=None,
+    ):
         """
         Fetches the result from a foreign key that is a set.
 
@@ -205,10 +467,37 @@ class Jeeves(object):
         The module, table and primarykey are those from the object having the
         foreign key and behave the same as with do_fetch. The extra parameter
         link is the foreign key that is pointing to the set.
+
+        With pagesize only that page (pagenum starting from 1) of the set is
+        fetched, using LIMIT/OFFSET in the SQL. The order_by is a comma
+        separated list of attribute names (preceded by - for descending
+        order), by default the rows are ordered by primary key. Without
+        pagesize nor order_by the whole set is loaded.
+        Use do_count_set for the total number of rows in the set.
         """
         origin = self.do_fetch(module, table, primarykey)
         result = getattr(origin, link)
-        return (suapp.orm.UiOrmObject.uize(r) for r in result)
+        if pagesize is None and not order_by:
+            return (suapp.orm.UiOrmObject.uize(r) for r in result)
+        query = result.select()
+        query = query.order_by(*set_order(result._attr_.py_type, order_by))
+        if pagesize is not None:
+            try:
+                pagenum = max(int(pagenum), 1)
+            except (TypeError, ValueError):
+                pagenum = 1
+            query = query.page(pagenum, int(pagesize))
+        return (suapp.orm.UiOrmObject.uize(r) for r in query)
+
+    @loguse
+    def do_count_set(self, module, table, primarykey, link):
+        """
+        Returns the number of rows in a foreign key set (see do_fetch_set).
+
+        Unless the set is already loaded this is a COUNT query.
+        """
+        origin = self.do_fetch(module, table, primarykey)
+        return getattr(origin, link).count()
 
     @loguse
     def do_fetch(self, module, table, primarykey):
@@ -261,6 +550,56 @@ class Jeeves(object):
         else:
             return table_class.get(**params)
 
+    @loguse("@")  # Not logging the return value.
+    def do_fetch_many(self, module, table, keys):
+        """
+        Fetches several objects from the database with one query.
+
+        This will return a list with, in the order of the keys, the object
+        for every key or None if there is no such row. The module and table
+        are the same as with do_fetch and keys is a list of primary keys
+        (each a string or a list of values as the primarykey of do_fetch).
+
+        The keys are looked up with one IN query (one OR of the columns for a
+        multi variable primary key), in chunks of at most fetch_many_chunk
+        parameters.
+        """
+        module = sys.modules[module]
+        table_class = getattr(module, table)
+        if issubclass(table_class, pony.orm.core.Entity):
+            entity = table_class
+        elif issubclass(table_class, suapp.orm.UiOrmObject):
+            entity = table_class._ui_class
+        else:
+            return None
+        pk_attrs = entity._pk_attrs_
+        pkvals = []
+        for key in keys:
+            if isinstance(key, str):
+                key = [key]
+            try:
+                if len(key) != len(pk_attrs):
+                    raise ValueError("Wrong number of primary key values: %s" % (key))
+                pkvals.append(
+                    tuple(attr.validate(value) for attr, value in zip(pk_attrs, key))
+                )
+            except (TypeError, ValueError) as err:
+                # Not a valid key, so there is no such row.
+                logging.getLogger(__name__).debug("Skipping key %s: %s", key, err)
+                pkvals.append(None)
+        wanted = list(dict.fromkeys(pkval for pkval in pkvals if pkval is not None))
+        found = dict(self._fetch_pkvals(entity, wanted))
+        logging.getLogger(__name__).debug(
+            "Fetched %s of %s %s objects", len(found), len(wanted), entity.__name__
+        )
+        results = []
+        for pkval in pkvals:
+            orm_object = found.get(pkval)
+            if orm_object is not None and entity is not table_class:
+                orm_object = table_class(orm=orm_object)
+            results.append(orm_object)
+        return results
+
     @loguse("@")  # Not logging the return value.
     def drone(self, fromvertex, name, mode, dataobject, **kwargs):
         """
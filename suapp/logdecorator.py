@@ -5,6 +5,7 @@ Copyright (C), 2013, The Schilduil Team. All rights reserved.
 """
 import logging
 import inspect
+import threading
 import time
 from collections import OrderedDict
 from operator import add
@@ -22,6 +23,8 @@ __all__ = [
 
 
 timings = None
+# Requests can be handled by multiple threads at the same time.
+timings_lock = threading.Lock()
 
 
 def get_timings():
@@ -44,12 +47,13 @@ def disable_timings():
 def add_timing(f, time):
     """Adds an executing time for a callable to the timings."""
     global timings
-    if timings is None:
-        return
-    if f in timings:
-        timings[f] = tuple(map(add, timings[f], (1, time)))
-    else:
-        timings[f] = (1, time)
+    with timings_lock:
+        if timings is None:
+            return
+        if f in timings:
+            timings[f] = tuple(map(add, timings[f], (1, time)))
+        else:
+            timings[f] = (1, time)
 
 
 def timings_report():
@@ -57,13 +61,15 @@ def timings_report():
     The slowest on average will be first."""
     if timings is None:
         return None
+    with timings_lock:
+        current_timings = dict(timings)
     report = {}
-    for f, (count, time) in timings.items():
+    for f, (count, time) in current_timings.items():
         report[f] = time / count
 
     sorted_report = OrderedDict()
     for f in sorted(report, key=report.get, reverse=True):
-        sorted_report[f] = timings[f] + (report[f],)
+        sorted_report[f] = current_timings[f] + (report[f],)
 
     return sorted_report
 
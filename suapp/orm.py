@@ -1,13 +1,91 @@
 #!/usr/bin/env python3
 
 
+import collections
 import pony.orm
 import sys
+import threading
 
 from suapp.logdecorator import loguse
 
 
-__all__ = ["UiOrmObject"]
+__all__ = [
+    "UiOrmObject",
+    "data_version",
+    "bump_data_versions",
+    "track_data_versions",
+]
+
+
+# The version of the data per entity name, bumped on every commit.
+# The version of "" is bumped on any commit.
+data_versions = collections.Counter()
+data_versions_lock = threading.Lock()
+
+
+def data_version(entities=None):
+    """
+    Returns the versions of the data of the entities (names).
+
+    Without entities it is the version of all the data.
+    """
+    if not entities:
+        return (data_versions[""],)
+    with data_versions_lock:
+        return tuple(data_versions[name] for name in entities)
+
+
+def bump_data_versions(entities):
+    """
+    Bumps the version of the data of the entities (names).
+    """
+    with data_versions_lock:
+        data_versions[""] += 1
+        for name in entities:
+            data_versions[name] += 1
+
+
+def bump_saved_entity(orm_object):
+    """
+    Bumps the data versions of the entity of the saved object.
+
+    This includes the entities it inherits from.
+    """
+    entity = orm_object.__class__
+    bump_data_versions([entity.__name__] + [b.__name__ for b in entity._all_bases_])
+
+
+def track_data_versions(database):
+    """
+    Bumps the data versions whenever an object of the database is saved.
+
+    This wraps the after_insert, after_update and after_delete hooks of all
+    the entities of the database. PonyORM calls these when the changes are
+    flushed, which is just before the commit: a query in another db_session
+    in between can still see the old data with the new version. The data
+    versions are per process, so changes saved by other processes are not
+    seen at all.
+    """
+    for entity in database.entities.values():
+        for name in ("after_insert", "after_update", "after_delete"):
+            hook = getattr(entity, name)
+            if getattr(hook, "tracks_data_versions", False):
+                # Inherited from an entity we have already done.
+                continue
+            setattr(entity, name, tracking_hook(hook))
+
+
+def tracking_hook(hook):
+    """
+    Returns the hook that also bumps the data versions.
+    """
+
+    def tracked(self):
+        bump_saved_entity(self)
+        return hook(self)
+
+    tracked.tracks_data_versions = True
+    return tracked
 
 
 class UiOrmObject:
@@ -3,6 +3,7 @@
 
 
 import json
+import operator
 from pony.orm.core import Entity, SetInstance, Required, Optional
 
 import suapp.orm
@@ -11,66 +12,248 @@ import suapp.orm
 __all__ = ["to_json", "dumps"]
 
 
-def to_json(object_to_serialize):
+# The compiled serializers by (class, ORM class, fields).
+serializers = {}
+# Beyond that many the serializers are compiled anew (the fields come from
+# the requests).
+max_serializers = 1024
+
+
+def convert(object_to_serialize, value):
+    """
+    Returns the json serializable value of an attribute of an ORM object.
+
+    A foreign key is its _pk_, a Set an empty dictionary and a tuple (e.g. a
+    multi variable primary key) a list.
+    """
+    if isinstance(value, Entity):
+        value = value._pk_
+    if isinstance(value, SetInstance):
+        # An empty dictonary signals a Set.
+        return {}
+    if isinstance(value, tuple):
+        # On json a tuple = list, so might as well use a list.
+        converted_tuple = []
+        for subvalue in value:
+            # Finding out the references to variables.
+            if isinstance(subvalue, Required) or isinstance(subvalue, Optional):
+                cur_obj = object_to_serialize
+                path = str(subvalue).split(".")[1:]
+                while len(path) > 0:
+                    subvalue = getattr(cur_obj, path.pop(0))
+                    cur_obj = subvalue
+            if isinstance(subvalue, Entity):
+                subvalue = subvalue._pk_
+            converted_tuple.append(subvalue)
+        return converted_tuple
+    return value
+
+
+def simple_primary_key(entity_class):
+    """
+    Returns True if the _pk_ of the entity class is one (not foreign) value.
+    """
+    pk_attrs = entity_class._pk_attrs_
+    return len(pk_attrs) == 1 and not pk_attrs[0].is_relation
+
+
+def reference_pk(object_to_serialize, value):
+    """
+    Returns the _pk_ of a foreign key to an entity with a simple_primary_key.
+    """
+    if value is None:
+        return None
+    return value._pk_
+
+
+def compile_entity(entity_class, names, fields):
+    """
+    Returns the serializer of the objects of a PonyORM entity class.
+
+    The names are the attributes to serialize (before filtering on fields).
+    The attributes are read with one attrgetter and only the foreign keys
+    and tuples are converted (see convert and reference_pk). The serializer
+    gets the object to serialize and the object with the attributes (the
+    same for an Entity, the _ui_orm for a UiOrmObject).
+    """
+    values = []
+    references = []
+    sets = []
+    for name in names:
+        if fields is not None and name not in fields:
+            continue
+        attr = entity_class._adict_[name]
+        if attr.is_collection:
+            # Not read: always an empty dictionary.
+            sets.append(name)
+            continue
+        if attr.is_relation and simple_primary_key(attr.py_type):
+            references.append((len(values), reference_pk))
+        elif attr.is_relation or (
+            isinstance(attr.py_type, type) and issubclass(attr.py_type, tuple)
+        ):
+            references.append((len(values), convert))
+        values.append(name)
+    if not values:
+        getter = lambda orm_object: ()
+    elif len(values) == 1:
+        single = operator.attrgetter(values[0])
+        getter = lambda orm_object: (single(orm_object),)
+    else:
+        getter = operator.attrgetter(*values)
+    simple_pk = simple_primary_key(entity_class)
+
+    def serialize(object_to_serialize, orm_object):
+        row = getter(orm_object)
+        if references:
+            row = list(row)
+            for index, converter in references:
+                row[index] = converter(object_to_serialize, row[index])
+        result = dict(zip(values, row))
+        for name in sets:
+            result[name] = {}
+        # Also putting out the primary key
+        if simple_pk:
+            result["_pk_"] = orm_object._pk_
+        else:
+            result["_pk_"] = convert(object_to_serialize, object_to_serialize._pk_)
+        return result
+
+    return serialize
+
+
+def compile_generic(names, fields):
+    """
+    Returns the serializer for objects that are not (backed by) an Entity.
+
+    Every attribute is read by name and converted.
+    """
+    names = [name for name in names if fields is None or name in fields]
+
+    def serialize(object_to_serialize, orm_object):
+        result = {}
+        for name in names:
+            result[name] = convert(
+                object_to_serialize, getattr(object_to_serialize, name)
+            )
+        # Also putting out the primary key
+        result["_pk_"] = convert(object_to_serialize, object_to_serialize._pk_)
+        return result
+
+    return serialize
+
+
+def compile_ui(ui_class, entity_class, names, fields):
+    """
+    Returns the serializer of the objects of a UiOrmObject class.
+
+    The columns are read from the _ui_orm (see compile_entity), except those
+    the UiOrmObject class overrides (e.g. with a property). Those and the
+    other names are read from the UiOrmObject itself (see compile_generic).
+    """
+    direct = []
+    others = []
+    for name in names:
+        if (
+            name in entity_class._adict_
+            and not name.startswith("ui_")
+            and not hasattr(ui_class, name)
+        ):
+            direct.append(name)
+        else:
+            others.append(name)
+    if not others:
+        return compile_entity(entity_class, direct, fields)
+    if not direct:
+        return compile_generic(others, fields)
+    serialize_direct = compile_entity(entity_class, direct, fields)
+    serialize_others = compile_generic(others, fields)
+
+    def serialize(object_to_serialize, orm_object):
+        result = serialize_direct(object_to_serialize, orm_object)
+        result.update(serialize_others(object_to_serialize, orm_object))
+        return result
+
+    return serialize
+
+
+def serializer(object_to_serialize, fields):
+    """
+    Returns the (cached) serializer of the class of the ORM object.
+
+    The serializer is compiled once per class (and fields). For a
+    UiOrmObject the attributes are its ui_attributes, which are assumed to
+    be the same for all the objects of a class.
+    """
+    cls = object_to_serialize.__class__
+    if isinstance(object_to_serialize, Entity):
+        orm_class = cls
+    else:
+        orm_class = object_to_serialize._ui_orm.__class__
+    key = (cls, orm_class, fields)
+    serialize = serializers.get(key)
+    if serialize is None:
+        if orm_class is cls:
+            serialize = compile_entity(cls, [attr.name for attr in cls._attrs_], fields)
+        else:
+            names = list(object_to_serialize.ui_attributes)
+            if issubclass(orm_class, Entity):
+                serialize = compile_ui(cls, orm_class, names, fields)
+            else:
+                serialize = compile_generic(names, fields)
+        if len(serializers) >= max_serializers:
+            serializers.clear()
+        serializers[key] = serialize
+    return serialize
+
+
+def to_json(object_to_serialize, fields=None):
     """
     Adding simple serialization for objects.
 
     If standard json.dumps fails and it is a real object it will try to call
     toJSON() on it. If that fails it will return a TypeError.
+
+    With fields (a set of attribute names) only those attributes of the ORM
+    objects are serialized, besides _pk_. The other attributes are not read,
+    so their lazy columns and related objects are not loaded.
+
+    The ORM objects are serialized by a serializer compiled per class (see
+    serializer).
     """
-    result = {}
     if isinstance(object_to_serialize, Entity):
-        for attr in object_to_serialize._attrs_:
-            column = attr.name
-            result[column] = getattr(object_to_serialize, column)
-    elif isinstance(object_to_serialize, suapp.orm.UiOrmObject):
-        for column in object_to_serialize.ui_attributes:
-            result[column] = getattr(object_to_serialize, column)
+        if fields is not None:
+            fields = frozenset(fields)
+        return serializer(object_to_serialize, fields)(
+            object_to_serialize, object_to_serialize
+        )
+    if isinstance(object_to_serialize, suapp.orm.UiOrmObject):
+        if fields is not None:
+            fields = frozenset(fields)
+        return serializer(object_to_serialize, fields)(
+            object_to_serialize, object_to_serialize._ui_orm
+        )
+    try:
+        return json.dumps(object_to_serialize)
+    except TypeError as te:
+        if isinstance(object_to_serialize, object):
+            try:
+                return getattr(object_to_serialize, "toJSON")()
+            except AttributeError:
+                raise TypeError(repr(object_to_serialize) + " is not JSON serializable")
+        # Re-raising the TypeError
+        raise
+
+
+def dumps(object_to_serialize, fields=None, **kwargs):
+    """
+    Returns the json with the objects serialized by to_json.
+
+    With fields only those attributes of the ORM objects are serialized.
+    """
+    if fields is None:
+        kwargs["default"] = to_json
     else:
-        try:
-            return json.dumps(object_to_serialize)
-        except TypeError as te:
-            if isinstance(object_to_serialize, object):
-                try:
-                    return getattr(object_to_serialize, "toJSON")()
-                except AttributeError:
-                    raise TypeError(
-                        repr(object_to_serialize) + " is not JSON serializable"
-                    )
-            # Re-raising the TypeError
-            raise
-        return result
-    # Also putting out the primary key
-    result["_pk_"] = object_to_serialize._pk_
-    # result['__str__'] = "%s" % (object_to_serialize)
-    # Checking for foreign keys
-    for column, value in result.items():
-        if isinstance(value, Entity):
-            value = value._pk_
-            # Setting it
-            # If is a Set or tuple it will be set again below.
-            result[column] = value
-        if isinstance(value, SetInstance):
-            # An empty dictonary signals a Set.
-            result[column] = {}
-        elif isinstance(value, tuple):
-            # On json a tuple = list, so might as well use a list.
-            converted_tuple = []
-            for subvalue in value:
-                # Finding out the references to variables.
-                if isinstance(subvalue, Required) or isinstance(subvalue, Optional):
-                    cur_obj = object_to_serialize
-                    path = str(subvalue).split(".")[1:]
-                    while len(path) > 0:
-                        subvalue = getattr(cur_obj, path.pop(0))
-                        cur_obj = subvalue
-                if isinstance(subvalue, Entity):
-                    subvalue = subvalue._pk_
-                converted_tuple.append(subvalue)
-            result[column] = converted_tuple
-    return result
-
-
-def dumps(object_to_serialize, **kwargs):
-    kwargs["default"] = to_json
+        fields = frozenset(fields)
+        kwargs["default"] = lambda o: to_json(o, fields)
     return json.dumps(object_to_serialize, **kwargs)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Web target on asyncio streams.
+
+It behaves like the localweb target and reuses its request handling (the
+do_service_* methods, authorized() and the HtmlTemplatingEngine), so flows and
+modlib view definitions run unchanged.
+
+The difference is in the connection handling: all the connections live on one
+asyncio event loop, so idle keep-alive connections cost next to nothing. Only
+a request that was read completely is handed to a pool of worker threads
+(httpd.workers, 10 by default) as that is where the blocking work happens
+(e.g. the Jeeves do_query, do_fetch and do_fetch_set).
+
+A request body is read into memory, so it can be at most httpd.max_body_size
+bytes (10 MiB by default). A bigger one is answered with a 413.
+"""
+
+import asyncio
+import concurrent.futures
+import http
+import http.client
+import io
+
+from suapp.logdecorator import *
+
+# The flow looks up the Woosters in the target module.
+from suapp.targets.localweb import (
+    About,
+    Configuration,
+    LocalWebHandler,
+    Record,
+    Table,
+    View,
+)
+import suapp.targets.localweb as localweb
+
+
+class AsyncWebHandler(LocalWebHandler):
+    """
+    Handles one request that was read by the AsyncWebServer.
+
+    The request is read from and the response written to memory buffers. The
+    response is always framed by the handler (Content-Length and Connection
+    headers) so the connection can be kept alive.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # The AsyncWebServer handles the idle connections.
+    timeout = None
+    max_requests = None
+
+    def __init__(self, raw_request, client_address, server):
+        """
+        Sets up the buffers for the request.
+
+        Not calling BaseRequestHandler.__init__ as that handles the request
+        straight away.
+        """
+        self.rfile = io.BytesIO(raw_request)
+        self.wfile = io.BytesIO()
+        self.client_address = client_address
+        self.server = server
+        self.response_headers = []
+
+    def flush_headers(self):
+        """
+        Keeps the headers aside instead of writing them to the wfile.
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        if hasattr(self, "_headers_buffer"):
+            self.response_headers.extend(self._headers_buffer)
+            self._headers_buffer = []
+
+    def handle_request(self):
+        """
+        Handles the request and returns the response and if we should close.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        self.flush_headers()
+        body = self.wfile.getvalue()
+        if not self.response_headers:
+            # Nothing to send (e.g. an empty request line).
+            return (body, True)
+        # The last header line is the empty line closing the headers.
+        headers = self.response_headers[:-1]
+        header_names = set()
+        for line in headers[1:]:
+            header_names.add(line.split(b":", 1)[0].strip().lower())
+        status = int(headers[0].split()[1])
+        if status >= 200 and status not in (204, 304):
+            if b"content-length" not in header_names:
+                if b"transfer-encoding" not in header_names:
+                    headers.append(b"Content-Length: %d\r\n" % (len(body)))
+        if self.close_connection and b"connection" not in header_names:
+            headers.append(b"Connection: close\r\n")
+        headers.append(b"\r\n")
+        return (b"".join(headers) + body, self.close_connection)
+
+
+def error_response(status):
+    """
+    Returns the raw response for an error status that closes the connection.
+    """
+    reason = http.HTTPStatus(status).phrase.encode("ascii")
+    return (
+        b"HTTP/1.1 %d %s\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"Content-Length: %d\r\n"
+        b"Connection: close\r\n"
+        b"\r\n"
+        b"%s" % (status, reason, len(reason), reason)
+    )
+
+
+# The answer when handling a request failed.
+internal_server_error = error_response(500)
+# The answer to a missing or invalid Content-Length.
+bad_request = error_response(400)
+# The answer to a body bigger than the max_body_size.
+request_entity_too_large = error_response(413)
+
+
+class AsyncWebServer:
+    """
+    Web server on asyncio streams.
+
+    It has the same serve_forever(), shutdown() and server_close() methods as
+    a socketserver so it can be run in the localweb ServerThread.
+    """
+
+    @loguse
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass=None,
+        workers=None,
+        idle_timeout=None,
+        reuse_port=False,
+        max_body_size=None,
+    ):
+        """
+        Creates the server.
+
+        By default there are 10 worker threads, idle connections are
+        closed after 300 seconds and a request body is at most 10 MiB
+        (max_body_size in bytes). With reuse_port several processes can
+        serve on the same port (SO_REUSEPORT), the kernel spreads the
+        connections over them.
+        """
+        if not RequestHandlerClass:
+            RequestHandlerClass = AsyncWebHandler
+        if not workers:
+            workers = 10
+        if not idle_timeout:
+            idle_timeout = 300
+        if max_body_size is None:
+            max_body_size = 10 * 1024 * 1024
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.idle_timeout = float(idle_timeout)
+        self.reuse_port = bool(reuse_port)
+        self.max_body_size = int(max_body_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(workers), thread_name_prefix="AsyncWebWorker"
+        )
+        self.loop = None
+        self.stopped = None
+        self.connections = set()
+        self.started = concurrent.futures.Future()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads the requests on a connection and writes the responses.
+        """
+        client_address = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.idle_timeout
+                    )
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                    asyncio.TimeoutError,
+                    ConnectionError,
+                ):
+                    # Closed, too long or idle for too long.
+                    break
+                body = b""
+                try:
+                    headers = http.client.parse_headers(
+                        io.BytesIO(head.split(b"\r\n", 1)[1])
+                    )
+                    length = headers.get("Content-Length")
+                except Exception:
+                    # Let the handler answer the malformed request.
+                    length = None
+                if length is not None:
+                    length = length.strip()
+                    if not (length.isascii() and length.isdigit()):
+                        # Negative or not a number.
+                        writer.write(bad_request)
+                        await writer.drain()
+                        break
+                    if int(length) > self.max_body_size:
+                        writer.write(request_entity_too_large)
+                        await writer.drain()
+                        break
+                    try:
+                        body = await reader.readexactly(int(length))
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        break
+                handler = self.RequestHandlerClass(head + body, client_address, self)
+                try:
+                    (response, close) = await loop.run_in_executor(
+                        self.executor, handler.handle_request
+                    )
+                except Exception:
+                    logging.getLogger(__name__).exception(
+                        "Error handling a request from %s" % (client_address,)
+                    )
+                    (response, close) = (internal_server_error, True)
+                writer.write(response)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError as err:
+            logging.getLogger(__name__).info("Connection error: %s" % (err))
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        """
+        Serves until shutdown() is called.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(
+            self.handle_connection,
+            self.server_address[0],
+            self.server_address[1],
+            reuse_port=self.reuse_port or None,
+        )
+        # Port 0 gets a free port.
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self.started.set_result(True)
+        async with server:
+            await self.stopped.wait()
+            # Not waiting for the idle keep-alive connections.
+            for writer in list(self.connections):
+                writer.close()
+
+    @loguse
+    def serve_forever(self):
+        """
+        Runs the event loop until shutdown() is called.
+        """
+        asyncio.run(self.serve())
+
+    @loguse
+    def shutdown(self):
+        """
+        Stops serve_forever(), can be called from another thread.
+        """
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    @loguse
+    def server_close(self):
+        """
+        Stops the worker threads.
+        """
+        self.executor.shutdown(wait=False)
+
+
+class Application(localweb.Application):
+    """
+    Application home page served by the AsyncWebServer.
+    """
+
+    @loguse("@")  # Not logging the return value.
+    def create_server(self, httpd_conf):
+        """
+        Returns the AsyncWebServer for the ip and port.
+
+        With httpd.processes every process binds the port (SO_REUSEPORT).
+        """
+        return AsyncWebServer(
+            (self.ip, self.port),
+            workers=httpd_conf.get("workers"),
+            idle_timeout=httpd_conf.get("idle_timeout"),
+            reuse_port=bool(httpd_conf.get("processes")),
+            max_body_size=httpd_conf.get("max_body_size"),
+        )
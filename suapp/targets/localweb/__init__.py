@@ -3,24 +3,50 @@
 
 
 import collections
+import concurrent.futures
+import copy
+import functools
 import hashlib
+from html import escape
 import http.cookies
 import http.server
 import json
-from threading import Thread
+from threading import (
+    BoundedSemaphore,
+    Event,
+    Lock,
+    RLock,
+    Thread,
+    current_thread,
+    main_thread,
+)
 import time
 import traceback
+import types
 import os.path
 import random
+import select
+import shutil
+import signal
+import ssl
 import string
 import sys
 import urllib.parse
 import webbrowser
+import zlib
+
+import pony.orm
 
 import suapp.jandw
 from suapp.logdecorator import *
 
 import suapp.simple_json as simple_json
+from suapp.targets.localweb.admission import AdmissionControl
+from suapp.targets.localweb.metrics import MetricsRegistry
+from suapp.targets.localweb.sessions import SQLiteSessionBackend
+from suapp.targets.localweb.routes import Route, RouteTable, json_mime, route
+from suapp.targets.localweb.static import StaticFileCache
+from suapp.targets.localweb.templates import CompiledTemplate, TemplateDirectory
 
 users = {
     "admin": "".join(
@@ -47,6 +73,27 @@ groups = {"administrators": ["admin"]}
 
 reserved_params = ["OUT"]
 
+# The mime types worth compressing.
+compressible_mimes = [
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/x-javascript",
+    "image/svg+xml",
+]
+
+# The mime types of the images by extension.
+static_mimes = {
+    ".png": "image/png",
+    ".ico": "image/x-icon",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+}
+
+# The wbits for zlib per content coding.
+content_codings = collections.OrderedDict([("gzip", 31), ("deflate", 15)])
+
 js_fancy_table = """
 $(document).ready(function() {
     $("tr:even").css("background-color", "#F4F4F8");
@@ -56,9 +103,109 @@ $(document).ready(function() {
 """
 
 
+# No @loguse as this is called for every response.
+def negotiate_encoding(accept_encoding, available=None):
+    """
+    Returns the content coding to use for the Accept-Encoding header value.
+
+    The available codings are in order of preference (by default gzip and
+    deflate). It returns None if the client accepts none of them (then the
+    response is sent as is: identity).
+    """
+    if not accept_encoding:
+        return None
+    if available is None:
+        available = content_codings.keys()
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        coding, *params = coding.strip().split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best = None
+    best_quality = 0.0
+    for coding in available:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best = coding
+            best_quality = quality
+    return best
+
+
+# No @loguse as this is called for every response.
+def compress(body, encoding, level=6):
+    """
+    Compresses the body (bytes) with the content coding gzip or deflate.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, content_codings[encoding])
+    return compressor.compress(body) + compressor.flush()
+
+
+# No @loguse as this is called for every query.
+def field_projection(fields):
+    """
+    Returns the attributes asked for with the "fields" GET/POST variable.
+
+    It is a comma separated list (e.g. fields=code,name) and can be repeated.
+    Without it there is no projection and it returns None.
+    """
+    if "fields" not in fields:
+        return None
+    return [
+        name.strip()
+        for value in fields["fields"]
+        for name in value.split(",")
+        if name.strip()
+    ]
+
+
+# No @loguse as the generator would be logged instead of the rows.
+def json_stream_query(results, projection=None):
+    """
+    Yields the json of a query result piece by piece.
+
+    The objects are serialized one at the time, so the result of the query
+    never has to be in memory. The json is the same as for the query result
+    without streaming, only the order of the keys differs. An error while
+    fetching the rows sets result to false with the message and traceback.
+    With a projection only those attributes of the objects are serialized.
+    """
+    yield '{"objects": ['
+    first = None
+    try:
+        for row in results:
+            if first is None:
+                first = row
+                yield simple_json.dumps(row, fields=projection)
+            else:
+                yield ", " + simple_json.dumps(row, fields=projection)
+        tail = {"result": True, "module": None, "table": None}
+        if first is not None:
+            tail["module"] = first.__class__.__module__
+            tail["table"] = first.__class__.__name__
+    except Exception as e:
+        tail = {
+            "result": False,
+            "message": "Error during query (%s: %s)" % (type(e), e),
+            "traceback": traceback.format_exc().split("\n"),
+        }
+    yield "], " + simple_json.dumps(tail)[1:]
+
+
 class HtmlTemplatingEngine:
     """
     Templating engine for the html.
+
+    With a template_directory (a TemplateDirectory) its layout.html replaces
+    the html_template (with the slots title and body) and its page.html the
+    navbar, breadcrumb and footer (with the slots title, shortname, menu and
+    main). Other files in it are fragments (see fragment).
     """
 
     @staticmethod
@@ -169,31 +316,63 @@ class HtmlTemplatingEngine:
             self.html_template = str(template)
         else:
             self.html_template = HtmlTemplatingEngine.html_template()
+        self.template_directory = None
+        # The compiled pages per prefix and the html of the menus (see html).
+        self.pages = {}
+        self.pages_source = None
+        self.menus = {}
+        self.max_menus = 256
+        self.menu = HtmlTemplatingEngine.default_menu()
 
-    @loguse([1, 3, "@"])  # Not logging session, main nor the return value.
-    def html(self, session, title, main, prefix=None, menu=None, shortname=None):
+    @staticmethod
+    def default_menu():
         """
-        Returns the html code.
+        Returns the menu used when there is none.
         """
-        if not shortname:
-            shortname = "SuApp"
-        if prefix is None:
-            prefix = ""
-        if menu is None:
-            # TODO: THIS NEXT LINE IS OBVIOUSLY WRONG - FOR TESTING TEMPORARILY. # DELME
-            file_menu = collections.OrderedDict()
-            file_menu["Quit"] = "EXIT"
-            test_menu = collections.OrderedDict()
-            test_menu["Table"] = "TABLE"
-            test_menu["Record"] = "RECORD"
-            test_menu["Adults"] = "ADULTS"
-            help_menu = collections.OrderedDict()
-            help_menu["Configuration"] = "CONFIGURATION"
-            help_menu["About"] = "ABOUT"
-            menu = collections.OrderedDict()
-            menu["File"] = file_menu
-            menu["Test"] = test_menu
-            menu["Help"] = help_menu
+        # TODO: THIS IS OBVIOUSLY WRONG - FOR TESTING TEMPORARILY. # DELME
+        file_menu = collections.OrderedDict()
+        file_menu["Quit"] = "EXIT"
+        test_menu = collections.OrderedDict()
+        test_menu["Table"] = "TABLE"
+        test_menu["Record"] = "RECORD"
+        test_menu["Adults"] = "ADULTS"
+        help_menu = collections.OrderedDict()
+        help_menu["Configuration"] = "CONFIGURATION"
+        help_menu["About"] = "ABOUT"
+        menu = collections.OrderedDict()
+        menu["File"] = file_menu
+        menu["Test"] = test_menu
+        menu["Help"] = help_menu
+        return menu
+
+    # No @loguse as this is called for every page.
+    def page_template(self, prefix):
+        """
+        Returns the html template of the page as CompiledTemplate.
+
+        The template has the slots title, shortname, menu and main. It is
+        compiled once per prefix (and again when html_template or the files
+        in the template_directory changed).
+        """
+        (layout, body) = (None, None)
+        if self.template_directory is not None:
+            layout = self.template_directory.get("layout.html")
+            body = self.template_directory.get("page.html")
+        source = (layout or self.html_template, body)
+        if self.pages_source != source:
+            self.pages = {}
+            self.pages_source = source
+        page = self.pages.get(prefix)
+        if page is not None:
+            return page
+        if layout is None:
+            layout = CompiledTemplate(self.html_template)
+        if body is not None:
+            page = self.pages[prefix] = layout.splice("body", body)
+            return page
+        key = prefix
+        # The prefix is static text in the template.
+        prefix = prefix.replace("%", "%%")
         output = []
         # output.append(prefix + '<!-- %s // -->' % (tables))
         # output.append(prefix + '<!-- Entered with mode %s // -->' % (???))
@@ -210,36 +389,18 @@ class HtmlTemplatingEngine:
         output.append(prefix + '\t\t\t\t<span class="icon-bar"></span>')
         output.append(prefix + "\t\t\t</button>")
         output.append(
-            prefix + '\t\t\t<a class="navbar-brand" href="/">%s</a>' % (shortname)
+            prefix + '\t\t\t<a class="navbar-brand" href="/">%(shortname)s</a>'
         )
         output.append(prefix + "\t\t</div>")
         output.append(prefix + '\t\t<div class="navbar-collapse collapse">')
         output.append(prefix + '\t\t\t<ul class="nav navbar-nav navbar-left">')
-        output.append(prefix + '\t\t\t\t<li><a href="/">%s</a></li>' % ("Start"))
-        # TODO: for now this is only 2 deep, perhaps we should make this multilevel.
-        for menu_name, menu_sub in menu.items():
-            if type(menu_sub) == type(menu):
-                output.append(prefix + '\t\t\t\t<li class="dropdown">')
-                output.append(
-                    prefix
-                    + '\t\t\t\t\t<a href="/%s" class="dropdown-toggle" data-toggle="dropdown">%s <b class="caret"></b></a>'
-                    % (menu_name, menu_name)
-                )
-                output.append(prefix + '\t\t\t\t\t<ul class="dropdown-menu">')
-                for label, outmessage in menu_sub.items():
-                    output.append(
-                        prefix
-                        + '\t\t\t\t\t\t<li><a href="/?OUT=%s">%s</a></li>'
-                        % (outmessage, label)
-                    )
-                output.append(prefix + "\t\t\t\t\t</ul>")
-                output.append(prefix + "\t\t\t\t</li>")
-            else:
-                output.append(
-                    prefix
-                    + '\t\t\t\t<li><a href="/?OUT=%s">Stefaan</a></li>' % (menu_sub)
-                )
-        output.append(prefix + "\t\t\t</ul>")
+        # The menu slot has its own line ends, as it can be empty.
+        output.append(
+            prefix
+            + '\t\t\t\t<li><a href="/">Start</a></li>\n%(menu)s'
+            + prefix
+            + "\t\t\t</ul>"
+        )
 
         # In the future maybe used.
         # output.append(prefix + '\t\t\t<form class="navbar-form navbar-left" action="/search.html" role="search">')
@@ -262,7 +423,7 @@ class HtmlTemplatingEngine:
         output.append(prefix + '\t\t<li class="active">Home</li>')
         output.append(prefix + "\t</ol>")
         output.append(prefix + '\t<div class="page-header">')
-        output.append(prefix + "\t\t<h1>%s</h1>" % (title))
+        output.append(prefix + "\t\t<h1>%(title)s</h1>")
         output.append(prefix + "\t</div>")
 
         output.append(prefix + '\t<div class="row">')
@@ -272,11 +433,8 @@ class HtmlTemplatingEngine:
         # output.append(prefix + '\t\t\t\t\t<li class="next"><a href="/stefaan.html">Stefaan &rarr;</a></li>')
         # output.append(prefix + '\t\t\t\t</ul>')
 
-        output.append(prefix + "\t\t\t\t<main>")
-        if main:
-            output.append(prefix + "\t\t\t\t\t%s" % (main))
-        # TODO
-        output.append(prefix + "\t\t\t\t</main>")
+        # The main slot has its own line end, as it can be empty.
+        output.append(prefix + "\t\t\t\t<main>\n%(main)s" + prefix + "\t\t\t\t</main>")
 
         # Maybe used later for "Most queried objects."
         # output.append(prefix + '\t\t\t\t<ul class="pager">')
@@ -321,7 +479,105 @@ class HtmlTemplatingEngine:
         output.append(prefix + "\t</div>")
 
         output.append(prefix + "</div>")
-        return self.html_template % {"title": title, "body": "\n".join(output)}
+        page = layout.splice("body", CompiledTemplate("\n".join(output)))
+        self.pages[key] = page
+        return page
+
+    # No @loguse as this is called for every page.
+    def fragment(self, names, values):
+        """
+        Returns the first of the template files names with the values in it,
+        or None if there is none of them (or no template_directory).
+
+        A slot without value is left empty.
+        """
+        if self.template_directory is None:
+            return None
+        for name in names:
+            template = self.template_directory.get(name)
+            if template is not None:
+                return template.render(collections.defaultdict(str, values))
+        return None
+
+    # No @loguse as this is called for every page.
+    def menu_html(self, prefix, menu):
+        """
+        Returns the html of the menu items, every line ending with a newline.
+
+        The html is kept per distinct menu (and prefix), so a menu is only
+        rendered once.
+        """
+        key = [prefix]
+        for menu_name, menu_sub in menu.items():
+            if type(menu_sub) == type(menu):
+                key.append((menu_name, tuple(menu_sub.items())))
+            else:
+                key.append((menu_name, menu_sub))
+        try:
+            key = tuple(key)
+            return self.menus[key]
+        except TypeError:
+            # Not hashable: not cached.
+            key = None
+        except KeyError:
+            pass
+        output = []
+        # TODO: for now this is only 2 deep, perhaps we should make this multilevel.
+        for menu_name, menu_sub in menu.items():
+            if type(menu_sub) == type(menu):
+                output.append(prefix + '\t\t\t\t<li class="dropdown">')
+                output.append(
+                    prefix
+                    + '\t\t\t\t\t<a href="/%s" class="dropdown-toggle" data-toggle="dropdown">%s <b class="caret"></b></a>'
+                    % (menu_name, menu_name)
+                )
+                output.append(prefix + '\t\t\t\t\t<ul class="dropdown-menu">')
+                for label, outmessage in menu_sub.items():
+                    output.append(
+                        prefix
+                        + '\t\t\t\t\t\t<li><a href="/?OUT=%s">%s</a></li>'
+                        % (outmessage, label)
+                    )
+                output.append(prefix + "\t\t\t\t\t</ul>")
+                output.append(prefix + "\t\t\t\t</li>")
+            else:
+                output.append(
+                    prefix
+                    + '\t\t\t\t<li><a href="/?OUT=%s">Stefaan</a></li>' % (menu_sub)
+                )
+        html = "".join(line + "\n" for line in output)
+        if key is not None:
+            if len(self.menus) >= self.max_menus:
+                self.menus.clear()
+            self.menus[key] = html
+        return html
+
+    @loguse([1, 3, "@"])  # Not logging session, main nor the return value.
+    def html(self, session, title, main, prefix=None, menu=None, shortname=None):
+        """
+        Returns the html code.
+
+        The page is the compiled page template (see page_template) with the
+        title, shortname, menu and main put in, joined at once.
+        """
+        if not shortname:
+            shortname = "SuApp"
+        if prefix is None:
+            prefix = ""
+        if menu is None:
+            menu = self.menu
+        if main:
+            main = "%s\t\t\t\t\t%s\n" % (prefix, main)
+        else:
+            main = ""
+        return self.page_template(prefix).render(
+            {
+                "title": "%s" % (title),
+                "shortname": "%s" % (shortname),
+                "menu": self.menu_html(prefix, menu),
+                "main": main,
+            }
+        )
 
 
 class Session(dict):
@@ -329,14 +585,156 @@ class Session(dict):
     Session is a dictionary that contains all session relevant objects.
 
     There is also a id variable that contains the session id.
+
+    The transient entries (jeeves, drone) are not stored in a session
+    backend. When missing they are rehydrated with the functions in
+    rehydrate (see SessionStore). The drone is stored as its drone-state
+    instead (see drone_state and rehydrate_drone).
     """
 
+    transient = ("jeeves", "drone", "last-used")
+
     @loguse
-    def __init__(self, sessionid):
+    def __init__(self, sessionid, rehydrate=None):
         """
         Initializing the session with an id.
         """
         self.id = sessionid
+        self.rehydrate = rehydrate or {}
+        # In the SessionStore (see SessionStore.store).
+        self.stored = False
+        # Something was written to it.
+        self.written = False
+        # Changed since it was saved in the session backend.
+        self.dirty = False
+        self.version = None
+        # The changes of a fork (see fork).
+        self.changes = None
+
+    def __setitem__(self, key, value):
+        """
+        Overridden to mark the session as changed.
+        """
+        super().__setitem__(key, value)
+        self.written = True
+        if key not in self.transient or key == "drone":
+            self.dirty = True
+        if self.changes is not None:
+            self.changes[key] = (True, value)
+
+    def __delitem__(self, key):
+        """
+        Overridden to mark the session as changed.
+        """
+        super().__delitem__(key)
+        self.written = True
+        if key not in self.transient:
+            self.dirty = True
+        if self.changes is not None:
+            self.changes[key] = (False, None)
+
+    def __missing__(self, key):
+        """
+        Rehydrates a transient entry or raises a KeyError.
+        """
+        if key in self.rehydrate:
+            value = self.rehydrate[key](self)
+            if value is not None:
+                super().__setitem__(key, value)
+                return value
+        raise KeyError(key)
+
+    @loguse("@")  # Not logging the return value.
+    def fork(self):
+        """
+        Returns a copy of the session that records its changes.
+
+        The changes are applied to the session with merge, so the session
+        isn't changed by several threads at once (see do_service_batch).
+        """
+        fork = Session(self.id, self.rehydrate)
+        dict.update(fork, self)
+        fork.changes = {}
+        return fork
+
+    @loguse
+    def merge(self, fork):
+        """
+        Applies the changes of a fork (see fork) to the session.
+        """
+        for key, (written, value) in fork.changes.items():
+            if written:
+                self[key] = value
+            elif key in self:
+                del self[key]
+
+    # No @loguse as this is called for every changed session.
+    def payload(self):
+        """
+        Returns the entries that can be stored in a session backend.
+        """
+        payload = {}
+        for key, value in self.items():
+            if key in self.transient:
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            payload[key] = value
+        if dict.get(self, "drone") is not None:
+            payload["drone-state"] = drone_state(dict.get(self, "drone"))
+        return payload
+
+
+# No @loguse as this is called for every changed session.
+def drone_state(drone):
+    """
+    Returns the json serializable state of the drone of a session.
+
+    The session in the dataobject and its other entries that can't be
+    serialized are left out.
+    """
+    dataobject = getattr(drone, "dataobject", None)
+    if isinstance(dataobject, dict):
+        state = {}
+        for key, value in dataobject.items():
+            if key == "session":
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            state[key] = value
+        dataobject = state
+    else:
+        dataobject = None
+    return {
+        "name": drone.name,
+        "mode": getattr(drone, "mode", None),
+        "dataobject": dataobject,
+    }
+
+
+@loguse("@")  # Not logging the return value.
+def rehydrate_drone(session):
+    """
+    Returns the drone of a session loaded from a session backend.
+
+    The drone is cloned again from the flow of the jeeves with the stored
+    drone-state (see drone_state), or None without one.
+    """
+    state = dict.get(session, "drone-state")
+    if not state:
+        return None
+    try:
+        drone = session["jeeves"].whichDrone("", state["name"])
+    except (suapp.jandw.FlowException, suapp.jandw.ApplicationClosed):
+        return None
+    dataobject = state["dataobject"]
+    if dataobject is not None:
+        dataobject = dict(dataobject, session=session)
+    return drone.get_new_instance_clone(dataobject, state["mode"])
 
 
 class SessionStore(dict):
@@ -352,15 +750,33 @@ class SessionStore(dict):
     the timeout is 3600 seconds. You can set both the prefix and timeout (in
     seconds) in the constructor:
         SessionStore(prefix = "SUAPP", timeout = 300)
+
+    There are at most max_sessions (10000 by default) sessions in the store,
+    beyond that the least recently used session is evicted. The expired
+    sessions are removed by reap(), which the reaper thread (see
+    start_reaper) calls regularly.
+
+    With a backend (see sessions) the sessions are also stored outside the
+    process. The store then only caches the sessions: an evicted session
+    is loaded again from the backend, as is a session another process
+    created or changed. The changes to a session are stored by save().
+    The transient entries of a loaded session are rehydrated by the
+    functions in rehydrate, e.g.:
+        sessions.rehydrate["jeeves"] = lambda session: jeeves
+        sessions.rehydrate["drone"] = rehydrate_drone
+    The reaper then only drops the local copies of the sessions not used
+    by this process: another process can still be using them. The expired
+    sessions are removed from the backend by its expire().
     """
 
     @loguse
-    def __init__(self, prefix=None, timeout=None):
+    def __init__(self, prefix=None, timeout=None, max_sessions=None, backend=None):
         """
         Constructs the session store.
 
-        By default the session id previx is SUAPP and
-        the timeout is 3600 seconds (1 hour).
+        By default the session id previx is SUAPP,
+        the timeout is 3600 seconds (1 hour) and
+        the maximum number of sessions is 10000.
         """
         if not prefix:
             prefix = "SUAPP"
@@ -368,6 +784,20 @@ class SessionStore(dict):
         if not timeout:
             timeout = 3600
         self.timeout = int(timeout)
+        if not max_sessions:
+            max_sessions = 10000
+        self.max_sessions = int(max_sessions)
+        # The store is shared by all the request handling threads.
+        self.lock = RLock()
+        # The session ids from least to most recently used.
+        self.order = collections.OrderedDict()
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.reaper = None
+        self.reaper_stop = None
+        self.backend = backend
+        self.rehydrate = {}
 
     @loguse
     def new(self, **kwargs):
@@ -377,16 +807,94 @@ class SessionStore(dict):
         It resturns the session object.
         You can pass any keyword arguments to initialize the session.
         """
+        return self.store(self.create(**kwargs))
+
+    @loguse
+    def create(self, **kwargs):
+        """
+        Creates a new session object without adding it to the store.
+
+        Use store() to add it, e.g. once something is written to it.
+        You can pass any keyword arguments to initialize the session.
+        """
+        # Adding some randomness as two threads can ask for a new session
+        # within the same timestamp.
         sessionid = (
-            self.prefix + hashlib.sha1(time.time().hex().encode("utf-8")).hexdigest()
+            self.prefix
+            + hashlib.sha1(
+                time.time().hex().encode("utf-8") + os.urandom(16)
+            ).hexdigest()
         )
         now = time.time()
-        session = Session(sessionid)
+        session = Session(sessionid, self.rehydrate)
         session.update(kwargs)
         session.update({"created": now, "last-used": now})
-        super().__setitem__(sessionid, session)
         return session
 
+    @loguse
+    def store(self, session):
+        """
+        Adds a session from create() to the store and returns it.
+        """
+        with self.lock:
+            self.add(session)
+            self.created += 1
+        if self.backend is not None:
+            session.dirty = False
+            session.version = self.backend.save(
+                session.id, session.payload(), session["last-used"]
+            )
+        return session
+
+    def add(self, session):
+        """
+        Adds the session, evicting the least recently used beyond max_sessions.
+        """
+        with self.lock:
+            session.stored = True
+            super().__setitem__(session.id, session)
+            self.order[session.id] = None
+            self.order.move_to_end(session.id)
+            while len(self.order) > self.max_sessions:
+                oldest = self.order.popitem(last=False)[0]
+                super().__delitem__(oldest)
+                self.evicted += 1
+
+    def load(self, sessionid):
+        """
+        Returns the session from the backend, None if not there.
+
+        The cached session is updated if it changed in the backend.
+        """
+        stored = self.backend.load(sessionid)
+        with self.lock:
+            session = super().get(sessionid)
+            if stored is None:
+                if session is not None:
+                    # Deleted by another process.
+                    super().__delitem__(sessionid)
+                    del self.order[sessionid]
+                return None
+            (payload, last_used, version) = stored
+            if session is None:
+                session = Session(sessionid, self.rehydrate)
+                self.add(session)
+            if session.version != version:
+                transient = {
+                    key: value
+                    for (key, value) in session.items()
+                    if key in Session.transient
+                }
+                dict.clear(session)
+                dict.update(session, payload)
+                dict.update(session, transient)
+                session.version = version
+                session.dirty = False
+            dict.__setitem__(
+                session, "last-used", max(last_used, session.get("last-used", 0))
+            )
+            return session
+
     def __setitem__(self, sessionid, session):
         """
         Overridden to block adding a session to the store.
@@ -399,15 +907,135 @@ class SessionStore(dict):
         """
         Overridden to check if the session isn't stale.
         """
-        session = super().__getitem__(sessionid)
-        now = time.time()
-        if session["last-used"] + self.timeout < now:
-            # Stale session, removing it and acting as if it never existed.
-            del self[sessionid]
-            raise KeyError("The session %s has expired." % sessionid)
-        session["last-used"] = now
+        if self.backend is not None:
+            session = self.load(sessionid)
+            if session is None:
+                raise KeyError(sessionid)
+        with self.lock:
+            if self.backend is None:
+                session = super().__getitem__(sessionid)
+            now = time.time()
+            if session["last-used"] + self.timeout < now:
+                # Stale session, removing it and acting as if it never existed.
+                self.__delitem__(sessionid)
+                self.expired += 1
+                raise KeyError("The session %s has expired." % sessionid)
+            dict.__setitem__(session, "last-used", now)
+            if sessionid in self.order:
+                self.order.move_to_end(sessionid)
+        if self.backend is not None:
+            self.backend.touch(sessionid, now)
         return session
 
+    def __delitem__(self, sessionid):
+        """
+        Overridden to remove the session under the lock.
+        """
+        with self.lock:
+            super().__delitem__(sessionid)
+            del self.order[sessionid]
+        if self.backend is not None:
+            self.backend.delete(sessionid)
+
+    @loguse
+    def save(self, session):
+        """
+        Stores the changes of the session in the backend.
+        """
+        if self.backend is None or not session.dirty:
+            return
+        with self.lock:
+            if not super().__contains__(session.id):
+                # Deleted (e.g. logged off) or evicted.
+                return
+            session.dirty = False
+            payload = session.payload()
+        session.version = self.backend.save(session.id, payload, session["last-used"])
+
+    @loguse
+    def reap(self):
+        """
+        Removes the expired sessions and returns how many.
+
+        As the sessions are ordered by last use, it stops at the first session
+        that isn't expired. With a backend only the local copies are dropped
+        (counted as evicted) and the backend removes the expired sessions.
+        """
+        expired = 0
+        with self.lock:
+            limit = time.time() - self.timeout
+            while self.order:
+                sessionid = next(iter(self.order))
+                if super().__getitem__(sessionid)["last-used"] >= limit:
+                    break
+                if self.backend is None:
+                    self.__delitem__(sessionid)
+                    expired += 1
+                else:
+                    # Another process can still be using it.
+                    super().__delitem__(sessionid)
+                    del self.order[sessionid]
+                    self.evicted += 1
+        if self.backend is not None:
+            expired = self.backend.expire(time.time() - self.timeout)
+        with self.lock:
+            self.expired += expired
+        return expired
+
+    @loguse
+    def start_reaper(self, interval=None):
+        """
+        Starts the thread calling reap() every interval seconds.
+
+        By default the interval is 60 seconds.
+        """
+        if not interval:
+            interval = 60
+        with self.lock:
+            if self.reaper is not None and self.reaper.is_alive():
+                return
+            self.reaper_stop = Event()
+            self.reaper = Thread(
+                target=self.run_reaper,
+                args=(float(interval), self.reaper_stop),
+                name="SessionReaper",
+                daemon=True,
+            )
+            self.reaper.start()
+
+    def run_reaper(self, interval, stop):
+        """
+        Runs the reaper until stop is set.
+        """
+        while not stop.wait(interval):
+            try:
+                self.reap()
+            except Exception as err:
+                logging.getLogger(__name__).error("Reaping sessions: %s" % (err))
+
+    @loguse
+    def stop_reaper(self):
+        """
+        Stops the reaper thread.
+        """
+        if self.reaper_stop is not None:
+            self.reaper_stop.set()
+        self.reaper = None
+
+    @loguse
+    def stats(self):
+        """
+        Returns the number of sessions and the created/expired/evicted counters.
+        """
+        with self.lock:
+            return {
+                "sessions": len(self.order),
+                "max_sessions": self.max_sessions,
+                "created": self.created,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
     def __str__(self):
         """
         Returns all session, comma separated.
@@ -427,12 +1055,386 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
     start = None
     sessions = SessionStore()
     html_template_engine = HtmlTemplatingEngine()
+    # Keep-alive: idle timeout (seconds) and maximum requests per connection.
+    timeout = None
+    max_requests = None
+    # How often (in seconds) an idle keep-alive connection checks if it
+    # should give its worker back (see wait_for_request).
+    keep_alive_poll = 0.5
+    # Compression of the dynamic responses.
+    compress = True
+    compress_level = 6
+    compress_min_size = 1024
+    # Streaming (chunked) json of the query results.
+    stream_queries = False
+    stream_chunk_size = 16384
+    # The static files: css, js, img.
+    static_files = StaticFileCache(os.path.dirname(__file__))
+    # The routes: filled in with the do_service_* methods (see routes).
+    routes = RouteTable()
+    # The request metrics per route and per named query.
+    metrics = MetricsRegistry()
+    # Limits the dynamic requests in flight (see configure).
+    admission = AdmissionControl()
+    # The batch service: maximum sub-requests and the pool to run them.
+    batch_max = 50
+    batch_executor = None
+    # Conditional GET of the json services (see configure).
+    etags = True
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Adds the routes of the methods of the subclass.
 
-    def send_last_modified_header(self):
+        They go in its own RouteTable, so they don't change the routes of
+        the parent class (and its other subclasses).
+        """
+        super().__init_subclass__(**kwargs)
+        cls.routes = cls.routes.child()
+        cls.routes.add_methods(cls)
+
+    @classmethod
+    def configure(cls, httpd_conf):
+        """
+        Configures the handler from the httpd configuration.
+
+        Keep-alive is off by default, enable it with:
+            "httpd": {
+                "keep_alive": true,
+                "keep_alive_timeout": 15,
+                "keep_alive_max": 100
+            }
+        A keep-alive connection holds one of the httpd.workers, also while
+        it is idle. So an idle connection is closed as soon as another
+        connection waits for a worker, and while connections are waiting the
+        responses close their connection. The keep_alive_timeout only
+        applies to a server with spare workers.
+
+        Compression of the responses is on by default when the client accepts
+        gzip or deflate. These are the defaults:
+            "httpd": {
+                "compress": true,
+                "compress_level": 6,
+                "compress_min_size": 1024
+            }
+
+        The result of /service/query/ is streamed when the "stream" GET/POST
+        variable is set or when stream_queries is on. It is sent in chunks of
+        stream_chunk_size bytes (chunked on HTTP/1.1, else until the
+        connection closes):
+            "httpd": {
+                "stream_queries": false,
+                "stream_chunk_size": 16384
+            }
+
+        With template_dir the page layout and the error pages can be changed
+        without a restart. Its layout.html replaces the html template, its
+        page.html the navbar, breadcrumb and footer and error-<code>.html (or
+        error.html) the body of the error pages. The files are compiled once
+        and checked for changes every template_check_interval seconds:
+            "httpd": {
+                "template_dir": "~/.suapp/templates",
+                "template_check_interval": 2
+            }
+
+        Sessions expire after session_timeout seconds unused and are removed
+        every session_reap_interval seconds. Beyond max_sessions the least
+        recently used session is evicted:
+            "httpd": {
+                "session_timeout": 3600,
+                "session_reap_interval": 60,
+                "max_sessions": 10000
+            }
+
+        Admission control is off by default. With max_in_flight at most that
+        many dynamic requests (pages and services) are handled at the same
+        time. A request waits at most max_queue_wait seconds for its turn,
+        after that it gets a 503 with a Retry-After of retry_after seconds.
+        The static files and /health are not limited, so keep max_in_flight
+        below workers to leave them a worker. With shed_load (on by default
+        with max_in_flight) a connection that finds all the workers busy and
+        the queue full gets a 503 right away, instead of waiting in the
+        listen backlog. The limits are per process:
+            "httpd": {
+                "workers": 10,
+                "max_queue": 50,
+                "max_in_flight": 8,
+                "max_queue_wait": 1,
+                "retry_after": 5,
+                "shed_load": true
+            }
+
+        The objects of the queries in a view are rendered by the browser (it
+        gets them from /service/query/) or with view_render "server" in the
+        page. A view definition can override it with its "render" key:
+            "httpd": {
+                "view_render": "client"
+            }
+
+        The /service/batch runs at most batch_max sub-requests. With
+        "parallel" they run on a pool of batch_workers threads (0 for none):
+            "httpd": {
+                "batch_max": 50,
+                "batch_workers": 4
+            }
+
+        The json services answer a GET with an ETag, so the client can ask
+        again with If-None-Match and get a 304 Not Modified. The ETag is a
+        hash of the json, so it is right whoever changed the data, but the
+        service still runs: a 304 only saves the transfer. The ETag is weak,
+        as the compressed and the uncompressed json have the same one. A
+        streamed query has no ETag. It is on by default:
+            "httpd": {
+                "etags": true
+            }
+
+        The latency, status codes and size of the responses are recorded per
+        route and per named query (see /service/admin/metrics). That is on
+        by default:
+            "httpd": {
+                "metrics": true
+            }
+
+        With session_file the sessions are stored in that SQLite database,
+        so they survive a restart and are shared by the processes using it:
+            "httpd": {
+                "session_file": "~/.suapp/sessions.sqlite"
+            }
+
+        With processes the server runs in that many worker processes (see
+        PreforkServer). More than one needs a session_file, otherwise the
+        Application refuses to start:
+            "httpd": {
+                "processes": 4,
+                "session_file": "~/.suapp/sessions.sqlite"
+            }
+        Only the sessions are shared. The query cache (with its data
+        versions) and the metrics are per worker process: /service/admin/querycache and
+        /service/admin/metrics show those of the worker that answers.
+
+        The static files are indexed at startup. Files up to
+        static_max_size bytes are kept in memory and the files are checked
+        for changes every static_rescan_interval seconds. With
+        static_precompress the gzip sidecars of the css and js files are
+        (re)generated when indexing:
+            "httpd": {
+                "static_max_size": 262144,
+                "static_rescan_interval": 2,
+                "static_precompress": false
+            }
+        """
+        if httpd_conf.get("keep_alive", False):
+            if not httpd_conf.get("workers"):
+                logging.getLogger(cls.__module__).warning(
+                    "Keep-alive without httpd.workers: an idle connection blocks all others."
+                )
+            cls.protocol_version = "HTTP/1.1"
+            cls.timeout = float(httpd_conf.get("keep_alive_timeout", 15))
+            cls.max_requests = int(httpd_conf.get("keep_alive_max", 100))
+        else:
+            cls.protocol_version = "HTTP/1.0"
+            cls.timeout = None
+            cls.max_requests = None
+        cls.compress = bool(httpd_conf.get("compress", True))
+        cls.compress_level = int(httpd_conf.get("compress_level", 6))
+        cls.compress_min_size = int(httpd_conf.get("compress_min_size", 1024))
+        cls.sessions.timeout = int(httpd_conf.get("session_timeout", 3600))
+        cls.sessions.max_sessions = int(httpd_conf.get("max_sessions", 10000))
+        if cls.sessions.backend is not None:
+            cls.sessions.backend.close()
+            cls.sessions.backend = None
+        if httpd_conf.get("session_file"):
+            cls.sessions.backend = SQLiteSessionBackend(
+                os.path.expanduser(httpd_conf["session_file"])
+            )
+        cls.sessions.rehydrate["jeeves"] = lambda session: LocalWebHandler.jeeves
+        cls.sessions.rehydrate["drone"] = rehydrate_drone
+        cls.metrics.enabled = bool(httpd_conf.get("metrics", True))
+        max_in_flight = int(httpd_conf.get("max_in_flight") or 0)
+        if max_in_flight and max_in_flight >= int(httpd_conf.get("workers") or 1):
+            logging.getLogger(cls.__module__).warning(
+                "httpd.max_in_flight is not below httpd.workers: "
+                "the static files and /health get no priority."
+            )
+        cls.admission = AdmissionControl(
+            max_in_flight,
+            max_queue_wait=httpd_conf.get("max_queue_wait"),
+            retry_after=httpd_conf.get("retry_after"),
+        )
+        cls.stream_queries = bool(httpd_conf.get("stream_queries", False))
+        View.render_mode = str(httpd_conf.get("view_render", "client")).lower()
+        cls.batch_max = int(httpd_conf.get("batch_max", 50))
+        cls.etags = bool(httpd_conf.get("etags", True))
+        if cls.batch_executor is not None:
+            cls.batch_executor.shutdown(wait=False)
+            cls.batch_executor = None
+        if int(httpd_conf.get("batch_workers", 4)):
+            cls.batch_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(httpd_conf.get("batch_workers", 4)),
+                thread_name_prefix="LocalWebBatch",
+            )
+        cls.stream_chunk_size = int(httpd_conf.get("stream_chunk_size", 16384))
+        if httpd_conf.get("template_dir"):
+            cls.html_template_engine.template_directory = TemplateDirectory(
+                os.path.expanduser(httpd_conf["template_dir"]),
+                check_interval=httpd_conf.get("template_check_interval"),
+            )
+        else:
+            cls.html_template_engine.template_directory = None
+        cls.static_files = StaticFileCache(
+            os.path.dirname(__file__),
+            max_size=httpd_conf.get("static_max_size"),
+            rescan_interval=httpd_conf.get("static_rescan_interval"),
+            precompress=httpd_conf.get("static_precompress", False),
+        )
+        cls.static_files.scan()
+
+    def handle(self):
+        """
+        Handles the requests on the connection.
+
+        Between two keep-alive requests it waits for the next one (see
+        wait_for_request).
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    # No @loguse as this is called for every keep-alive request.
+    def connections_waiting(self):
+        """
+        Returns True if there are connections waiting for a worker.
+        """
+        queued = getattr(self.server, "queued", None)
+        return queued is not None and queued() > 0
+
+    # No @loguse as this is called for every keep-alive request.
+    def wait_for_request(self):
+        """
+        Returns True when the next request arrives on an idle connection.
+
+        An idle connection holds its worker, so it only waits in slices of
+        keep_alive_poll seconds: it gives up (returns False) as soon as
+        another connection waits for a worker or after the keep-alive
+        timeout.
+        """
+        if not self.timeout or getattr(self.server, "queued", None) is None:
+            # The socket timeout limits waiting for the request line.
+            return True
+        # A pipelined request can already be in the buffer.
+        self.connection.settimeout(0)
+        try:
+            buffered = self.rfile.peek(1)
+        except OSError:
+            buffered = b""
+        finally:
+            self.connection.settimeout(self.timeout)
+        if buffered:
+            return True
+        if isinstance(self.connection, ssl.SSLSocket) and self.connection.pending():
+            return True
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self.connections_waiting():
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            (readable, _, _) = select.select(
+                [self.connection], [], [], min(self.keep_alive_poll, remaining)
+            )
+            if readable:
+                return True
+
+    def handle_one_request(self):
+        """
+        Handles one request on the connection while counting them.
+
+        It also records the metrics of the request.
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        self.request_count = getattr(self, "request_count", 0) + 1
+        self.current_route = None
+        self.current_query = None
+        self.response_code = None
+        self.response_size = 0
+        self.etag = None
+        start = time.perf_counter()
+        super().handle_one_request()
+        if self.response_code is not None:
+            seconds = time.perf_counter() - start
+            if self.current_route is not None:
+                path = self.current_route.path
+            else:
+                # E.g. a malformed request line or an unknown path.
+                path = "unmatched"
+            self.metrics.observe(
+                "route", path, self.response_code, seconds, self.response_size
+            )
+            if self.current_query is not None:
+                self.metrics.observe(
+                    "query",
+                    self.current_query,
+                    self.response_code,
+                    seconds,
+                    self.response_size,
+                )
+
+    def send_response(self, code, message=None):
+        """
+        Sends the response line while keeping the code for the metrics.
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        self.response_code = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        """
+        Sends a header while keeping the Content-Length for the metrics.
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        if keyword == "Content-Length":
+            self.response_size = int(value)
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        """
+        Closes the connection when it reached the maximum number of requests
+        or when other connections are waiting for a worker.
+
+        Overridden from http.server.BaseHTTPRequestHandler.
+        """
+        if self.request_version != "HTTP/0.9" and self.protocol_version >= "HTTP/1.1":
+            if (
+                self.close_connection
+                or (
+                    self.max_requests
+                    and getattr(self, "request_count", 0) >= self.max_requests
+                )
+                or self.connections_waiting()
+            ):
+                self.send_header("Connection", "close")
+            elif self.timeout:
+                self.send_header(
+                    "Keep-Alive",
+                    "timeout=%d, max=%d" % (self.timeout, self.max_requests),
+                )
+        super().end_headers()
+
+    def send_last_modified_header(self, timestamp=None):
         """
         Sets the Last-Modified header.
+
+        By default it is the current time.
         """
-        timestamp = time.time()
+        if timestamp is None:
+            timestamp = time.time()
         year, month, day, hh, mm, ss, wd, y, z = time.gmtime(timestamp)
         s = "%s, %02d %3s %4d %02d:%02d:%02d GMT" % (
             self.weekdayname[wd],
@@ -461,11 +1463,23 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             self.html_template_engine = LocalWebHandler.html_template_engine
         return self.html_template_engine.html(session, title, body, **kwargs)
 
+    @loguse([2, "@"])  # Not logging the values nor the return value.
+    def fragment(self, names, values):
+        """
+        Returns the first template file of names with the values or None.
+
+        See HtmlTemplatingEngine.fragment.
+        """
+        if not self.html_template_engine:
+            self.html_template_engine = LocalWebHandler.html_template_engine
+        return self.html_template_engine.fragment(names, values)
+
     @loguse
     def cookies(self):
         """
         Gets the cookie information.
         """
+        self.current_session = None
         self.cookie = http.cookies.SimpleCookie()
         if "Cookie" in self.headers:
             # Not sure why I need .split(";",1)[0], but otherwise it takes the last on on the line.
@@ -483,7 +1497,8 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         If the client has sent a cookie named sessionId, that is used.
         It returns the corresponding session object from the session store.
         If there is no sessionId or it can't find it in the session store it
-        will create a new session and set it as a cookie.
+        will create a new session. That is only added to the store (and set
+        as a cookie) when something is written to it, see save_session().
         """
         self.expired_cookie = None
         session = None
@@ -499,17 +1514,34 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 session = None
         # There was no session or the session expired. Create a new one.
         if not session:
-            session = LocalWebHandler.sessions.new(jeeves=LocalWebHandler.jeeves)
-            self.cookie["sessionId"] = session.id
+            session = LocalWebHandler.sessions.create(jeeves=LocalWebHandler.jeeves)
         self.session_id = session.id
+        self.current_session = session
         return session
 
+    # No @loguse as this is called for every request.
+    def save_session(self, session):
+        """
+        Stores the changes of the session.
+
+        A new session is only stored (and set as cookie) if something was
+        written to it.
+        """
+        if session.stored:
+            LocalWebHandler.sessions.save(session)
+        elif session.written:
+            LocalWebHandler.sessions.store(session)
+            self.cookie["sessionId"] = session.id
+
     @loguse
     def callback_drone(self, drone):
         """
         Callback function that gets called from the drone.
         """
-        self.session()["drone"] = drone
+        session = getattr(self, "current_session", None)
+        if session is None:
+            session = self.session()
+        session["drone"] = drone
 
     @loguse(
         [1, "json_object", "payload"]
@@ -624,10 +1656,12 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         )
 
     @loguse(1)  # Not logging session.
-    def authorized(self, session, fields):
+    def authorized(self, session, fields, path=None):
         """
         Returns a number indicating the permissions.
 
+        The permissions are for the path, the path of the request by default.
+
         TODO: group based authorization: now it's just Y/N an everything.
         Using UNIX filesystem permission rwx
              4: read
@@ -640,10 +1674,12 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             user_id = session["userid"]
         except:
             pass
-        if self.path.startswith("/service/public/"):
+        if path is None:
+            path = self.path
+        if path.startswith("/service/public/"):
             return 6
         # Not a logged in user, let's see if we can log you in.
-        if not user_id:
+        if not user_id and ("username" in fields or "Authorization" in self.headers):
             (result_code, result_type, result_message) = self.do_service_public_logon(
                 session, fields
             )
@@ -669,7 +1705,7 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             if user_id in groups["administrators"]:
                 # Admin has all rights.
                 return 7
-            elif self.path.startswith("/service/admin/"):
+            elif path.startswith("/service/admin/"):
                 return 0
             else:
                 return 4
@@ -684,9 +1720,60 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         return (
             200,
             "text/json; charset=utf-8",
-            {"result": True, "sessions": LocalWebHandler.sessions},
+            {
+                "result": True,
+                "sessions": LocalWebHandler.sessions,
+                "stats": LocalWebHandler.sessions.stats(),
+            },
         )
 
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_admin_metrics(self, session, fields, json_object):
+        """
+        Returns the request metrics per route and per named query.
+
+        The json also has the counters of the admission control.
+
+        With the "format" GET/POST variable "prometheus" (or an Accept header
+        asking for text/plain or openmetrics) it is in the Prometheus text
+        format. The "reset" GET/POST variable clears the metrics afterwards.
+        """
+        fmt = fields.get("format", [""])[-1]
+        accept = self.headers.get("Accept", "")
+        if fmt == "prometheus" or (
+            not fmt and ("text/plain" in accept or "openmetrics" in accept)
+        ):
+            result = (
+                200,
+                "text/plain; version=0.0.4; charset=utf-8",
+                self.metrics.to_prometheus(),
+            )
+        else:
+            result = (
+                200,
+                json_mime,
+                {
+                    "result": True,
+                    "metrics": self.metrics.snapshot(),
+                    "admission": self.admission.stats(),
+                },
+            )
+        if "reset" in fields:
+            self.metrics.reset()
+        return result
+
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_admin_querycache(self, session, fields, json_object):
+        """
+        Returns the size and hit/miss counters of the query cache.
+
+        With the "clear" GET/POST variable the cache is emptied first.
+        """
+        query_cache = session["jeeves"].query_cache
+        if "clear" in fields:
+            query_cache.clear()
+        return (200, json_mime, {"result": True, "querycache": query_cache.stats()})
+
     @loguse([1, 3])  # Not logging session and json_object.
     def do_service_who(self, session, fields, json_object):
         """
@@ -738,6 +1825,7 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             # Unknown session id:
             return (200, "text/json; charset=utf-8", {})
 
+    @route("/service/fetch")
     @loguse([1, 3])  # Not logging session and json_object.
     def do_service_fetch(self, session, fields, json_object):
         """
@@ -760,20 +1848,81 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 },
             )
 
+    @route("/service/fetchmany")
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_fetchmany(self, session, fields, json_object):
+        """
+        Fetching several objects by TableName[PrimaryKey] with one query.
+
+        Every key GET/POST variable is a primary key. A multi variable
+        primary key is only possible with a json body:
+            {"module": "modlib.kinship", "table": "Kinship", "keys": [[5, 6]]}
+        The objects are in the order of the keys (null if not found).
+        """
+        try:
+            if isinstance(json_object, dict):
+                (module, table, keys) = (
+                    json_object["module"],
+                    json_object["table"],
+                    json_object["keys"],
+                )
+            else:
+                (module, table, keys) = (
+                    fields["module"][0],
+                    fields["table"][0],
+                    fields.get("key", []),
+                )
+            results = session["jeeves"].do_fetch_many(module, table, keys)
+            return (
+                200,
+                "text/json; charset=utf-8",
+                {"result": True, "objects": results, "module": module, "table": table},
+            )
+        except Exception as e:
+            return (
+                200,
+                "text/json; charset=utf-8",
+                {
+                    "result": False,
+                    "message": "Objects not found (%s: %s)" % (type(e), e),
+                    "traceback": traceback.format_exc().split("\n"),
+                },
+            )
+
+    @route("/service/setfetch")
     @loguse([1, 3])  # Not logging session and json_object.
     def do_service_setfetch(self, session, fields, json_object):
         """
         Fetching a foreign key set by TableName[PrimaryKey].Link
+
+        With the pagesize GET/POST variable only the page pagenum (default 1)
+        is fetched and the total number of rows in the set is returned as
+        total (also with the count GET/POST variable). The order_by is passed
+        to do_fetch_set.
         """
         try:
+            jeeves = session["jeeves"]
+            (module, table, key, link) = (
+                fields["module"][0],
+                fields["table"][0],
+                fields["key"],
+                fields["link"][0],
+            )
+            pagesize = fields.get("pagesize", [None])[0]
             results = list(
-                session["jeeves"].do_fetch_set(
-                    fields["module"][0],
-                    fields["table"][0],
-                    fields["key"],
-                    fields["link"][0],
+                jeeves.do_fetch_set(
+                    module,
+                    table,
+                    key,
+                    link,
+                    pagenum=fields.get("pagenum", [None])[0],
+                    pagesize=pagesize,
+                    order_by=fields.get("order_by", [None])[0],
                 )
             )
+            total = None
+            if pagesize is not None or "count" in fields:
+                total = jeeves.do_count_set(module, table, key, link)
             table_type = None
             module = None
             try:
@@ -781,16 +1930,15 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 table_type = results[0].__class__.__name__
             except:
                 pass
-            return (
-                200,
-                "text/json; charset=utf-8",
-                {
-                    "result": True,
-                    "objects": results,
-                    "module": module,
-                    "table": table_type,
-                },
-            )
+            answer = {
+                "result": True,
+                "objects": results,
+                "module": module,
+                "table": table_type,
+            }
+            if total is not None:
+                answer["total"] = total
+            return (200, "text/json; charset=utf-8", answer)
         except Exception as e:
             return (
                 200,
@@ -802,16 +1950,180 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 },
             )
 
+    @route("/service/batch", json=False)
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_batch(self, session, fields, json_object):
+        """
+        Runs several services in one request.
+
+        The sub-requests are a json array as body of a POST (or in the
+        "requests" GET/POST variable). The service is the path after
+        /service/, the params are its GET/POST variables and json its
+        json_object:
+            [
+                {"id": "items", "service": "query/items", "params": {"pagesize": 5}},
+                {"id": "who", "service": "who"}
+            ]
+        It can also be {"requests": [...], "parallel": true}. The answer has
+        the status and body of every sub-request by id (by index without):
+            {"result": true, "responses": {"items": {"status": 200, "body": ...}}}
+
+        The sub-requests run one after the other in one db_session. With
+        "parallel" they run on the batch worker pool (see configure), each
+        in its own db_session and with its own fork of the session (see
+        Session.fork). Their changes to the session are merged in the order
+        of the requests.
+        """
+        requests = json_object
+        parallel = "parallel" in fields
+        if requests is None and "requests" in fields:
+            try:
+                requests = json.loads(fields["requests"][-1])
+            except ValueError:
+                requests = None
+        if isinstance(requests, dict):
+            parallel = parallel or bool(requests.get("parallel"))
+            requests = requests.get("requests")
+        if not isinstance(requests, list) or not all(
+            isinstance(request, dict) for request in requests
+        ):
+            message = "Expected a json array of requests."
+        elif len(requests) > self.batch_max:
+            message = "At most %s requests in a batch." % (self.batch_max)
+        else:
+            message = None
+        if message is not None:
+            return (
+                400,
+                json_mime,
+                simple_json.dumps({"result": False, "message": message}),
+            )
+        if parallel and self.batch_executor is not None and len(requests) > 1:
+            # Every sub-request gets its own copy of the handler (for the
+            # request state) and a fork of the session.
+            forks = []
+            futures = []
+            for request in requests:
+                fork = session.fork()
+                handler = copy.copy(self)
+                handler.current_session = fork
+                forks.append(fork)
+                futures.append(
+                    self.batch_executor.submit(
+                        handler.batch_call, fork, request, fields, True
+                    )
+                )
+            results = [future.result() for future in futures]
+            for fork in forks:
+                session.merge(fork)
+        else:
+            with pony.orm.db_session:
+                results = [
+                    self.batch_call(session, request, fields) for request in requests
+                ]
+        responses = []
+        for index, (request, (code, body)) in enumerate(zip(requests, results)):
+            responses.append(
+                '%s: {"status": %d, "body": %s}'
+                % (json.dumps(str(request.get("id", index))), code, body)
+            )
+        return (
+            200,
+            json_mime,
+            '{"result": true, "responses": {%s}}' % (", ".join(responses)),
+        )
+
+    @loguse([1, 2, "@"])  # Not logging session, request nor the return value.
+    def batch_call(self, session, request, fields, own_session=False):
+        """
+        Returns the status and json body of a sub-request of a batch.
+
+        With own_session it runs in its own db_session.
+        """
+        if own_session:
+            with pony.orm.db_session:
+                return self.batch_call(session, request, fields)
+        (path, _, query) = str(request.get("service", "")).partition("?")
+        path = "/service/" + path.lstrip("/")
+        sub_fields = urllib.parse.parse_qs(query, keep_blank_values=True)
+        for key, value in (request.get("params") or {}).items():
+            if not isinstance(value, list):
+                value = [value]
+            sub_fields[key] = ["%s" % (v) for v in value]
+        (route, rest) = self.routes.find(path)
+        auth_level = self.authorized(session, sub_fields, path)
+        if route is None or route.static or not route.session:
+            (code, message) = (404, "Not Found")
+        elif route.handler == "do_service_batch":
+            (code, message) = (400, "No batch in a batch.")
+        elif auth_level is None:
+            (code, message) = (401, "Unauthorized")
+        elif auth_level & route.auth != route.auth:
+            (code, message) = (403, "Forbidden")
+        else:
+            try:
+                (code, mime, message) = route.call(
+                    self, session, rest, sub_fields, request.get("json")
+                )
+            except Exception as e:
+                return (
+                    500,
+                    self.to_json(
+                        {
+                            "result": False,
+                            "message": "Error in %s (%s: %s)" % (path, type(e), e),
+                            "traceback": traceback.format_exc().split("\n"),
+                        },
+                        sub_fields,
+                    ),
+                )
+            if isinstance(message, types.GeneratorType):
+                # A streamed query result: the pieces are json.
+                return (code, "".join(message))
+            if route.json and mime == json_mime:
+                return (code, self.to_json(message, sub_fields))
+            return (code, simple_json.dumps(message))
+        return (code, simple_json.dumps({"result": False, "message": message}))
+
+    # No @loguse as this is for load balancers and monitoring.
+    @route("/health", auth=0, session=False)
+    def do_health(self, session, fields, json_object):
+        """
+        Tells the server is up, without session (see do_sessionless).
+        """
+        return (200, json_mime, {"result": True, "status": "ok"})
+
+    @route("/service/query/")
     @loguse([1, 3])  # Not logging seesion and json_ojbect.
     def do_service_query(self, session, query, fields, json_object):
         """
         Executing a query.
+
+        When streaming (see configure) the rows are only fetched and
+        serialized while sending the response. With the "fields" GET/POST
+        variable only those attributes of the objects are serialized (see
+        field_projection). The query gets it in its params too, so it can
+        leave out what isn't needed.
+
+        The metrics of an unknown query are recorded as "unknown", so any
+        path doesn't add its own metrics.
         """
+        if query in session["jeeves"].queries:
+            self.current_query = query
+        else:
+            self.current_query = "unknown"
         try:
             params = {}
             for param in fields:
                 params[param] = fields[param][0]
-            results = list(session["jeeves"].do_query(query, params=params))
+            results = session["jeeves"].do_query(query, params=params)
+            if self.stream_queries or "stream" in fields:
+                return (
+                    200,
+                    json_mime,
+                    json_stream_query(results, field_projection(fields)),
+                )
+            results = list(results)
             table_type = None
             module = None
             try:
@@ -840,6 +2152,40 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 },
             )
 
+    @route("/service/session/")
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_session(self, session, path, fields, json_object):
+        """
+        Getting something from the session.
+
+        See do_object for the path.
+        """
+        return self.do_object(session, path)
+
+    @route("/service/")
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_service_not_found(self, session, path, fields, json_object):
+        """
+        There is no service for the path.
+        """
+        method_name = "do_service_" + "_".join(path.split("/"))
+        return (
+            404,
+            json_mime,
+            {
+                "result": False,
+                "message": "Service %s not found." % (method_name.lower()),
+            },
+        )
+
+    @route("/", mime="text/html; charset=utf-8", json=False)
+    @loguse([1, 3])  # Not logging session and json_object.
+    def do_page(self, session, path, fields, json_object):
+        """
+        All that is not a service is a dynamic page.
+        """
+        return self.do_dynamic_page(session, fields)
+
     @loguse  # ('@')
     def do_object(self, start_object, path):
         """
@@ -1074,17 +2420,11 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         # The imporant stuff is the OUT message.
         return (return_code, return_mime, return_message)
 
-    @loguse(3)  # Not logging return_message.
-    def _do(self, return_code, return_mime, return_message):
+    # No @loguse as this is called for every response.
+    def send_cookie_headers(self):
         """
-        It will create and send the http output.
-
-        It does this, including headers, based on the  return_code, return_mime
-        and return_message.
+        Sends the Set-Cookie headers (including the expired session cookie).
         """
-        self.send_response(return_code)
-        self.send_header("Content-type", return_mime)
-        self.send_last_modified_header()
         if self.expired_cookie:
             self.send_header(
                 "Set-Cookie",
@@ -1096,8 +2436,141 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             self.send_header(
                 "Set-Cookie", morsel.output(header="").lstrip() + "; Path=/"
             )
+
+    # No @loguse as this is called for every response.
+    def send_etag_headers(self, return_code):
+        """
+        Sets the ETag header (if any) of a 200 response.
+
+        The response can be cached, but only after asking if it changed.
+        """
+        etag = getattr(self, "etag", None)
+        if etag is not None and return_code == 200:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+
+    @loguse
+    def do_not_modified(self):
+        """
+        Replies with a 304 as the client's copy (with self.etag) is current.
+
+        It varies like the 200 it replaces (see _do).
+        """
+        self.send_response(304)
+        self.send_etag_headers(200)
+        if self.compress:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_cookie_headers()
+        self.end_headers()
+
+    # No @loguse as this is called for every json service.
+    def if_none_match(self, etag):
+        """
+        Returns True if the If-None-Match header of the request has the etag.
+
+        The comparison is weak: W/"x" matches "x".
+        """
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+
+        def opaque(etag):
+            return etag[2:] if etag.startswith("W/") else etag
+
+        etags = [opaque(e.strip()) for e in header.split(",")]
+        return "*" in etags or opaque(etag) in etags
+
+    @loguse(3)  # Not logging return_message.
+    def _do(self, return_code, return_mime, return_message):
+        """
+        It will create and send the http output.
+
+        It does this, including headers, based on the  return_code, return_mime
+        and return_message. A generator as return_message is streamed (see
+        _do_stream).
+        """
+        if isinstance(return_message, types.GeneratorType):
+            return self._do_stream(return_code, return_mime, return_message)
+        self.send_response(return_code)
+        self.send_header("Content-type", return_mime)
+        self.send_last_modified_header()
+        self.send_etag_headers(return_code)
+        self.send_cookie_headers()
+        body = return_message.encode("utf-8")
+        if self.compress and any(return_mime.startswith(m) for m in compressible_mimes):
+            self.send_header("Vary", "Accept-Encoding")
+            if len(body) >= self.compress_min_size:
+                encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+                if encoding:
+                    body = compress(body, encoding, self.compress_level)
+                    self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @loguse(3)  # Not logging return_message.
+    def _do_stream(self, return_code, return_mime, return_message):
+        """
+        Sends the pieces (str) of the generator return_message.
+
+        The pieces are collected until there are stream_chunk_size bytes,
+        which are then (compressed and) sent as one chunk. On HTTP/1.0 there
+        is no chunked transfer encoding, so the end of the response is the
+        end of the connection.
+        """
+        self.send_response(return_code)
+        self.send_header("Content-type", return_mime)
+        self.send_last_modified_header()
+        self.send_etag_headers(return_code)
+        self.send_cookie_headers()
+        compressor = None
+        if self.compress and any(return_mime.startswith(m) for m in compressible_mimes):
+            self.send_header("Vary", "Accept-Encoding")
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+            if encoding:
+                compressor = zlib.compressobj(
+                    self.compress_level, zlib.DEFLATED, content_codings[encoding]
+                )
+                self.send_header("Content-Encoding", encoding)
+        chunked = (
+            self.protocol_version >= "HTTP/1.1" and self.request_version >= "HTTP/1.1"
+        )
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
         self.end_headers()
-        self.wfile.write(return_message.encode("utf-8"))
+
+        def write(data):
+            if compressor is not None:
+                data = compressor.compress(data)
+            if not data:
+                # An empty chunk would end the response.
+                return
+            self.response_size += len(data)
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        pieces = []
+        size = 0
+        self.response_size = 0
+        for piece in return_message:
+            piece = piece.encode("utf-8")
+            pieces.append(piece)
+            size += len(piece)
+            if size >= self.stream_chunk_size:
+                write(b"".join(pieces))
+                pieces = []
+                size = 0
+        write(b"".join(pieces))
+        if compressor is not None:
+            data = compressor.flush()
+            compressor = None
+            write(data)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
 
     @loguse([1, 4])  # Not logging session nor return_message.
     def do_error_page(self, session, return_code, return_mime, return_message):
@@ -1108,21 +2581,29 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         if return_mime.startswith("text/plain"):
             # template
             try:
-                body = ""
+                body = self.fragment(
+                    ["error-%s.html" % (return_code), "error.html"],
+                    {
+                        "code": "%s" % (return_code),
+                        "message": escape("%s" % (return_message)),
+                    },
+                )
                 if return_code == 401:
                     # We don't want to return a 401 as that will trigger the browser to get Authorization credentials.
                     # Instead we want to show a link to the login page.
                     return_code = 403
-                    body = (
+                    default = (
                         '<p>Go to the login page <a href="/public/logon">here</a>.</p>'
                     )
                 elif return_code == 403:
-                    body = "<p>Sorry, you don't have access to this.</p>"
+                    default = "<p>Sorry, you don't have access to this.</p>"
                 else:
-                    body = "<p>Oops, something went wrong.</p>"
+                    default = "<p>Oops, something went wrong.</p>"
+                if body is None:
+                    body = default
                 message = self.html(
                     session,
-                    "%s: %s" % (return_code, return_message),
+                    escape("%s: %s" % (return_code, return_message)),
                     body,
                     menu={},
                     prefix="        ",
@@ -1150,163 +2631,155 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         If json is found in the body this is decoded and can be found in
         json_object. Otherwise the body of the request is in payload.
 
-        If the request path looks like "/service/*" it looks for the
-        self.do_service_*() method to handle it for it. If that doesn't exist it
-        returns with a 404. For a service that returns json, you can add the
-        "pretty" GET/POST variable to return a nicely formatted answer instead
-        of the default one line short json.
+        The request path is looked up in the route table (see routes). For
+        "/service/*" that is a self.do_service_*() method or a service
+        registered by a modlib module. If that doesn't exist it returns with a
+        404. For a service that returns json, you can add the "pretty" GET/POST
+        variable to return a nicely formatted answer instead of the default
+        one line short json.
 
         If it isn't a service it passes handling the request to
         do_dynamic_page().
+
+        It is only handled when admitted by the admission control, else it
+        gets a 503 (see do_overloaded).
         """
-        self.cookies()
-        session = self.session()
-        return_code = 200
-        return_mime = "text/html; charset=utf-8"
-        return_message = ""
-        # Check authorization
-        auth_level = self.authorized(session, fields)
-        if self.path.startswith("/public/"):
-            auth_level = 7
-        if auth_level is not None:
-            if auth_level & 4:
-                if self.path.startswith("/service/session/"):
-                    # Getting something from the session.
-                    path_part = self.path[17:]
-                    try:
-                        (path_part, variables) = self.path[17:].rsplit("?", 1)
-                    except:
-                        pass
-                    (return_code, return_mime, return_message) = self.do_object(
-                        session, path_part
+        (route, rest) = self.routes.find(self.path.split("?", 1)[0])
+        self.current_route = route
+        if not self.admission.admit():
+            self.do_overloaded()
+            return
+        try:
+            self.cookies()
+            session = self.session()
+            return_code = 200
+            return_mime = "text/html; charset=utf-8"
+            return_message = ""
+            # Check authorization
+            auth_level = self.authorized(session, fields)
+            if self.path.startswith("/public/"):
+                auth_level = 7
+            if route is None:
+                (return_code, return_mime, return_message) = (
+                    404,
+                    "text/plain; charset=utf-8",
+                    "Not Found",
+                )
+            elif auth_level is not None:
+                if auth_level & route.auth == route.auth:
+                    (return_code, return_mime, return_message) = route.call(
+                        self, session, rest, fields, json_object
                     )
-                    # The output should be json, so transforming it to json:
-                    try:
-                        if "pretty" in fields:
-                            return_message = simple_json.dumps(
-                                return_message,
-                                sort_keys=True,
-                                indent=4,
-                                separators=(",", ": "),
-                            )
-                        else:
-                            return_message = simple_json.dumps(return_message)
-                    except Exception as e:
-                        if "pretty" in fields:
-                            return_message = simple_json.dumps(
-                                {
-                                    "result": False,
-                                    "message": "Object not convertible to json (%s: %s)."
-                                    % (type(e), e),
-                                    "traceback": traceback.format_exc().split("\n"),
-                                },
-                                sort_keys=True,
-                                indent=4,
-                                separators=(",", ": "),
-                            )
-                        else:
-                            return_message = simple_json.dumps(
-                                {
-                                    "result": False,
-                                    "message": "Object not convertible to json (%s: %s)."
-                                    % (type(e), e),
-                                    "traceback": traceback.format_exc().split("\n"),
-                                }
+                    if (
+                        route.json
+                        and return_mime == json_mime
+                        and not isinstance(return_message, types.GeneratorType)
+                    ):
+                        return_message = self.to_json(return_message, fields)
+                        if self.etags and self.command == "GET" and return_code == 200:
+                            self.etag = 'W/"%s"' % (
+                                hashlib.sha1(return_message.encode("utf-8")).hexdigest()
                             )
-                elif self.path.startswith("/service/query/"):
-                    temp = self.path.split("?")
-                    (return_code, return_mime, return_message) = self.do_service_query(
-                        session, temp[0][15:], fields, json_object
-                    )
-                    if "pretty" in fields:
-                        return_message = simple_json.dumps(
-                            return_message,
-                            sort_keys=True,
-                            indent=4,
-                            separators=(",", ": "),
-                        )
-                    else:
-                        return_message = simple_json.dumps(return_message)
-                elif self.path.startswith("/service/"):
-                    # Looking up if we have a do_service_{} method.
-                    temp = self.path.split("?")
-                    method_name = "do" + "_".join(temp[0].split("/"))
-                    try:
-                        (return_code, return_mime, return_message) = getattr(
-                            self, method_name.lower()
-                        )(session, fields, json_object)
-                    except AttributeError:
-                        # Not found
-                        return_code = 404
-                        return_mime = "text/json; charset=utf-8"
-                        return_message = {
-                            "result": False,
-                            "message": "Service %s not found." % (method_name.lower()),
-                        }
-                    if return_mime == "text/json; charset=utf-8":
-                        try:
-                            # The output should be json, so transforming it to json:
-                            if "pretty" in fields:
-                                return_message = simple_json.dumps(
-                                    return_message,
-                                    sort_keys=True,
-                                    indent=4,
-                                    separators=(",", ": "),
-                                )
-                            else:
-                                return_message = simple_json.dumps(return_message)
-                        except Exception as e:
-                            if "pretty" in fields:
-                                return_message = simple_json.dumps(
-                                    {
-                                        "result": False,
-                                        "message": "Object not convertible to json (%s: %s)."
-                                        % (type(e), e),
-                                        "traceback": traceback.format_exc().split("\n"),
-                                    },
-                                    sort_keys=True,
-                                    indent=4,
-                                    separators=(",", ": "),
-                                )
-                            else:
-                                return_message = simple_json.dumps(
-                                    {
-                                        "result": False,
-                                        "message": "Object not convertible to json (%s: %s)."
-                                        % (type(e), e),
-                                        "traceback": traceback.format_exc().split("\n"),
-                                    }
-                                )
+                            if self.if_none_match(self.etag):
+                                self.save_session(session)
+                                self.do_not_modified()
+                                return
                 else:
-                    (return_code, return_mime, return_message) = self.do_dynamic_page(
-                        session, fields
+                    (return_code, return_mime, return_message) = (
+                        403,
+                        "text/plain; charset=utf-8",
+                        "Forbidden",
                     )
             else:
                 (return_code, return_mime, return_message) = (
-                    403,
+                    401,
                     "text/plain; charset=utf-8",
-                    "Forbidden",
+                    "Unauthorized",
                 )
-        else:
-            (return_code, return_mime, return_message) = (
-                401,
-                "text/plain; charset=utf-8",
-                "Unauthorized",
+            # Storing the changes before answering, another process could get
+            # the next request.
+            self.save_session(session)
+            # And make a http response from it all.
+            self.do(session, return_code, return_mime, return_message)
+        finally:
+            self.admission.release()
+
+    # No @loguse as this has to be cheap when overloaded.
+    def do_overloaded(self):
+        """
+        Replies with a 503 as the request was not admitted (see admission).
+        """
+        body = b"Service Unavailable"
+        self.send_response(503)
+        self.send_header("Content-type", "text/plain; charset=utf-8")
+        self.send_header("Retry-After", str(self.admission.retry_after))
+        self.send_header("Content-Length", str(len(body)))
+        self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    # No @loguse as this is for the requests that should cost next to nothing.
+    def do_sessionless(self, route, rest, fields):
+        """
+        Replies to a request for a route without session (e.g. /health).
+
+        There are no cookies, session nor authorization.
+        """
+        self.cookie = http.cookies.SimpleCookie()
+        self.expired_cookie = None
+        (return_code, return_mime, return_message) = route.call(
+            self, None, rest, fields, None
+        )
+        if route.json and return_mime == json_mime:
+            return_message = self.to_json(return_message, fields)
+        self._do(return_code, return_mime, return_message)
+
+    @loguse([1, "@"])  # Not logging the message nor the return value.
+    def to_json(self, return_message, fields):
+        """
+        Returns the message as json.
+
+        With the "pretty" GET/POST variable it is nicely formatted. With the
+        "fields" GET/POST variable only those attributes of the objects are
+        in it (see field_projection).
+        """
+        kwargs = {}
+        if "pretty" in fields:
+            kwargs = {"sort_keys": True, "indent": 4, "separators": (",", ": ")}
+        try:
+            return simple_json.dumps(
+                return_message, fields=field_projection(fields), **kwargs
+            )
+        except Exception as e:
+            return simple_json.dumps(
+                {
+                    "result": False,
+                    "message": "Object not convertible to json (%s: %s)."
+                    % (type(e), e),
+                    "traceback": traceback.format_exc().split("\n"),
+                },
+                **kwargs
             )
-        # And make a http response from it all.
-        self.do(session, return_code, return_mime, return_message)
 
     @loguse
-    def do_static(self, fields, mimetype):
+    def do_static(self, fields, mimetype, public=False):
         """
         Serve the request from the file system.
+
+        A public file is served without looking at cookies, session or
+        authorization.
         """
-        # Get the cookies.
-        self.cookies()
-        # Initialize the session.
-        session = self.session()
-        # Check authorization
-        auth_level = self.authorized(session, fields)
+        session = None
+        if public:
+            auth_level = 4
+        else:
+            # Get the cookies.
+            self.cookies()
+            # Initialize the session.
+            session = self.session()
+            # Check authorization
+            auth_level = self.authorized(session, fields)
+            self.save_session(session)
         # Some mime types are always accessable: css, js
         if self.path.startswith("/public/"):
             auth_level = 7
@@ -1316,32 +2789,55 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             auth_level = 4
         if auth_level is not None:
             if auth_level & 4:
-                # Save on work by sending a "304 Not Modified"
-                # If the request has a "If-Modified-Since" header.
-                if "If-Modified-Since" in self.headers:
-                    last_modified = self.headers["If-Modified-Since"]
-                    self.send_response(304)
-                    self.send_header("Last-Modified", last_modified)
-                    self.end_headers()
-                    # And we're done, no body to send.
-                    return
+                url = urllib.parse.unquote(self.path.split("?", 1)[0])
+                static_file = self.static_files.get(url)
                 try:
-                    localfile = os.path.join(os.path.dirname(__file__), self.path[1:])
-                    with open(localfile, "rb") as f:
-                        self.send_response(200)
-                        self.send_header("Content-type", mimetype)
-                        self.send_last_modified_header()
+                    if static_file is None:
+                        logging.getLogger(self.__module__).info(
+                            "Request file not found: %s" % (url)
+                        )
+                        message = "File %s not found." % (url)
+                        body = message.encode("utf-8")
+                        self.send_response(404)
+                        self.send_header("Content-type", "text/plain; charset=utf-8")
+                        self.send_header("Content-Length", str(len(body)))
                         self.end_headers()
-                        self.wfile.write(f.read())
-                except FileNotFoundError:
-                    logging.getLogger(self.__module__).info(
-                        "Request file not found: %s" % (localfile)
-                    )
-                    self.send_response(404)
-                    self.send_header("Content-type", "text/plain; charset=utf-8")
-                    self.end_headers()
-                    message = "File %s not found.\n%s" % (self.path, localfile)
-                    self.wfile.write(message.encode("utf-8"))
+                        self.wfile.write(body)
+                    else:
+                        # Use the gzip sidecar if the client accepts it.
+                        representation = static_file
+                        if static_file.gzip is not None:
+                            if negotiate_encoding(
+                                self.headers.get("Accept-Encoding"), ["gzip"]
+                            ):
+                                representation = static_file.gzip
+                        not_modified = representation.not_modified(
+                            self.headers.get("If-None-Match"),
+                            self.headers.get("If-Modified-Since"),
+                        )
+                        if not_modified:
+                            # Save on work by sending a "304 Not Modified".
+                            self.send_response(304)
+                        else:
+                            self.send_response(200)
+                            self.send_header("Content-type", mimetype)
+                            self.send_header("Content-Length", str(representation.size))
+                            if representation is not static_file:
+                                self.send_header("Content-Encoding", "gzip")
+                        if static_file.gzip is not None:
+                            self.send_header("Vary", "Accept-Encoding")
+                        self.send_header("ETag", representation.etag)
+                        self.send_last_modified_header(static_file.mtime)
+                        if session is not None:
+                            self.send_cookie_headers()
+                        self.end_headers()
+                        if not_modified:
+                            # And we're done, no body to send.
+                            pass
+                        elif representation.content is not None:
+                            self.wfile.write(representation.content)
+                        else:
+                            self.send_file(representation)
                 except BrokenPipeError as err:
                     logging.getLogger(self.__module__).info("Broken pipe: %s" % (err))
                     pass
@@ -1353,6 +2849,21 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
             # 403: Not authorized
             self.do(session, 403, "text/plain; charset=utf-8", "Not logged in.")
 
+    @loguse
+    def send_file(self, static_file):
+        """
+        Sends a large file from disk.
+
+        On a socket this uses socket.sendfile (i.e. os.sendfile), so the
+        content doesn't pass through Python. Otherwise it is copied.
+        """
+        with open(static_file.path, "rb") as fh:
+            connection = getattr(self, "connection", None)
+            if connection is not None and not isinstance(connection, ssl.SSLSocket):
+                connection.sendfile(fh, count=static_file.size)
+            else:
+                shutil.copyfileobj(fh, self.wfile)
+
     @loguse
     def do_POST(self):
         """
@@ -1373,6 +2884,14 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         #     application/x-www-form-urlencoded # parameters
         #     text/json                         # json
         #     multipart/form-data               # upload
+        if "json" in self.headers.get("Content-Type", ""):
+            try:
+                json_object = json.loads(field_data)
+            except ValueError:
+                json_object = None
+            if json_object is not None:
+                self.do_dynamic(fields, json_object=json_object)
+                return
 
         # Fields from the POST body get precedence over those from GET.
         fields.update(urllib.parse.parse_qs(field_data, encoding="utf-8"))
@@ -1405,31 +2924,26 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
                 urllib.parse.urlparse(self.path).query, keep_blank_values=True
             )
             # Anything starting with /js/, /css/, /img/ is static content.
-            if self.path == "/favicon.ico":
-                self.do_static(fields, "image/x-icon")
-            elif self.path.startswith("/js/"):
-                self.do_static(fields, "application/x-javascript")
-            elif self.path.startswith("/img/"):
-                file_name = self.path.split("?", 1)[0]
-                if file_name.endswith(".png"):
-                    self.do_static(fields, "image/png")
-                elif file_name.endswith(".ico"):
-                    self.do_static(fields, "image/x-icon")
-                elif file_name.endswith(".jpg") or file_name.endswith(".jpeg"):
-                    self.do_static(fields, "image/jpeg")
-                elif file_name.endswith(".gif"):
-                    self.do_static(fields, "image/gif")
-                else:
-                    self.do_static(fields, "binary/octet-stream")
-            elif self.path.startswith("/css/"):
-                self.do_static(fields, "text/css; charset=utf-8")
+            (route, rest) = self.routes.find(self.path.split("?", 1)[0])
+            self.current_route = route
+            if route is not None and route.static:
+                mimetype = route.mime
+                if mimetype is None:
+                    mimetype = static_mimes.get(
+                        os.path.splitext(rest)[1].lower(), "binary/octet-stream"
+                    )
+                self.do_static(fields, mimetype, public=not route.auth)
+            elif route is not None and not route.session:
+                self.do_sessionless(route, rest, fields)
             else:
                 self.do_dynamic(fields)
         except Exception as e:
+            message = "%s" % (e)
+            body = message.encode("utf-8")
             self.send_response(400)
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            message = "%s" % (e)
-            self.wfile.write(message.encode("utf-8"))
+            self.wfile.write(body)
 
     # No @loguse as then we would be logging what we are logging.
     def log_error(self, format, *args):
@@ -1483,31 +2997,308 @@ class LocalWebHandler(http.server.BaseHTTPRequestHandler):
         )
 
 
+LocalWebHandler.routes.add_methods(LocalWebHandler)
+# The css, js and favicon are public: served without session.
+LocalWebHandler.routes.add(
+    Route("/favicon.ico", auth=0, mime="image/x-icon", static=True)
+)
+LocalWebHandler.routes.add(
+    Route("/js/", auth=0, mime="application/x-javascript", static=True)
+)
+LocalWebHandler.routes.add(Route("/img/", mime=None, static=True))
+LocalWebHandler.routes.add(
+    Route("/css/", auth=0, mime="text/css; charset=utf-8", static=True)
+)
+
+
+def service(path, auth=4, mime=json_mime, json=True, handler_class=None):
+    """
+    Decorator for a modlib module to add a service to the LocalWebHandler.
+
+    With handler_class it is only added to that subclass of the
+    LocalWebHandler.
+
+    The function is called as f(handler, session, fields, json_object) (with
+    the rest of the path after the session for a path ending with /) and
+    returns (return_code, return_mime, return_message) like the
+    do_service_* methods.
+
+    E.g.:
+        @service("/service/mymodule/stats")
+        def stats(handler, session, fields, json_object):
+            return (200, "text/json; charset=utf-8", {"result": True})
+    """
+
+    def register(f):
+        (handler_class or LocalWebHandler).routes.add(
+            Route(path, f, auth=auth, mime=mime, json=json)
+        )
+        return f
+
+    return register
+
+
 class BrowserThread(Thread):
 
-    # @loguse seems to break it.
-    def __init__(self, ip, port):
+    # @loguse seems to break it.
+    def __init__(self, ip, port):
+        """
+        Set the ip and port for the browser upon creation.
+        """
+        self.ip = ip
+        self.port = port
+        super().__init__(name="BrowserThread", daemon=True)
+
+    @loguse
+    def run(self):
+        """
+        Run the thread: i.e. wait and lauch the browser.
+        """
+        import time
+
+        # Waiting for x seconds to be sure the http server is up.
+        time.sleep(0)
+        webbrowser.open(
+            "http://%s:%s/?username=user&password=%s"
+            % (self.ip, self.port, users["user"])
+        )
+        print("Admin credentials: admin/%s" % (users["admin"]))
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """
+    HTTPServer that hands the requests to a bounded pool of worker threads.
+
+    The accepting thread only accepts the connections and queues them on the
+    pool. At most workers requests are handled at the same time and at most
+    max_queue accepted connections wait for a free worker. When both are full
+    the accepting thread stops accepting until a worker is done, so the rest
+    waits in the listen backlog of the kernel. With shed_load it answers
+    those connections with a 503 right away instead.
+    """
+
+    @loguse
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        workers=None,
+        max_queue=None,
+        shed_load=False,
+        retry_after=None,
+    ):
+        """
+        Creates the server with the pool of worker threads.
+
+        By default there are 10 workers and a queue of 50 connections. A shed
+        connection is told to retry after retry_after seconds (5 by default).
+        """
+        if not workers:
+            workers = 10
+        self.workers = int(workers)
+        if max_queue is None:
+            max_queue = 50
+        self.max_queue = int(max_queue)
+        if retry_after is None:
+            retry_after = 5
+        self.shed_load = bool(shed_load)
+        self.retry_after = int(retry_after)
+        self.shed = 0
+        # The accepted connections that aren't closed yet.
+        self.connections = 0
+        self.connections_lock = Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="LocalWebWorker"
+        )
+        self.slots = BoundedSemaphore(self.workers + self.max_queue)
+        super().__init__(server_address, RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        """
+        Queues the request on the worker pool.
+
+        Overridden from socketserver.BaseServer.
+        """
+        if self.shed_load:
+            if not self.slots.acquire(blocking=False):
+                self.shed_request(request)
+                return
+        else:
+            self.slots.acquire()
+        with self.connections_lock:
+            self.connections += 1
+        try:
+            self.executor.submit(self.process_request_worker, request, client_address)
+        except RuntimeError:
+            # The pool is already shut down.
+            with self.connections_lock:
+                self.connections -= 1
+            self.slots.release()
+            self.shutdown_request(request)
+
+    # No @loguse as this is called for every keep-alive request.
+    def queued(self):
+        """
+        Returns the number of connections waiting for a worker.
+        """
+        return max(0, self.connections - self.workers)
+
+    # No @loguse as this has to be cheap when overloaded.
+    def shed_request(self, request):
+        """
+        Answers the connection with a 503 without reading the request.
+        """
+        self.shed += 1
+        body = b"Service Unavailable"
+        response = (
+            b"HTTP/1.0 503 Service Unavailable\r\n"
+            b"Content-Type: text/plain; charset=utf-8\r\n"
+            b"Retry-After: %d\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n%s" % (self.retry_after, len(body), body)
+        )
+        try:
+            # Small enough for the socket buffer, so this doesn't block.
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        """
+        Handles the request in a worker thread.
+
+        Same as socketserver.ThreadingMixIn.process_request_thread.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.connections_lock:
+                self.connections -= 1
+            self.slots.release()
+
+    def server_close(self):
+        """
+        Closes the socket and stops the worker pool.
+        """
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class PreforkServer:
+    """
+    Runs a server in several processes.
+
+    The server (and so its listening socket) is created once, before forking
+    the worker processes which all accept on it. A server that only binds
+    when serving (e.g. the asyncweb server) must bind with SO_REUSEPORT. The parent process only
+    supervises: a worker process that stops is replaced until shutdown().
+
+    The after_fork function is called in every worker process before it
+    starts serving, e.g. to start threads (threads don't survive a fork) or
+    to reopen files and connections that can't be shared.
+    """
+
+    @loguse
+    def __init__(self, server, processes, after_fork=None):
+        self.server = server
+        self.server_address = server.server_address
+        self.processes = int(processes)
+        self.after_fork = after_fork
+        # The pids of the worker processes with their start time.
+        self.children = {}
+        self.stopping = False
+        # Accepting with a timeout: all the processes are woken up for a
+        # connection, but only one gets it. The others must not block in
+        # accept() as then they can't be stopped.
+        # Servers binding in the worker (SO_REUSEPORT) have no socket yet.
+        if getattr(self.server, "socket", None) is not None:
+            self.server.socket.settimeout(0.5)
+
+    @loguse
+    def spawn(self):
+        """
+        Forks a worker process.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+        # The worker process.
+        status = 0
+        try:
+            self.children = {}
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(
+                signal.SIGTERM,
+                lambda signum, frame: Thread(target=self.server.shutdown).start(),
+            )
+            if self.after_fork:
+                self.after_fork()
+            self.server.serve_forever()
+        except BaseException:
+            logging.getLogger(__name__).exception("Worker process %s" % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    @loguse
+    def serve_forever(self):
         """
-        Set the ip and port for the browser upon creation.
+        Starts the worker processes and replaces them until shutdown().
         """
-        self.ip = ip
-        self.port = port
-        super().__init__(name="BrowserThread", daemon=True)
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        try:
+            for i in range(self.processes):
+                self.spawn()
+            while self.children:
+                try:
+                    (pid, status) = os.wait()
+                except ChildProcessError:
+                    break
+                except InterruptedError:
+                    continue
+                started = self.children.pop(pid, None)
+                if started is None or self.stopping:
+                    continue
+                logging.getLogger(__name__).warning(
+                    "Worker process %s stopped (%s), restarting it." % (pid, status)
+                )
+                if time.monotonic() - started < 1:
+                    # Not restarting in a tight loop when it fails at start.
+                    time.sleep(1)
+                if not self.stopping:
+                    self.spawn()
+        except KeyboardInterrupt:
+            self.shutdown()
+            while self.children:
+                try:
+                    self.children.pop(os.wait()[0], None)
+                except ChildProcessError:
+                    break
 
     @loguse
-    def run(self):
+    def shutdown(self):
         """
-        Run the thread: i.e. wait and lauch the browser.
+        Stops the worker processes, can be called from another thread.
         """
-        import time
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
-        # Waiting for x seconds to be sure the http server is up.
-        time.sleep(0)
-        webbrowser.open(
-            "http://%s:%s/?username=user&password=%s"
-            % (self.ip, self.port, users["user"])
-        )
-        print("Admin credentials: admin/%s" % (users["admin"]))
+    @loguse
+    def server_close(self):
+        """
+        Closes the listening socket.
+        """
+        self.server.server_close()
 
 
 class ServerThread(Thread):
@@ -1530,6 +3321,7 @@ class ServerThread(Thread):
     @loguse
     def shutdown(self):
         self.server.shutdown()
+        self.server.server_close()
 
 
 class Application(suapp.jandw.Wooster):
@@ -1562,9 +3354,32 @@ class Application(suapp.jandw.Wooster):
         httpd_conf["ip"] = httpd_conf.get("ip", self.ip)
         httpd_conf["service_url"] = httpd_conf.get("service_url", "/service")
         jeeves.app.configuration["httpd"] = httpd_conf
+        if int(httpd_conf.get("processes") or 0) > 1 and not httpd_conf.get(
+            "session_file"
+        ):
+            # Every worker would have its own sessions (and logins).
+            raise ValueError(
+                "httpd.processes needs httpd.session_file to share the sessions."
+            )
         LocalWebHandler.jeeves = jeeves
         LocalWebHandler.drone = drone
-        self.server = http.server.HTTPServer((self.ip, self.port), LocalWebHandler)
+        LocalWebHandler.configure(httpd_conf)
+        self.server = self.create_server(httpd_conf)
+        if httpd_conf.get("processes"):
+            # The database connection can't be shared with the workers.
+            try:
+                jeeves.app.db.disconnect()
+            except AttributeError:
+                pass
+            self.server = PreforkServer(
+                self.server,
+                httpd_conf["processes"],
+                after_fork=lambda: self.after_fork(httpd_conf),
+            )
+        else:
+            LocalWebHandler.sessions.start_reaper(
+                httpd_conf.get("session_reap_interval")
+            )
         if httpd_conf.get("client", True):
             browser_thread = BrowserThread(self.ip, self.port)
             browser_thread.start()
@@ -1583,6 +3398,39 @@ class Application(suapp.jandw.Wooster):
             self.server.serve_forever()
             print("HTTPServer stopped.")
 
+    @loguse
+    def after_fork(self, httpd_conf):
+        """
+        Prepares a worker process of the PreforkServer.
+
+        The database connection is reopened by PonyORM when first used.
+        """
+        if LocalWebHandler.sessions.backend is not None:
+            LocalWebHandler.sessions.backend.after_fork()
+        LocalWebHandler.sessions.reaper = None
+        LocalWebHandler.sessions.start_reaper(httpd_conf.get("session_reap_interval"))
+
+    @loguse("@")  # Not logging the return value.
+    def create_server(self, httpd_conf):
+        """
+        Returns the http server for the ip and port.
+
+        Other web targets override this to use their own server.
+        """
+        if httpd_conf.get("workers"):
+            # Concurrent mode: handling the requests on a pool of threads.
+            return PooledHTTPServer(
+                (self.ip, self.port),
+                LocalWebHandler,
+                workers=httpd_conf["workers"],
+                max_queue=httpd_conf.get("max_queue"),
+                shed_load=httpd_conf.get(
+                    "shed_load", bool(httpd_conf.get("max_in_flight"))
+                ),
+                retry_after=httpd_conf.get("retry_after"),
+            )
+        return http.server.HTTPServer((self.ip, self.port), LocalWebHandler)
+
     @loguse
     def lock(self):
         pass
@@ -1813,16 +3661,320 @@ def arguments_as_dict(f):
     return real_f
 
 
+class ViewPlan:
+    """
+    The render plan of a view definition (see View).
+
+    It is compiled once from the definition: the static html is rendered and
+    joined then. What depends on the request (the query parameters and the
+    query results) are the nodes (functions) in it, which render() calls.
+
+    The objects of the queries of the lines are either rendered by the
+    browser (mode "client": the javascript gets them from /service/query/)
+    or in the html (mode "server"). Either way the query runs once.
+    """
+
+    @loguse([1])  # Not logging the definition.
+    def __init__(self, definition, name, debug=False, mode="client"):
+        """
+        Compiles the view definition.
+
+        With debug the plan has the DEBUG comments.
+        """
+        self.definition = definition
+        self.debug = debug
+        self.mode = mode
+        if definition is None:
+            definition = {}
+        self.title = definition.get("name", name)
+        html = []
+        self.add_debug(html, "title = %s", self.title)
+        def_tabs = definition.get("tabs", {0: {"title": ""}})
+        self.add_debug(html, "def_tabs = %s", def_tabs)
+        if "query" in def_tabs:
+            self.add_debug(html, "query = %s", def_tabs["query"])
+            html.append(functools.partial(self.query_tabs, definition, def_tabs, name))
+        else:
+            tabs = collections.OrderedDict()
+            # Loop over all integer keys and get out the titles.
+            for i in def_tabs:
+                # TODO: is this second element in the tuple correct?
+                tabs[i] = (def_tabs[i]["title"], def_tabs[i])
+                self.add_debug(html, "tabs: %s", tabs)
+            html.extend(self.compile_tabs(definition, tabs))
+        # Joining the static html between the nodes.
+        self.nodes = []
+        for part in html:
+            if isinstance(part, str) and self.nodes and isinstance(self.nodes[-1], str):
+                self.nodes[-1] += "\n" + part
+            else:
+                self.nodes.append(part)
+        self.nodes = tuple(self.nodes)
+
+    def add_debug(self, html, message, *args):
+        """
+        Adds the DEBUG comment to the html when debugging.
+        """
+        if self.debug:
+            html.append("<!-- DEBUG %s -->" % (message % args))
+
+    def compile_tabs(self, definition, tabs):
+        """
+        Returns the html and the nodes of the tab headers and tabs.
+        """
+        html = []
+        # Tab headers
+        html.append('<ul class="nav nav-tabs">')
+        for i in sorted(tabs):  # CHECKME: DO WE NEED SORTED HERE?
+            if i == 0:
+                html.append(
+                    '\t<li class="active"><a data-toggle="tab" href="#tab%s">%s</a></li>'
+                    % (i, tabs[i][0])
+                )
+            else:
+                html.append(
+                    '\t<li><a data-toggle="tab" href="#tab%s">%s</a></li>'
+                    % (i, tabs[i][0])
+                )
+        html.append("</ul>")
+
+        # Tabs
+        html.append('<div class="tab-content">')
+        for i in sorted(tabs):
+            self.add_debug(html, "tab: %s = %s", i, tabs[i])
+            if i == 0:
+                html.append('\t<div id="tab%s" class="tab-pane fade in active">' % (i))
+            else:
+                html.append('\t<div id="tab%s" class="tab-pane fade">' % (i))
+            # Sections
+            sections = tabs[i][1].get(
+                "sections", definition.get("sections", {0: {"title": ""}})
+            )
+            self.add_debug(html, "sections: %s", sections)
+            for s in sorted(sections.keys(), key=str):
+                self.add_debug(html, "section: %s", s)
+                if not str(s).isdigit():
+                    continue
+                section_title = sections[s].get("title", "")
+                html.append(
+                    '\t\t<div class="panel panel-default">'
+                )  # panel-primary <> panel-default ?
+                if section_title != tabs[i][0]:
+                    html.append(
+                        '\t\t\t<div class="panel-heading">%s</div>' % (section_title)
+                    )
+                html.append('\t\t\t<div class="panel-body" id="section%s_%s">' % (i, s))
+                # Lines
+                lines = sections[s].get(
+                    "lines",
+                    tabs.get("lines", definition.get("sections", {0: {"title": ""}})),
+                )
+                self.add_debug(html, "lines = %s", lines)
+                if "query" in lines and self.mode == "server":
+                    html.append(
+                        self.compile_server_lines(lines, "section%s_%s" % (i, s))
+                    )
+                elif "query" in lines:
+                    html.append(
+                        self.compile_query_lines(lines, "section%s_%s" % (i, s))
+                    )
+                else:
+                    html.extend(self.compile_lines(lines))
+                html.append("\t\t\t</div>")
+                html.append("\t\t</div>")
+
+            html.append("\t</div>")
+        html.append("</div>")
+        return html
+
+    def compile_query_lines(self, lines, view):
+        """
+        Returns the node of lines with a query: the javascript getting the
+        objects and rendering their elements.
+
+        The values are escaped, the attributes of the objects by the
+        javascript (suappEscape in View.raw_js).
+        """
+        html_element = None
+        if "elements" in lines:
+            html = []
+            for e in sorted(lines["elements"]):
+                value = lines["elements"][e].get("value", "#")
+                element_type = lines["elements"][e].get("type", "label").lower()
+                outmessage = lines["elements"][e].get("outmessage", "")
+                if value[0] == ".":
+                    value = (
+                        '\' + suappEscape(data["objects"][elementid]["'
+                        + value[1:]
+                        + "\"]) + '"
+                    )
+                else:
+                    # In a javascript string.
+                    value = escape(value).replace("\\", "\\\\")
+                if element_type == "button":
+                    html.append(
+                        View._button_as_button(value=value, outmessage=outmessage)
+                    )
+                else:
+                    html.append('<span class="label">%s</span>' % (value))
+            html_element = "".join(html)
+        return functools.partial(self.query_js, lines["query"], view, html_element)
+
+    def compile_server_lines(self, lines, view):
+        """
+        Returns the node of lines with a query rendered on the server: the
+        html of the elements for every object.
+        """
+        elements = []
+        for e in sorted(lines.get("elements", {})):
+            value = lines["elements"][e].get("value", "#")
+            element_type = lines["elements"][e].get("type", "label").lower()
+            outmessage = lines["elements"][e].get("outmessage", "")
+            elements.append((value, element_type, outmessage))
+        return functools.partial(self.query_objects, lines["query"], view, elements)
+
+    def compile_lines(self, lines):
+        """
+        Returns the html of the lines without query.
+
+        Without query there is no object, so a value can't be an attribute.
+        """
+        html = []
+        for l in sorted(lines.keys(), key=str):
+            if str(l).isdigit():
+                # Line elements
+                if "elements" in lines[l]:
+                    for e in sorted(lines[l]["elements"]):
+                        self.add_debug(html, "element = %s", e)
+                        value = lines[l]["elements"][e].get("value", "#")
+                        l_type = lines[l]["elements"][e].get("type", "button").lower()
+                        outmessage = lines[l]["elements"][e].get("outmessage", "")
+                        if l_type == "button":
+                            html.append(
+                                "\t\t\t"
+                                + View.button(value=value, outmessage=outmessage)
+                            )
+                        else:
+                            html.append("\t\t\t" + View.label(value=value))
+        return html
+
+    # No @loguse as this is called for every query in a view.
+    def query_js(self, query, view, html_element, jeeves, query_params, js_params):
+        """
+        Returns the html of the javascript getting the objects of the query.
+        """
+        # The objects are fetched by the javascript, not here.
+        parameters = jeeves.pre_query(query, params=query_params)[1]
+        parameters["query"] = query
+        js_query_params = with_expanded_values(js_params, params=parameters)
+        js_query_params["view"] = view
+        if html_element is not None:
+            js_query_params["html"] = html_element
+        return [View.raw_js % (js_query_params)]
+
+    # No @loguse as this is called for every query in a view.
+    def query_objects(self, query, view, elements, jeeves, query_params, js_params):
+        """
+        Returns the html of the objects of the query with their elements.
+
+        It has the same elements as the javascript of query_js renders (see
+        compile_query_lines), with the values escaped.
+        """
+        items = []
+        for line_object in jeeves.do_query(query, params=query_params):
+            table_type = line_object.__class__.__name__.split("_")[-1]
+            html = []
+            for value, element_type, outmessage in elements:
+                if value[0] == ".":
+                    value = getattr(line_object, value[1:])
+                value = escape(str(value))
+                if element_type == "button":
+                    kwargs = {}
+                    if outmessage == "RECORD":
+                        kwargs = {
+                            "module": line_object.__module__,
+                            "table": table_type,
+                            "key": line_object._pk_,
+                        }
+                    html.append(
+                        View.button(value=value, outmessage=outmessage, **kwargs)
+                    )
+                else:
+                    html.append('<span class="label">%s</span>' % (value))
+            items.append(
+                '<p id="%s_%s">%s</p>'
+                % (table_type, escape(str(line_object._pk_)), "".join(html))
+            )
+        return [
+            '<span class="my-new-list" id="%s_objects">%s</span>'
+            % (view, " ".join(items))
+        ]
+
+    # No @loguse as this is called for every view with a tabs query.
+    def query_tabs(self, definition, def_tabs, name, jeeves, query_params, js_params):
+        """
+        Returns the html of the tabs of a tabs query: a tab per object.
+
+        The tab objects are needed for the tabs themselves, so the query
+        runs here (once) in both modes and not in the browser.
+        """
+        html = []
+        tab_title = def_tabs.get("title", name)
+        tab_objects = jeeves.do_query(def_tabs["query"], params=query_params)
+        self.add_debug(html, "tab_objects = %s", tab_objects)
+        tabs = collections.OrderedDict()
+        tab_count = 0
+        for tab in tab_objects:
+            if tab_title[0] == ".":
+                tabs[tab_count] = (getattr(tab, tab_title[1:]), tab)
+            else:
+                tabs[tab_count] = (tab_title, tab)
+            tab_count += 1
+        # The tabs depend on the objects, so they are compiled every time.
+        self.fill(
+            self.compile_tabs(definition, tabs), html, jeeves, query_params, js_params
+        )
+        return html
+
+    def fill(self, nodes, html, jeeves, query_params, js_params):
+        """
+        Adds the html of the nodes to html.
+        """
+        for node in nodes:
+            if isinstance(node, str):
+                html.append(node)
+            else:
+                html.extend(node(jeeves, query_params, js_params))
+
+    # No @loguse as this is called for every view.
+    def render(self, jeeves, query_params, js_params):
+        """
+        Returns the html of the view for the request.
+        """
+        html = []
+        self.fill(self.nodes, html, jeeves, query_params, js_params)
+        return "\n".join(html)
+
+
 class View(suapp.jandw.Wooster):
     """
     Generic view page for showing.
     """
 
+    # The ViewPlan per (flow name, debug, mode), see plan.
+    plans = {}
+    # Where the objects of the queries are rendered: "client" or "server".
+    render_mode = "client"
+
     # http://api.jquery.com/jquery.getjson/
     # Is more complicated, check on 'result' and next 'object'.
     raw_js = """<script>
 (function() {
     var suappAPI = "%(service_url)s/%(query)s";
+    function suappEscape(value) {
+      return String(value).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+        .replace(/>/g, "&gt;").replace(/"/g, "&quot;").replace(/'/g, "&#x27;");
+    }
     $.getJSON( suappAPI, function( data ) {
       console.log("Got json.")
       console.log(data)
@@ -2003,20 +4155,44 @@ class View(suapp.jandw.Wooster):
     def combobox(**kwargs):
         return View.combobox_as_select(**kwargs)
 
+    @classmethod
+    def plan(cls, flow_name, definition, debug=False):
+        """
+        Returns the ViewPlan of the view definition.
+
+        The plan is compiled once and again when the definition in
+        jeeves.views is replaced (changing it in place isn't noticed).
+
+        The definition can set its own "render" mode, else it is render_mode
+        (see LocalWebHandler.configure).
+        """
+        mode = cls.render_mode
+        if definition:
+            mode = definition.get("render", mode)
+        key = (flow_name, debug, mode)
+        plan = cls.plans.get(key)
+        if plan is None or plan.definition is not definition:
+            plan = cls.plans[key] = ViewPlan(
+                definition, flow_name.lower().capitalize(), debug, mode
+            )
+        return plan
+
     @loguse("@")  # Not logging the return value.
     def inflow(self, jeeves, drone):
         """
         Entry point for the record page
+
+        The view definition is rendered by its ViewPlan (see plan).
         """
         self.jeeves = jeeves
 
-        # Getting the flow (usually uppercase) and ref (lowercase) names.
+        # Getting the flow (usually uppercase) name and the view definition.
         flow_name = drone.name
-        ref_name = flow_name.lower()
-        name = ref_name.capitalize()
-
-        # Getting the view definition.
-        definition = jeeves.views.get(flow_name, {})
+        plan = View.plan(
+            flow_name,
+            jeeves.views.get(flow_name),
+            logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG),
+        )
 
         # Getting the session, params and preparing the scope.
         session = drone.dataobject.get("session", {})
@@ -2034,225 +4210,6 @@ class View(suapp.jandw.Wooster):
             js_params[
                 "query"
             ] = "query/%(query)s?pagenum=%(pagenum)s&pagesize=%(pagesize)s"
-        result = []
         js_params["service_url"] = jeeves.app.configuration["httpd"]["service_url"]
 
-        # Creating the output.
-        html = []
-
-        # Title
-        title = definition.get("name", name)
-        if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-            html.append("<!-- DEBUG title = %s -->" % (title))
-
-        def_tabs = definition.get("tabs", {0: {"title": ""}})
-        if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-            html.append("<!-- DEBUG def_tabs = %s -->" % (def_tabs))
-
-        tabs = collections.OrderedDict()
-        tab_count = 0
-        if "query" in def_tabs:
-            if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                html.append("<!-- DEBUG query = %s -->" % (def_tabs["query"]))
-            tab_title = def_tabs.get("title", name)
-            tab_objects = self.jeeves.do_query(def_tabs["query"], params=query_params)
-            parameters = self.jeeves.pre_query(def_tabs["query"], params=query_params)[
-                1
-            ]
-            parameters["query"] = def_tabs["query"]
-            js_query_params = with_expanded_values(js_params, params=parameters)
-            js_query_params["view"] = "testview"  # TODO
-            html.append(View.raw_js % (js_query_params))
-            # TESTVIEW
-            html.append('<table id="testview">')
-            html.append("</table>")
-            if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                html.append("<!-- DEBUG tab_objects = %s -->" % (tab_objects))
-            for tab in tab_objects:
-                if tab_title[0] == ".":
-                    tabs[tab_count] = (getattr(tab, tab_title[1:]), tab)
-                else:
-                    tabs[tab_count] = (tab_title, tab)
-                tab_count += 1
-        else:
-            # Loop over all integer keys and get out the titles.
-            for i in def_tabs:
-                # TODO: is this second element in the tuple correct?
-                tabs[i] = (def_tabs[i]["title"], def_tabs[i])
-                if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                    html.append("<!-- DEBUG tabs: %s -->" % (tabs))
-
-        # Tab headers
-        html.append('<ul class="nav nav-tabs">')
-        for i in sorted(tabs):  # CHECKME: DO WE NEED SORTED HERE?
-            if i is 0:
-                html.append(
-                    '\t<li class="active"><a data-toggle="tab" href="#tab%s">%s</a></li>'
-                    % (i, tabs[i][0])
-                )
-            else:
-                html.append(
-                    '\t<li><a data-toggle="tab" href="#tab%s">%s</a></li>'
-                    % (i, tabs[i][0])
-                )
-        html.append("</ul>")
-
-        # Tabs
-        html.append('<div class="tab-content">')
-        for i in sorted(tabs):
-            if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                html.append("<!-- DEBUG tab: %s = %s -->" % (i, tabs[i]))
-            if i is 0:
-                html.append('\t<div id="tab%s" class="tab-pane fade in active">' % (i))
-            else:
-                html.append('\t<div id="tab%s" class="tab-pane fade">' % (i))
-            # Sections
-            sections = tabs[i][1].get(
-                "sections", definition.get("sections", {0: {"title": ""}})
-            )
-            if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                html.append("<!-- DEBUG sections: %s -->" % (sections))
-            for s in sorted(sections.keys(), key=str):
-                if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                    html.append("<!-- DEBUG section: %s -->" % (s))
-                if not str(s).isdigit():
-                    continue
-                section_title = sections[s].get("title", "")
-                html.append(
-                    '\t\t<div class="panel panel-default">'
-                )  # panel-primary <> panel-default ?
-                if section_title != tabs[i][0]:
-                    html.append(
-                        '\t\t\t<div class="panel-heading">%s</div>' % (section_title)
-                    )
-                html.append('\t\t\t<div class="panel-body" id="section%s_%s">' % (i, s))
-                # Lines
-                lines = sections[s].get(
-                    "lines",
-                    tabs.get("lines", definition.get("sections", {0: {"title": ""}})),
-                )
-                # DEBUGGING
-                if logging.getLogger(self.__module__).isEnabledFor(logging.DEBUG):
-                    html.append("<!-- DEBUG lines = %s -->" % (lines))
-                line_objects = []
-                if "query" in lines:
-                    line_objects = self.jeeves.do_query(
-                        lines["query"], params=query_params
-                    )
-                    query_template, parameters = self.jeeves.pre_query(
-                        lines["query"], params=query_params
-                    )
-                    parameters["query"] = lines["query"]
-                    js_query_params = with_expanded_values(js_params, params=parameters)
-                    js_query_params["view"] = "section%s_%s" % (i, s)
-                    if "elements" in lines:
-                        for e in sorted(lines["elements"]):
-                            value = lines["elements"][e].get("value", "#")
-                            element_type = (
-                                lines["elements"][e].get("type", "label").lower()
-                            )
-                            outmessage = lines["elements"][e].get("outmessage", "")
-                            if value[0] == ".":
-                                value = (
-                                    '\' + data["objects"][elementid]["'
-                                    + value[1:]
-                                    + "\"] + '"
-                                )
-                            html_element = "&nbsp;"
-                            if element_type == "button":
-                                # Button
-                                html_element = View._button_as_button(
-                                    value=value, outmessage=outmessage
-                                )
-                            else:
-                                # Label
-                                pass
-                            js_query_params["html"] = html_element
-                    html.append(View.raw_js % (js_query_params))
-                else:
-                    for line_object in line_objects:
-                        if logging.getLogger(self.__module__).isEnabledFor(
-                            logging.DEBUG
-                        ):
-                            html.append(
-                                "<!-- DEBUG line_object = %s (%s in %s) -->"
-                                % (
-                                    line_object,
-                                    type(line_object),
-                                    line_object.__module__,
-                                )
-                            )
-                        line_elements = []
-                        # Line elements
-                        if "elements" in lines:
-                            for e in sorted(lines["elements"]):
-                                if logging.getLogger(self.__module__).isEnabledFor(
-                                    logging.DEBUG
-                                ):
-                                    html.append("<!-- DEBUG element = %s -->" % (e))
-                                value = lines["elements"][e].get("value", "#")
-                                element_type = (
-                                    lines["elements"][e].get("type", "label").lower()
-                                )
-                                outmessage = lines["elements"][e].get("outmessage", "")
-                                if value[0] == ".":
-                                    value = getattr(line_object, value[1:])
-                                if element_type == "button":
-                                    html.append(
-                                        "\t\t\t\t"
-                                        + View.button(
-                                            value=value,
-                                            outmessage=outmessage,
-                                            module=line_object.__module__,
-                                            table=line_object.__class__.__name__.split(
-                                                "_"
-                                            )[-1],
-                                            key=line_object._pk_,
-                                        )
-                                    )
-                                else:
-                                    html.append("\t\t\t\t" + View.label(value=value))
-                    for l in sorted(lines.keys(), key=str):
-                        if str(l).isdigit():
-                            # Line elements
-                            if "elements" in lines[l]:
-                                for e in sorted(lines[l]["elements"]):
-                                    if logging.getLogger(self.__module__).isEnabledFor(
-                                        logging.DEBUG
-                                    ):
-                                        html.append("<!-- DEBUG element = %s -->" % (e))
-                                    value = lines[l]["elements"][e].get("value", "#")
-                                    l_type = (
-                                        lines[l]["elements"][e]
-                                        .get("type", "button")
-                                        .lower()
-                                    )
-                                    outmessage = lines[l]["elements"][e].get(
-                                        "outmessage", ""
-                                    )
-                                    if value[0] == ".":
-                                        value = getattr(line_object, value[1:])
-                                    if element_type == "button":
-                                        html.append(
-                                            "\t\t\t"
-                                            + View.button(
-                                                value=value,
-                                                outmessage=outmessage,
-                                                module=line_object.__module__,
-                                                table=line_object.__class__.__name__.split(
-                                                    "_"
-                                                )[
-                                                    -1
-                                                ],
-                                                key=line_object._pk_,
-                                            )
-                                        )
-                                    else:
-                                        html.append("\t\t\t" + View.label(value=value))
-                html.append("\t\t\t</div>")
-                html.append("\t\t</div>")
-
-            html.append("\t</div>")
-        html.append("</div>")
-
-        return (title, "\n".join(html))
+        return (plan.title, plan.render(jeeves, query_params, js_params))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Admission control of the localweb target.
+
+The AdmissionControl limits how many dynamic requests (pages and services,
+e.g. /service/query/) are handled at the same time. A request waits at most
+max_queue_wait seconds for its turn, after that it is answered with a 503
+and a Retry-After header. That way an overloaded server answers quickly
+instead of letting every client time out.
+
+The cheap requests (static files and routes without session, e.g. /health)
+are not limited, so they still get a worker while the dynamic requests are
+waiting.
+"""
+
+import threading
+
+from suapp.logdecorator import *
+
+
+__all__ = ["AdmissionControl"]
+
+
+class AdmissionControl:
+    """
+    Limits the number of requests in flight.
+
+    Without max_in_flight every request is admitted right away.
+    """
+
+    @loguse
+    def __init__(self, max_in_flight=None, max_queue_wait=None, retry_after=None):
+        """
+        Admits at most max_in_flight requests at the same time.
+
+        A request waits at most max_queue_wait seconds (1 by default) and is
+        told to retry after retry_after seconds (5 by default).
+        """
+        if max_queue_wait is None:
+            max_queue_wait = 1
+        if retry_after is None:
+            retry_after = 5
+        self.max_in_flight = int(max_in_flight or 0)
+        self.max_queue_wait = float(max_queue_wait)
+        self.retry_after = int(retry_after)
+        if self.max_in_flight:
+            self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        else:
+            self.slots = None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    # No @loguse as this is called for every request.
+    def admit(self):
+        """
+        Returns True if the request can be handled, False if it is rejected.
+
+        An admitted request has to call release() when it is done.
+        """
+        if self.slots is None:
+            return True
+        if not self.slots.acquire(blocking=False):
+            # Full: waiting in line for a slot.
+            with self.lock:
+                self.waiting += 1
+            try:
+                admitted = self.slots.acquire(timeout=self.max_queue_wait)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not admitted:
+                with self.lock:
+                    self.rejected += 1
+                return False
+        with self.lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True
+
+    # No @loguse as this is called for every request.
+    def release(self):
+        """
+        Frees the slot of an admitted request.
+        """
+        if self.slots is None:
+            return
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    @loguse("@")  # Not logging the return value.
+    def stats(self):
+        """
+        Returns the limits and the counters.
+        """
+        with self.lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "max_queue_wait": self.max_queue_wait,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
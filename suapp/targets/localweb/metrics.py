@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Request metrics of the localweb target.
+
+The MetricsRegistry keeps per series (e.g. a route or a named query) a
+latency histogram with fixed buckets, the number of responses per status
+code and the total size of the responses.
+
+Recording has to be cheap enough to leave it on: every thread writes to one
+of several stripes (each with its own lock), so the threads rarely wait on
+each other. Only reading the metrics merges the stripes.
+
+The metrics are per process: with several processes every process has its
+own.
+"""
+
+import bisect
+import threading
+
+from suapp.logdecorator import *
+
+
+__all__ = ["MetricsRegistry"]
+
+
+# The upper bounds (in seconds) of the latency buckets.
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Series:
+    """
+    The counters of one series in one stripe.
+    """
+
+    __slots__ = ["count", "sum", "buckets", "codes", "size"]
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.sum = 0.0
+        # One more for the +Inf bucket.
+        self.buckets = [0] * (buckets + 1)
+        self.codes = {}
+        self.size = 0
+
+
+class MetricsRegistry:
+    """
+    Registry of the request metrics.
+
+    A series is identified by its kind (e.g. "route" or "query") and name.
+    The latencies are counted in the buckets (in seconds, default_buckets
+    by default) and spread over stripes (8 by default).
+    """
+
+    @loguse
+    def __init__(self, buckets=None, stripes=None):
+        if buckets is None:
+            buckets = default_buckets
+        if not stripes:
+            stripes = 8
+        self.enabled = True
+        self.buckets = tuple(sorted(buckets))
+        self.stripes = [(threading.Lock(), {}) for i in range(int(stripes))]
+
+    # No @loguse as this is called for every request.
+    def observe(self, kind, name, code, seconds, size=0):
+        """
+        Records a response with its status code, latency and size.
+        """
+        if not self.enabled:
+            return
+        (lock, series) = self.stripes[threading.get_ident() % len(self.stripes)]
+        with lock:
+            counters = series.get((kind, name))
+            if counters is None:
+                counters = series[(kind, name)] = Series(len(self.buckets))
+            counters.count += 1
+            counters.sum += seconds
+            counters.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+            counters.codes[code] = counters.codes.get(code, 0) + 1
+            counters.size += size
+
+    @loguse
+    def reset(self):
+        """
+        Removes all the series.
+        """
+        for lock, series in self.stripes:
+            with lock:
+                series.clear()
+
+    @loguse("@")  # Not logging the return value.
+    def snapshot(self):
+        """
+        Returns the metrics (merged over the stripes) as dictionary.
+
+        E.g.:
+            {
+                "route": {
+                    "/service/query/": {
+                        "count": 3,
+                        "sum": 0.042,
+                        "buckets": [[0.005, 1], ..., ["+Inf", 3]],
+                        "codes": {"200": 3},
+                        "size": 1234
+                    }
+                }
+            }
+        The buckets are cumulative: the number of responses that took at most
+        that many seconds.
+        """
+        merged = {}
+        for lock, series in self.stripes:
+            with lock:
+                for (kind, name), counters in series.items():
+                    total = merged.setdefault(kind, {}).get(name)
+                    if total is None:
+                        total = merged[kind][name] = Series(len(self.buckets))
+                    total.count += counters.count
+                    total.sum += counters.sum
+                    for i, count in enumerate(counters.buckets):
+                        total.buckets[i] += count
+                    for code, count in counters.codes.items():
+                        total.codes[code] = total.codes.get(code, 0) + count
+                    total.size += counters.size
+        result = {}
+        for kind, names in merged.items():
+            result[kind] = {}
+            for name, total in sorted(names.items()):
+                cumulative = []
+                count = 0
+                for bound, bucket in zip(self.buckets + ("+Inf",), total.buckets):
+                    count += bucket
+                    cumulative.append([bound, count])
+                result[kind][name] = {
+                    "count": total.count,
+                    "sum": total.sum,
+                    "buckets": cumulative,
+                    "codes": {str(code): n for code, n in sorted(total.codes.items())},
+                    "size": total.size,
+                }
+        return result
+
+    @loguse("@")  # Not logging the return value.
+    def to_prometheus(self, prefix="suapp"):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        lines.append(
+            "# HELP %s_request_duration_seconds Time to answer a request." % prefix
+        )
+        lines.append("# TYPE %s_request_duration_seconds histogram" % prefix)
+        for kind, names in sorted(snapshot.items()):
+            for name, metrics in names.items():
+                labels = 'kind="%s",name="%s"' % (kind, label_value(name))
+                for bound, count in metrics["buckets"]:
+                    lines.append(
+                        '%s_request_duration_seconds_bucket{%s,le="%s"} %d'
+                        % (prefix, labels, bound, count)
+                    )
+                lines.append(
+                    "%s_request_duration_seconds_sum{%s} %r"
+                    % (prefix, labels, metrics["sum"])
+                )
+                lines.append(
+                    "%s_request_duration_seconds_count{%s} %d"
+                    % (prefix, labels, metrics["count"])
+                )
+        lines.append("# HELP %s_responses_total Responses per status code." % prefix)
+        lines.append("# TYPE %s_responses_total counter" % prefix)
+        for kind, names in sorted(snapshot.items()):
+            for name, metrics in names.items():
+                labels = 'kind="%s",name="%s"' % (kind, label_value(name))
+                for code, count in metrics["codes"].items():
+                    lines.append(
+                        '%s_responses_total{%s,code="%s"} %d'
+                        % (prefix, labels, code, count)
+                    )
+        lines.append("# HELP %s_response_bytes_total Size of the responses." % prefix)
+        lines.append("# TYPE %s_response_bytes_total counter" % prefix)
+        for kind, names in sorted(snapshot.items()):
+            for name, metrics in names.items():
+                labels = 'kind="%s",name="%s"' % (kind, label_value(name))
+                lines.append(
+                    "%s_response_bytes_total{%s} %d" % (prefix, labels, metrics["size"])
+                )
+        return "\n".join(lines) + "\n"
+
+
+def label_value(value):
+    """
+    Escapes a Prometheus label value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Route table of the localweb target.
+
+A route maps a path to what handles it: a method of the LocalWebHandler (by
+name, so subclasses can override it) or a function registered by a modlib
+module. Exact routes match the whole path, prefix routes (ending with /)
+match everything below them and get the rest of the path.
+
+Looking up an exact route is a dictionary lookup. For a prefix route only
+the path up to each / is looked up, starting with the longest.
+
+Every LocalWebHandler subclass has its own RouteTable with the table of its
+parent class as parent: its routes don't change the parent, but it still
+sees the routes added to the parent later (e.g. by a modlib module).
+"""
+
+from suapp.logdecorator import *
+
+
+__all__ = ["json_mime", "Route", "RouteTable", "route"]
+
+
+json_mime = "text/json; charset=utf-8"
+
+
+class Route:
+    """
+    A route with what handles it.
+
+    Parameters:
+     - path: The exact path or the prefix (ending with /).
+     - handler: The name of a LocalWebHandler method or a function. Both are
+                called with (session, fields, json_object) and for a prefix
+                route with (session, rest, fields, json_object). A function
+                gets the LocalWebHandler as extra first argument.
+     - auth: The permissions needed (see LocalWebHandler.authorized).
+     - mime: The mime type of the response. For static routes None means
+             guessing it from the file extension.
+     - json: If the result should be transformed to json.
+     - static: If it is served from the static files.
+     - session: If it needs the session. Without, it gets None as session
+                and there are no cookies nor authorization (auth must be 0).
+    """
+
+    __slots__ = [
+        "path",
+        "handler",
+        "auth",
+        "mime",
+        "json",
+        "static",
+        "session",
+        "prefix",
+    ]
+
+    def __init__(
+        self,
+        path,
+        handler=None,
+        auth=4,
+        mime=json_mime,
+        json=True,
+        static=False,
+        session=True,
+    ):
+        self.path = path
+        self.handler = handler
+        self.auth = auth
+        self.mime = mime
+        self.json = json
+        self.static = static
+        self.session = session
+        self.prefix = path.endswith("/")
+
+    def __repr__(self):
+        return "Route(%r, %r)" % (self.path, self.handler)
+
+    def call(self, web_handler, session, rest, fields, json_object):
+        """
+        Calls what handles the route and returns (code, mime, message).
+        """
+        if isinstance(self.handler, str):
+            f = getattr(web_handler, self.handler)
+        else:
+            f = self.handler.__get__(web_handler)
+        if self.prefix:
+            return f(session, rest, fields, json_object)
+        return f(session, fields, json_object)
+
+
+class RouteTable:
+    """
+    Table of the routes.
+
+    A route that isn't in the table is looked up in the parent table (if
+    any).
+    """
+
+    @loguse
+    def __init__(self, parent=None):
+        self.exact = {}
+        self.prefixes = {}
+        self.parent = parent
+        self.tables = [self]
+        if parent is not None:
+            self.tables.extend(parent.tables)
+
+    @loguse
+    def child(self):
+        """
+        Returns a new (empty) RouteTable with this one as parent.
+        """
+        return RouteTable(parent=self)
+
+    @staticmethod
+    def normalize(path):
+        """
+        Normalizes an exact path.
+
+        The services were found by their lowercased method name, so
+        /service/admin_sessions and /service/Admin/Sessions were the same as
+        /service/admin/sessions. This is kept for all the exact routes, so
+        other exact paths (e.g. /health) are now case-insensitive too, which
+        they were not before. The prefix routes are still case-sensitive.
+        """
+        return path.lower().replace("_", "/")
+
+    @loguse
+    def add(self, route):
+        """
+        Adds (or replaces) the route.
+        """
+        if route.prefix:
+            self.prefixes[route.path] = route
+        else:
+            self.exact[RouteTable.normalize(route.path)] = route
+        return route
+
+    # No @loguse as this is called for every request.
+    def find(self, path):
+        """
+        Returns the route for the path (without query) and the rest of path.
+
+        The rest is the part after the prefix for a prefix route. If there is
+        no route it returns (None, path).
+        """
+        normalized = RouteTable.normalize(path)
+        for table in self.tables:
+            route = table.exact.get(normalized)
+            if route is not None:
+                return (route, "")
+        index = len(path)
+        while index > 0:
+            index = path.rfind("/", 0, index)
+            if index < 0:
+                break
+            prefix = path[: index + 1]
+            for table in self.tables:
+                route = table.prefixes.get(prefix)
+                if route is not None:
+                    return (route, path[index + 1 :])
+        return (None, path)
+
+    @loguse
+    def add_methods(self, cls):
+        """
+        Adds the routes of the methods of the class.
+
+        Every do_service_* method is a route: do_service_admin_sessions is
+        /service/admin/sessions. Methods marked with @route get the options
+        passed to it.
+        """
+        for name, method in vars(cls).items():
+            options = getattr(method, "route_options", None)
+            if options is not None:
+                self.add(Route(handler=name, **options))
+            elif name.startswith("do_service_") and callable(method):
+                self.add(Route("/service/" + name[11:].replace("_", "/"), name))
+
+
+def route(path, **kwargs):
+    """
+    Marks a LocalWebHandler method as handling the path.
+
+    The keyword arguments are the Route options (auth, mime, json, static,
+    session).
+    """
+
+    def mark(f):
+        f.route_options = dict(kwargs, path=path)
+        return f
+
+    return mark
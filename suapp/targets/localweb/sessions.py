@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Session backends of the localweb SessionStore.
+
+A backend keeps the sessions outside of the process, so they survive a
+restart and can be shared by several processes. The SessionStore keeps the
+live Session objects in memory and reads and writes the backend.
+
+Only the json serializable entries of a session are stored. The entries that
+can't be serialized (e.g. the jeeves and the drone) are rehydrated by the
+SessionStore when they are first used.
+"""
+
+import json
+import sqlite3
+import threading
+
+from suapp.logdecorator import *
+
+
+__all__ = ["SessionBackend", "SQLiteSessionBackend"]
+
+
+class SessionBackend:
+    """
+    The interface of a session backend.
+
+    The payload is a dict with the json serializable entries of a session.
+    The version is incremented on every save, so a process can see if its
+    copy of the session is still current.
+    """
+
+    def load(self, sessionid):
+        """
+        Returns (payload, last_used, version) of the session or None.
+        """
+        raise NotImplementedError()
+
+    def save(self, sessionid, payload, last_used):
+        """
+        Stores the session and returns its new version.
+        """
+        raise NotImplementedError()
+
+    def touch(self, sessionid, last_used):
+        """
+        Sets when the session was last used.
+        """
+        raise NotImplementedError()
+
+    def delete(self, sessionid):
+        """
+        Removes the session.
+        """
+        raise NotImplementedError()
+
+    def expire(self, limit):
+        """
+        Removes the sessions last used before limit and returns how many.
+        """
+        raise NotImplementedError()
+
+    def after_fork(self):
+        """
+        Called in a forked process, before the backend is used.
+        """
+        pass
+
+    def close(self):
+        """
+        Releases the resources of the backend.
+        """
+        pass
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Stores the sessions in a SQLite database file.
+
+    The database is in WAL mode, so the readers don't block the writer and
+    several processes on the host can use the same file. Every thread has its
+    own connection.
+    """
+
+    @loguse
+    def __init__(self, filename, busy_timeout=None):
+        """
+        Opens (or creates) the database.
+
+        A writer waits at most busy_timeout seconds (5 by default) for another.
+        """
+        if not busy_timeout:
+            busy_timeout = 5
+        self.filename = filename
+        self.busy_timeout = float(busy_timeout)
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, "
+            "payload TEXT NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 1)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)"
+        )
+
+    # No @loguse as this is called for every session access.
+    def connection(self):
+        """
+        Returns the connection of this thread.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # Autocommit: every statement is its own (short) transaction.
+            connection = sqlite3.connect(
+                self.filename, timeout=self.busy_timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    # No @loguse as this is called for every session access.
+    def load(self, sessionid):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT payload, last_used, version FROM sessions WHERE id = ?",
+                (sessionid,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return (json.loads(row[0]), row[1], row[2])
+
+    # No @loguse as this is called for every changed session.
+    def save(self, sessionid, payload, last_used):
+        connection = self.connection()
+        statement = (
+            "INSERT INTO sessions (id, payload, last_used) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET payload = excluded.payload, "
+            "last_used = excluded.last_used, version = version + 1"
+        )
+        parameters = (sessionid, json.dumps(payload, separators=(",", ":")), last_used)
+        if sqlite3.sqlite_version_info >= (3, 35):
+            return connection.execute(
+                statement + " RETURNING version", parameters
+            ).fetchall()[0][0]
+        # No RETURNING before SQLite 3.35.
+        connection.execute(statement, parameters)
+        return connection.execute(
+            "SELECT version FROM sessions WHERE id = ?", (sessionid,)
+        ).fetchone()[0]
+
+    # No @loguse as this is called for every session access.
+    def touch(self, sessionid, last_used):
+        self.connection().execute(
+            "UPDATE sessions SET last_used = ? WHERE id = ?", (last_used, sessionid)
+        )
+
+    @loguse
+    def delete(self, sessionid):
+        self.connection().execute("DELETE FROM sessions WHERE id = ?", (sessionid,))
+
+    @loguse
+    def expire(self, limit):
+        cursor = self.connection().execute(
+            "DELETE FROM sessions WHERE last_used < ?", (limit,)
+        )
+        return cursor.rowcount
+
+    @loguse
+    def after_fork(self):
+        # Not closing the connections of the parent as that releases its locks.
+        self.local = threading.local()
+
+    @loguse
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
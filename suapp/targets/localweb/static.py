@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Static files (css, js, img) of the localweb target.
+
+The StaticFileCache indexes the static directories. Small files are kept in
+memory, large files are only indexed and sent from disk. Every file has a
+strong ETag and its real modification time, for the conditional GET.
+
+A file can have a gzip compressed sidecar next to it (e.g. site.css.gz for
+site.css) which is sent to clients accepting gzip. The sidecar gets the
+modification time of its source, so a sidecar with another modification time
+is stale and ignored. The sidecars can be generated when indexing (see
+precompress).
+"""
+
+import email.utils
+import hashlib
+import os
+import os.path
+import time
+import zlib
+from threading import RLock
+
+from suapp.logdecorator import *
+
+
+__all__ = ["StaticFile", "StaticFileCache"]
+
+
+class StaticFile:
+    """
+    A static file with its validators.
+
+    The content is None for large files: those are read from path.
+    """
+
+    __slots__ = ["path", "size", "mtime", "etag", "content", "gzip"]
+
+    def __init__(self, path, size, mtime, etag, content=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.content = content
+        # The StaticFile of the gzip sidecar, if any.
+        self.gzip = None
+
+    def not_modified(self, if_none_match=None, if_modified_since=None):
+        """
+        Returns True if the client's copy is still valid.
+
+        The If-None-Match takes precedence over If-Modified-Since.
+        """
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(",")]
+            return "*" in etags or self.etag in etags
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(self.mtime) <= since.timestamp()
+        return False
+
+
+class StaticFileCache:
+    """
+    Index of the static files under the root directory.
+
+    Only files in the directories (by default css, js and img) and the
+    files (by default favicon.ico) are served. Files up to max_size bytes
+    (256KiB by default) are kept in memory. The files are checked for changes
+    at most every rescan_interval seconds (2 by default).
+
+    With precompress the missing or stale gzip sidecars of the files with the
+    precompress_extensions (by default .css and .js) are (re)generated when
+    scanning.
+    """
+
+    @loguse
+    def __init__(
+        self,
+        root,
+        directories=None,
+        files=None,
+        max_size=None,
+        rescan_interval=None,
+        precompress=False,
+        precompress_extensions=None,
+    ):
+        if directories is None:
+            directories = ["css", "js", "img"]
+        if files is None:
+            files = ["favicon.ico"]
+        if max_size is None:
+            max_size = 256 * 1024
+        if rescan_interval is None:
+            rescan_interval = 2
+        if precompress_extensions is None:
+            precompress_extensions = [".css", ".js"]
+        self.root = root
+        self.directories = list(directories)
+        self.files = {}
+        self.top_files = list(files)
+        self.max_size = int(max_size)
+        self.rescan_interval = float(rescan_interval)
+        self.precompress = bool(precompress)
+        self.precompress_extensions = tuple(precompress_extensions)
+        self.last_scan = None
+        self.lock = RLock()
+
+    def load(self, path, size, mtime):
+        """
+        Returns the StaticFile for path.
+        """
+        if size <= self.max_size:
+            with open(path, "rb") as fh:
+                content = fh.read()
+            etag = '"%s"' % (hashlib.sha1(content).hexdigest())
+            return StaticFile(path, len(content), mtime, etag, content)
+        # Too big for memory: the size and mtime (in ns) as validator.
+        etag = '"%x-%x"' % (size, int(mtime * 1000000000))
+        return StaticFile(path, size, mtime, etag)
+
+    @loguse
+    def write_sidecar(self, static_file):
+        """
+        Writes the gzip sidecar of the static file.
+
+        The sidecar gets the same modification time as the file.
+        """
+        sidecar = static_file.path + ".gz"
+        with open(static_file.path, "rb") as fh:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            compressed = compressor.compress(fh.read()) + compressor.flush()
+        # Writing next to it and renaming, so no one reads half a file.
+        temporary = "%s.%s.tmp" % (sidecar, os.getpid())
+        with open(temporary, "wb") as fh:
+            fh.write(compressed)
+        os.utime(temporary, (static_file.mtime, static_file.mtime))
+        os.replace(temporary, sidecar)
+
+    def add_sidecar(self, static_file, old_sidecar=None):
+        """
+        Sets the gzip sidecar of the static file if there is a fresh one.
+        """
+        sidecar = static_file.path + ".gz"
+        try:
+            stat = os.stat(sidecar)
+        except OSError:
+            stat = None
+        if stat is None or stat.st_mtime != static_file.mtime:
+            # Missing or stale.
+            if not self.precompress or not static_file.path.endswith(
+                self.precompress_extensions
+            ):
+                static_file.gzip = None
+                return
+            try:
+                self.write_sidecar(static_file)
+                stat = os.stat(sidecar)
+            except OSError as err:
+                logging.getLogger(__name__).warning(
+                    "Could not write gzip sidecar %s: %s" % (sidecar, err)
+                )
+                static_file.gzip = None
+                return
+        if old_sidecar is not None:
+            if old_sidecar.mtime == stat.st_mtime and old_sidecar.size == stat.st_size:
+                static_file.gzip = old_sidecar
+                return
+        try:
+            static_file.gzip = self.load(sidecar, stat.st_size, stat.st_mtime)
+        except OSError:
+            static_file.gzip = None
+
+    def add(self, files, url, path):
+        """
+        Adds the file to the new index, reusing the old entry if unchanged.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        static_file = self.files.get(url)
+        old_sidecar = None
+        if static_file is not None:
+            old_sidecar = static_file.gzip
+            if static_file.mtime != stat.st_mtime or static_file.size != stat.st_size:
+                static_file = None
+        if static_file is None:
+            try:
+                static_file = self.load(path, stat.st_size, stat.st_mtime)
+            except OSError as err:
+                logging.getLogger(__name__).warning(
+                    "Could not read static file %s: %s" % (path, err)
+                )
+                return
+        self.add_sidecar(static_file, old_sidecar)
+        files[url] = static_file
+
+    @loguse
+    def scan(self):
+        """
+        (Re)indexes the static files.
+        """
+        files = {}
+        with self.lock:
+            for directory in self.directories:
+                top = os.path.join(self.root, directory)
+                for dirpath, dirnames, filenames in os.walk(top):
+                    for filename in filenames:
+                        if filename.endswith(".gz") and filename[:-3] in filenames:
+                            # Sidecars are served as variant of their file.
+                            continue
+                        if filename.endswith(".tmp"):
+                            continue
+                        path = os.path.join(dirpath, filename)
+                        url = "/" + os.path.relpath(path, self.root).replace(
+                            os.sep, "/"
+                        )
+                        self.add(files, url, path)
+            for filename in self.top_files:
+                self.add(files, "/" + filename, os.path.join(self.root, filename))
+            self.files = files
+            self.last_scan = time.monotonic()
+        return len(files)
+
+    # No @loguse as this is called for every static request.
+    def get(self, url):
+        """
+        Returns the StaticFile for the url path (without query) or None.
+        """
+        if self.last_scan is None:
+            self.scan()
+        elif time.monotonic() - self.last_scan >= self.rescan_interval:
+            # Only one thread rescans, the others use the current index.
+            if self.lock.acquire(blocking=False):
+                try:
+                    self.scan()
+                finally:
+                    self.lock.release()
+        return self.files.get(url)
+
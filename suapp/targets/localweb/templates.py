@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compiled html templates of the localweb target.
+
+A template is a string with %(name)s slots (and %% for a %), as for the %
+operator. Compiling it splits it once into its static segments and its
+slots, so rendering only puts the values in the slots and joins the list.
+
+The TemplateDirectory loads the templates from files. A file is compiled
+when first used and reloaded when it changed, but it is only checked for
+changes every check_interval seconds.
+"""
+
+import os.path
+import re
+import time
+
+from suapp.logdecorator import *
+
+
+__all__ = ["CompiledTemplate", "TemplateDirectory"]
+
+
+slot_pattern = re.compile(r"%\((\w+)\)s|%%")
+
+
+class CompiledTemplate:
+    """
+    A template split in static segments and slots.
+
+    The segments list has the static strings with None where a slot goes,
+    slots has (index in segments, name) for every slot.
+    """
+
+    __slots__ = ["segments", "slots"]
+
+    def __init__(self, template=""):
+        parts = []
+        position = 0
+        for match in slot_pattern.finditer(template):
+            parts.append((template[position : match.start()], None))
+            position = match.end()
+            if match.group(1) is None:
+                parts.append(("%", None))
+            else:
+                parts.append((None, match.group(1)))
+        parts.append((template[position:], None))
+        self.assemble(parts)
+
+    def assemble(self, parts):
+        """
+        Sets the segments and slots from the (static, None) and (None, name)
+        parts, joining the adjacent static ones.
+        """
+        self.segments = [""]
+        self.slots = []
+        for static, name in parts:
+            if name is None:
+                self.segments[-1] += static
+            else:
+                self.slots.append((len(self.segments), name))
+                self.segments.append(None)
+                self.segments.append("")
+
+    def parts(self):
+        """
+        Returns the (static, None) and (None, name) parts.
+        """
+        names = dict(self.slots)
+        return [
+            (segment, None) if segment is not None else (None, names[index])
+            for index, segment in enumerate(self.segments)
+        ]
+
+    def splice(self, name, template):
+        """
+        Returns a new CompiledTemplate with the template in the slots name.
+
+        The slots of template become slots of the new one.
+        """
+        parts = []
+        for part in self.parts():
+            if part[1] == name:
+                parts.extend(template.parts())
+            else:
+                parts.append(part)
+        spliced = CompiledTemplate()
+        spliced.assemble(parts)
+        return spliced
+
+    # No @loguse as this is called for every page.
+    def render(self, values):
+        """
+        Returns the template with the (str) values in the slots.
+        """
+        parts = list(self.segments)
+        for index, name in self.slots:
+            parts[index] = values[name]
+        return "".join(parts)
+
+
+class TemplateFile:
+    """
+    A compiled template file with its validators.
+
+    The template is None for a missing file.
+    """
+
+    __slots__ = ["template", "mtime", "size", "checked"]
+
+    def __init__(self, template, mtime, size, checked):
+        self.template = template
+        self.mtime = mtime
+        self.size = size
+        self.checked = checked
+
+
+class TemplateDirectory:
+    """
+    The templates in the root directory.
+
+    The files are checked for changes at most every check_interval seconds
+    (2 by default).
+    """
+
+    @loguse
+    def __init__(self, root, check_interval=None):
+        if check_interval is None:
+            check_interval = 2
+        self.root = os.path.abspath(root)
+        self.check_interval = float(check_interval)
+        self.files = {}
+
+    @loguse("@")  # Not logging the return value.
+    def load(self, name, now):
+        """
+        Returns the TemplateFile for name, (re)compiling it if it changed.
+        """
+        template_file = self.files.get(name)
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            # Not in the directory (e.g. ../).
+            return TemplateFile(None, None, None, now)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return TemplateFile(None, None, None, now)
+        if (
+            template_file is not None
+            and template_file.template is not None
+            and (template_file.mtime, template_file.size)
+            == (stat.st_mtime, stat.st_size)
+        ):
+            template_file.checked = now
+            return template_file
+        try:
+            with open(path, encoding="utf-8") as fh:
+                template = CompiledTemplate(fh.read())
+        except (OSError, UnicodeDecodeError) as err:
+            logging.getLogger(__name__).warning(
+                "Could not read template %s: %s" % (path, err)
+            )
+            return TemplateFile(None, None, None, now)
+        return TemplateFile(template, stat.st_mtime, stat.st_size, now)
+
+    # No @loguse as this is called for every page.
+    def get(self, name):
+        """
+        Returns the CompiledTemplate of the file name (relative to the root)
+        or None if there is no such file.
+        """
+        now = time.monotonic()
+        template_file = self.files.get(name)
+        if template_file is None or now - template_file.checked >= self.check_interval:
+            template_file = self.files[name] = self.load(name, now)
+        return template_file.template
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import http.client
+import os
+import socket
+import sys
+
+sys.path.append(os.getcwd())
+import suapp.targets.asyncweb as asyncweb
+import suapp.targets.localweb as localweb
+
+
+@pytest.fixture
+def async_server():
+    server = asyncweb.AsyncWebServer(("127.0.0.1", 0), workers=2)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    server.started.result(timeout=5)
+    yield server
+    thread.shutdown()
+
+
+def test_keep_alive(async_server):
+    connection = http.client.HTTPConnection(*async_server.server_address)
+    connection.request("GET", "/css/site.css")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert response.getheader("Content-Type").startswith("text/css")
+    body = response.read()
+    assert len(body) == int(response.getheader("Content-Length"))
+    sock = connection.sock
+    # Second request on the same connection.
+    connection.request("GET", "/")
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 403
+    assert connection.sock is sock
+    connection.close()
+
+
+def test_unknown_service(async_server):
+    connection = http.client.HTTPConnection(*async_server.server_address)
+    connection.request("GET", "/service/public/doesnotexist")
+    response = connection.getresponse()
+    assert response.status == 404
+    assert b"do_service_public_doesnotexist" in response.read()
+    connection.close()
+
+
+class BrokenHandler(asyncweb.AsyncWebHandler):
+    def handle_request(self):
+        raise RuntimeError("broken")
+
+
+def test_handler_error():
+    server = asyncweb.AsyncWebServer(("127.0.0.1", 0), BrokenHandler, workers=1)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    server.started.result(timeout=5)
+    try:
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request("GET", "/")
+        response = connection.getresponse()
+        assert response.status == 500
+        assert response.read() == b"Internal Server Error"
+        connection.close()
+    finally:
+        thread.shutdown()
+
+
+def request_head(server, content_length):
+    with socket.create_connection(server.server_address) as connection:
+        connection.sendall(
+            b"POST /service/public/logon HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Content-Length: %s\r\n\r\n" % (content_length)
+        )
+        return connection.makefile("rb").read()
+
+
+@pytest.mark.parametrize(
+    "content_length, status",
+    [(b"11", b"413"), (b"-1", b"400"), (b"ten", b"400")],
+)
+def test_body_size(content_length, status):
+    server = asyncweb.AsyncWebServer(("127.0.0.1", 0), workers=1, max_body_size=10)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    server.started.result(timeout=5)
+    try:
+        # Answered (and closed) without reading the body.
+        response = request_head(server, content_length)
+        assert response.startswith(b"HTTP/1.1 %s " % (status))
+        assert b"\r\nConnection: close\r\n" in response
+    finally:
+        thread.shutdown()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import base64
+import os
+import sys
+
+sys.path.append(os.getcwd())
+import suapp.jandw
+import suapp.targets.localweb as localweb
+
+
+class NumbersJeeves(suapp.jandw.Jeeves):
+    def do_query(self, name, scope=None, params=None):
+        if name == "broken":
+            return (1 / i for i in range(2, -1, -1))
+        return ({"n": i} for i in range(int(params.get("count", 10))))
+
+
+@pytest.fixture
+def server(request):
+    httpd_conf = getattr(request, "param", {})
+    httpd_conf.setdefault("workers", 2)
+    localweb.LocalWebHandler.configure(httpd_conf)
+    localweb.LocalWebHandler.metrics.reset()
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), localweb.LocalWebHandler, workers=httpd_conf["workers"]
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+    localweb.LocalWebHandler.configure({})
+
+
+@pytest.fixture
+def jeeves():
+    localweb.LocalWebHandler.jeeves = NumbersJeeves()
+    credentials = "user:%s" % (localweb.users["user"])
+    yield {
+        "Authorization": "Basic %s" % (base64.b64encode(credentials.encode()).decode())
+    }
+    localweb.LocalWebHandler.jeeves = None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import http.server
+import os
+import signal
+import sys
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+
+sys.path.append(os.getcwd())
+import suapp.targets.localweb as localweb
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.5)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"OK")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pooled_server():
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), SlowHandler, workers=4, max_queue=4
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+
+
+def test_pooled_server_concurrent(pooled_server):
+    url = "http://127.0.0.1:%s/" % (pooled_server.server_address[1])
+    results = []
+
+    def fetch():
+        with urllib.request.urlopen(url) as r:
+            results.append(r.read())
+
+    threads = [threading.Thread(target=fetch) for i in range(4)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Sequentially this would take at least 2 seconds.
+    assert time.time() - start < 1.5
+    assert results == [b"OK"] * 4
+
+
+def test_session_store_unique_ids():
+    store = localweb.SessionStore()
+    sessions = []
+
+    def create():
+        for i in range(100):
+            sessions.append(store.new().id)
+
+    threads = [threading.Thread(target=create) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(sessions)) == 400
+    assert len(store) == 400
+
+
+def test_session_store_evicts_lru():
+    store = localweb.SessionStore(max_sessions=3)
+    sessions = [store.new() for i in range(3)]
+    # Using the first makes the second the least recently used.
+    store[sessions[0].id]
+    store.new()
+    assert sessions[1].id not in store
+    assert sessions[0].id in store
+    assert store.stats()["evicted"] == 1
+    assert store.stats()["created"] == 4
+
+
+def test_session_store_reap():
+    store = localweb.SessionStore(timeout=60)
+    old = [store.new() for i in range(3)]
+    for session in old:
+        session["last-used"] -= 120
+    fresh = store.new()
+    # The sessions are in order of last use.
+    store[fresh.id]
+    assert store.reap() == 3
+    assert list(store) == [fresh.id]
+    assert store.stats()["expired"] == 3
+    with pytest.raises(KeyError):
+        store[old[0].id]
+
+
+def test_session_store_reaper():
+    store = localweb.SessionStore(timeout=60)
+    session = store.new()
+    session["last-used"] -= 120
+    store.start_reaper(0.05)
+    try:
+        time.sleep(0.5)
+        assert len(store) == 0
+    finally:
+        store.stop_reaper()
+
+
+class PidHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def prefork_server():
+    server = localweb.PreforkServer(
+        http.server.HTTPServer(("127.0.0.1", 0), PidHandler), processes=2
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def fetch_pid(server):
+    url = "http://127.0.0.1:%s/" % (server.server_address[1])
+    with urllib.request.urlopen(url, timeout=5) as r:
+        return int(r.read())
+
+
+def test_prefork_server(prefork_server):
+    pids = set(fetch_pid(prefork_server) for i in range(20))
+    assert os.getpid() not in pids
+    assert pids <= set(prefork_server.children)
+
+
+def test_prefork_server_restarts(prefork_server):
+    pid = fetch_pid(prefork_server)
+    os.kill(pid, signal.SIGKILL)
+    for i in range(50):
+        time.sleep(0.1)
+        if pid not in prefork_server.children and len(prefork_server.children) == 2:
+            break
+    assert pid not in prefork_server.children
+    assert len(prefork_server.children) == 2
+    assert fetch_pid(prefork_server) != pid
+
+
+def test_admission_control():
+    admission = localweb.AdmissionControl(1, max_queue_wait=0.1)
+    assert admission.admit()
+    start = time.time()
+    assert not admission.admit()
+    assert time.time() - start >= 0.1
+    admission.release()
+    assert admission.admit()
+    stats = admission.stats()
+    assert (stats["in_flight"], stats["admitted"], stats["rejected"]) == (1, 2, 1)
+    assert localweb.AdmissionControl().admit()
+
+
+def test_pooled_server_shed_load():
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), SlowHandler, workers=1, max_queue=0, shed_load=True
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    url = "http://127.0.0.1:%s/" % (server.server_address[1])
+    statuses = []
+
+    def fetch():
+        try:
+            with urllib.request.urlopen(url) as r:
+                statuses.append(r.status)
+        except urllib.error.HTTPError as e:
+            statuses.append((e.code, e.headers["Retry-After"]))
+
+    try:
+        threads = [threading.Thread(target=fetch) for i in range(3)]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        for t in threads:
+            t.join()
+    finally:
+        thread.shutdown()
+    assert sorted(statuses, key=str) == [(503, "5"), (503, "5"), 200]
+    assert server.shed == 2
+
+
+def test_processes_need_session_file():
+    app = types.SimpleNamespace(configuration={"httpd": {"processes": 2}})
+    with pytest.raises(ValueError):
+        localweb.Application().inflow(types.SimpleNamespace(app=app), None)
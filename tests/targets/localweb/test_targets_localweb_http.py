@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import hashlib
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+sys.path.append(os.getcwd())
+import suapp.jandw
+import suapp.targets.localweb as localweb
+
+
+@pytest.mark.parametrize(
+    "server", [{"keep_alive": True, "keep_alive_max": 3}], indirect=True
+)
+def test_keep_alive(server):
+    connection = http.client.HTTPConnection(*server.server_address)
+    socks = []
+    for i in range(3):
+        connection.request("GET", "/css/site.css")
+        response = connection.getresponse()
+        body = response.read()
+        assert response.status == 200
+        assert len(body) == int(response.getheader("Content-Length"))
+        socks.append(connection.sock)
+    assert socks[0] is socks[1]
+    # The third request reached the maximum.
+    assert response.getheader("Connection") == "close"
+    connection.close()
+
+
+def test_no_keep_alive(server):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/")
+    response = connection.getresponse()
+    body = response.read()
+    assert response.status == 403
+    assert response.version == 10
+    assert len(body) == int(response.getheader("Content-Length"))
+    connection.close()
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, None),
+        ("", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip", "gzip"),
+        ("gzip;q=0.5, deflate", "deflate"),
+        ("gzip;q=0, br", None),
+        ("*", "gzip"),
+        ("*;q=0.1, gzip;q=0", "deflate"),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    assert localweb.negotiate_encoding(accept_encoding) == expected
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+def test_compressed_page(server, encoding):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/", headers={"Accept-Encoding": encoding})
+    response = connection.getresponse()
+    body = response.read()
+    assert response.getheader("Content-Encoding") == encoding
+    assert response.getheader("Vary") == "Accept-Encoding"
+    assert len(body) == int(response.getheader("Content-Length"))
+    html = zlib.decompress(body, 31 if encoding == "gzip" else 15)
+    assert b"</html>" in html
+    connection.close()
+
+
+def test_json_stream_query():
+    body = "".join(localweb.json_stream_query({"n": i} for i in range(3)))
+    assert json.loads(body) == {
+        "result": True,
+        "objects": [{"n": 0}, {"n": 1}, {"n": 2}],
+        "module": "builtins",
+        "table": "dict",
+    }
+    body = "".join(localweb.json_stream_query(1 / i for i in range(1, -1, -1)))
+    result = json.loads(body)
+    assert result["result"] is False
+    assert result["objects"] == [1.0]
+    assert "division by zero" in result["message"]
+
+
+@pytest.mark.parametrize(
+    "server",
+    [
+        {"keep_alive": True, "stream_chunk_size": 100},
+        {"stream_queries": True, "stream_chunk_size": 100},
+    ],
+    indirect=True,
+)
+def test_stream_query(server, jeeves):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "GET", "/service/query/numbers?count=1000&stream", headers=jeeves
+    )
+    response = connection.getresponse()
+    body = response.read()
+    assert response.status == 200
+    assert response.getheader("Content-Length") is None
+    if response.version == 11:
+        assert response.getheader("Transfer-Encoding") == "chunked"
+    else:
+        # No chunked transfer encoding on HTTP/1.0: until the connection closes.
+        assert response.getheader("Transfer-Encoding") is None
+    result = json.loads(body)
+    assert result["result"] is True
+    assert result["objects"] == [{"n": i} for i in range(1000)]
+    connection.close()
+
+
+@pytest.mark.parametrize("server", [{"keep_alive": True}], indirect=True)
+def test_stream_query_compressed(server, jeeves):
+    jeeves["Accept-Encoding"] = "gzip"
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "GET", "/service/query/numbers?count=1000&stream", headers=jeeves
+    )
+    response = connection.getresponse()
+    body = zlib.decompress(response.read(), 31)
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert len(json.loads(body)["objects"]) == 1000
+    # The connection is still usable after the chunked response.
+    connection.request("GET", "/service/query/broken?stream", headers=jeeves)
+    response = connection.getresponse()
+    result = json.loads(zlib.decompress(response.read(), 31))
+    assert result["result"] is False
+    assert result["objects"] == [0.5, 1.0]
+    connection.close()
+
+
+@pytest.mark.parametrize("path", ["/health", "/css/site.css", "/", "/img/x.png"])
+def test_no_session(server, path):
+    created = localweb.LocalWebHandler.sessions.stats()["created"]
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    body = response.read()
+    assert response.getheader("Set-Cookie") is None
+    assert localweb.LocalWebHandler.sessions.stats()["created"] == created
+    if path == "/health":
+        assert response.status == 200
+        assert json.loads(body) == {"result": True, "status": "ok"}
+    connection.close()
+
+
+def test_session_on_logon(server, jeeves):
+    created = localweb.LocalWebHandler.sessions.stats()["created"]
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/who", headers=jeeves)
+    response = connection.getresponse()
+    assert json.loads(response.read())["userid"] == "user"
+    cookie = response.getheader("Set-Cookie").split(";", 1)[0]
+    assert localweb.LocalWebHandler.sessions.stats()["created"] == created + 1
+    connection.close()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/who", headers={"Cookie": cookie})
+    response = connection.getresponse()
+    assert json.loads(response.read())["userid"] == "user"
+    assert localweb.LocalWebHandler.sessions.stats()["created"] == created + 1
+    connection.close()
+
+
+@localweb.service("/service/public/test/slow")
+def slow(handler, session, fields, json_object):
+    time.sleep(0.5)
+    return (200, localweb.json_mime, {"result": True})
+
+
+@pytest.mark.parametrize(
+    "server", [{"workers": 3, "max_in_flight": 1, "max_queue_wait": 0.1}], indirect=True
+)
+def test_admission_control(server):
+    statuses = []
+
+    def fetch():
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request("GET", "/service/public/test/slow")
+        response = connection.getresponse()
+        response.read()
+        statuses.append((response.status, response.getheader("Retry-After")))
+        connection.close()
+
+    first = threading.Thread(target=fetch)
+    first.start()
+    time.sleep(0.1)
+    fetch()
+    # The cheap routes are not limited.
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/health")
+    assert connection.getresponse().status == 200
+    connection.close()
+    first.join()
+    assert statuses == [(503, "5"), (200, None)]
+    assert localweb.LocalWebHandler.admission.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_batch(server, jeeves, parallel):
+    requests = [
+        {"id": "numbers", "service": "query/numbers", "params": {"count": 3}},
+        {"service": "who"},
+        {"id": "missing", "service": "no/such/service"},
+        {"id": "nested", "service": "batch"},
+        {"id": "admin", "service": "admin/sessions"},
+    ]
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "POST",
+        "/service/batch",
+        body=json.dumps({"requests": requests, "parallel": parallel}),
+        headers=dict(jeeves, **{"Content-Type": "application/json"}),
+    )
+    response = connection.getresponse()
+    assert response.status == 200
+    result = json.loads(response.read())
+    connection.close()
+    assert result["result"] is True
+    responses = result["responses"]
+    assert sorted(responses) == ["1", "admin", "missing", "nested", "numbers"]
+    assert responses["numbers"]["status"] == 200
+    assert responses["numbers"]["body"]["objects"] == [{"n": 0}, {"n": 1}, {"n": 2}]
+    assert responses["1"]["body"]["userid"] == "user"
+    assert responses["missing"]["status"] == 404
+    assert responses["nested"]["status"] == 400
+    assert responses["admin"]["status"] == 403
+
+
+@pytest.mark.parametrize("server", [{"batch_max": 2}], indirect=True)
+def test_batch_invalid(server, jeeves):
+    for body in ['{"requests": 1}', "[1, 2]", json.dumps([{"service": "who"}] * 3)]:
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request(
+            "POST",
+            "/service/batch",
+            body=body,
+            headers=dict(jeeves, **{"Content-Type": "application/json"}),
+        )
+        response = connection.getresponse()
+        assert response.status == 400
+        assert json.loads(response.read())["result"] is False
+        connection.close()
+
+
+class BatchHandler(localweb.LocalWebHandler):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def do_service_public_test_mark(self, session, fields, json_object):
+        mark = fields["mark"][-1]
+        self.current_query = mark
+        session[mark] = True
+        if "wait" in fields:
+            # Both sub-requests have written their mark now.
+            self.barrier.wait()
+        marks = sorted(key for key in ("a", "b", "c") if key in session)
+        return (
+            200,
+            localweb.json_mime,
+            {"result": True, "mark": self.current_query, "marks": marks},
+        )
+
+
+@pytest.fixture
+def batch_server(jeeves):
+    localweb.LocalWebHandler.configure({"batch_workers": 2})
+    server = localweb.PooledHTTPServer(("127.0.0.1", 0), BatchHandler, workers=2)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+    localweb.LocalWebHandler.configure({})
+
+
+def batch(server, headers, requests, parallel):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "POST",
+        "/service/batch",
+        body=json.dumps({"requests": requests, "parallel": parallel}),
+        headers=dict(headers, **{"Content-Type": "application/json"}),
+    )
+    response = connection.getresponse()
+    result = json.loads(response.read())
+    connection.close()
+    return (response, result["responses"])
+
+
+def test_batch_parallel_state(batch_server, jeeves):
+    requests = [
+        {"id": mark, "service": "public/test/mark", "params": {"mark": mark, "wait": 1}}
+        for mark in ("a", "b")
+    ]
+    (response, responses) = batch(batch_server, jeeves, requests, True)
+    # Each sub-request only sees its own request state and session changes.
+    assert responses["a"]["body"] == {"result": True, "mark": "a", "marks": ["a"]}
+    assert responses["b"]["body"] == {"result": True, "mark": "b", "marks": ["b"]}
+    # Which are merged into the session afterwards.
+    headers = dict(jeeves, Cookie=response.getheader("Set-Cookie").split(";", 1)[0])
+    requests = [{"id": "c", "service": "public/test/mark", "params": {"mark": "c"}}]
+    (response, responses) = batch(batch_server, headers, requests, False)
+    assert responses["c"]["body"]["marks"] == ["a", "b", "c"]
+
+
+def get(server, path, headers):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", path, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return (response, body)
+
+
+class ChangingJeeves(suapp.jandw.Jeeves):
+    def __init__(self):
+        super().__init__()
+        self.first = 0
+
+    def do_query(self, name, scope=None, params=None):
+        count = int(params.get("count", 10))
+        return ({"n": i} for i in range(self.first, self.first + count))
+
+
+def test_etag_query(server, jeeves):
+    localweb.LocalWebHandler.jeeves = changing = ChangingJeeves()
+    (response, body) = get(server, "/service/query/numbers?count=3", jeeves)
+    etag = response.getheader("ETag")
+    assert response.status == 200
+    assert etag == 'W/"%s"' % (hashlib.sha1(body).hexdigest())
+    assert response.getheader("Cache-Control") == "no-cache"
+    (response, body) = get(
+        server,
+        "/service/query/numbers?count=3",
+        dict(jeeves, **{"If-None-Match": '"other", %s' % (etag[2:])}),
+    )
+    assert response.status == 304
+    assert body == b""
+    assert response.getheader("ETag") == etag
+    # Other parameters.
+    (response, body) = get(
+        server,
+        "/service/query/numbers?count=4",
+        dict(jeeves, **{"If-None-Match": etag}),
+    )
+    assert response.status == 200
+    # Changed data (e.g. by another process) changes the ETag.
+    changing.first = 1
+    (response, body) = get(
+        server,
+        "/service/query/numbers?count=3",
+        dict(jeeves, **{"If-None-Match": etag}),
+    )
+    assert response.status == 200
+    assert response.getheader("ETag") != etag
+
+
+def test_etag_hash(server, jeeves):
+    (response, body) = get(server, "/service/who", jeeves)
+    etag = response.getheader("ETag")
+    assert etag == 'W/"%s"' % (hashlib.sha1(body).hexdigest())
+    (response, body) = get(
+        server, "/service/who", dict(jeeves, **{"If-None-Match": etag})
+    )
+    assert response.status == 304
+
+
+def test_etag_compressed(server, jeeves):
+    path = "/service/query/numbers?count=500"
+    (response, body) = get(server, path, dict(jeeves, **{"Accept-Encoding": "gzip"}))
+    assert response.getheader("Content-Encoding") == "gzip"
+    etag = response.getheader("ETag")
+    # Weak: the uncompressed json has other bytes.
+    assert etag == 'W/"%s"' % (hashlib.sha1(zlib.decompress(body, 31)).hexdigest())
+    (response, body) = get(server, path, jeeves)
+    assert response.getheader("Content-Encoding") is None
+    assert response.getheader("ETag") == etag
+    (response, body) = get(server, path, dict(jeeves, **{"If-None-Match": etag}))
+    assert response.status == 304
+    assert response.getheader("Vary") == "Accept-Encoding"
+
+
+@pytest.mark.parametrize("server", [{"etags": False}], indirect=True)
+def test_no_etags(server, jeeves):
+    (response, body) = get(server, "/service/who", jeeves)
+    assert response.getheader("ETag") is None
+
+
+@pytest.mark.parametrize(
+    "fields, expected",
+    [
+        ({}, None),
+        ({"fields": [""]}, []),
+        ({"fields": ["code, name"]}, ["code", "name"]),
+        ({"fields": ["code", "_pk_,name"]}, ["code", "_pk_", "name"]),
+    ],
+)
+def test_field_projection(fields, expected):
+    assert localweb.field_projection(fields) == expected
+
+
+@pytest.mark.parametrize(
+    "server",
+    [{"workers": 1, "keep_alive": True, "keep_alive_timeout": 15}],
+    indirect=True,
+)
+def test_idle_keep_alive_gives_worker_back(server):
+    idle = http.client.HTTPConnection(*server.server_address)
+    idle.request("GET", "/css/site.css")
+    response = idle.getresponse()
+    response.read()
+    assert response.getheader("Connection") is None
+    # The only worker is held by the idle connection.
+    start = time.monotonic()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/health")
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 200
+    assert time.monotonic() - start < 5
+    connection.close()
+    # The idle connection was closed.
+    assert idle.sock.recv(1) == b""
+    idle.close()
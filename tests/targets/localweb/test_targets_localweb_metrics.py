@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import base64
+import http.client
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.getcwd())
+import suapp.targets.localweb as localweb
+from suapp.targets.localweb.metrics import MetricsRegistry
+
+
+def test_registry():
+    metrics = MetricsRegistry(buckets=(0.1, 1))
+    metrics.observe("route", "/", 200, 0.05, 10)
+    metrics.observe("route", "/", 200, 0.5, 20)
+    metrics.observe("route", "/", 404, 5, 30)
+    assert metrics.snapshot() == {
+        "route": {
+            "/": {
+                "count": 3,
+                "sum": 5.55,
+                "buckets": [[0.1, 1], [1, 2], ["+Inf", 3]],
+                "codes": {"200": 2, "404": 1},
+                "size": 60,
+            }
+        }
+    }
+    text = metrics.to_prometheus()
+    assert (
+        'suapp_request_duration_seconds_bucket{kind="route",name="/",le="1"} 2' in text
+    )
+    assert 'suapp_responses_total{kind="route",name="/",code="404"} 1' in text
+    assert 'suapp_response_bytes_total{kind="route",name="/"} 60' in text
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_registry_threads():
+    metrics = MetricsRegistry()
+
+    def observe():
+        for i in range(1000):
+            metrics.observe("query", "q", 200, 0.001, 1)
+
+    threads = [threading.Thread(target=observe) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert metrics.snapshot()["query"]["q"]["count"] == 4000
+
+
+def recorded(path, count):
+    """
+    Waits until count responses of path are recorded.
+
+    They are recorded after the response is sent, so the client can be first.
+    """
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        route = localweb.LocalWebHandler.metrics.snapshot().get("route", {})
+        if route.get(path, {}).get("count", 0) >= count:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_metrics_service(server):
+    credentials = "admin:%s" % (localweb.users["admin"])
+    headers = {
+        "Authorization": "Basic %s" % (base64.b64encode(credentials.encode()).decode())
+    }
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/health")
+    connection.getresponse().read()
+    connection.close()
+    assert recorded("/health", 1)
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/admin/metrics", headers=headers)
+    response = connection.getresponse()
+    metrics = json.loads(response.read())["metrics"]
+    assert metrics["route"]["/health"]["codes"] == {"200": 1}
+    connection.close()
+    assert recorded("/service/admin/metrics", 1)
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "GET", "/service/admin/metrics?format=prometheus", headers=headers
+    )
+    response = connection.getresponse()
+    assert response.getheader("Content-type").startswith("text/plain")
+    text = response.read().decode()
+    assert (
+        'suapp_responses_total{kind="route",name="/service/admin/metrics",code="200"} 1'
+        in text
+    )
+    connection.close()
+
+
+def test_metrics_admin_only(server):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/admin/metrics")
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 403
+    connection.close()
+
+
+def test_query_metrics(server, jeeves):
+    localweb.LocalWebHandler.jeeves.queries = {"numbers": (None, {})}
+    for path in ("numbers", "x1", "x2"):
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request("GET", "/service/query/%s" % (path), headers=jeeves)
+        connection.getresponse().read()
+        connection.close()
+    assert recorded("/service/query/", 3)
+    queries = localweb.LocalWebHandler.metrics.snapshot()["query"]
+    # Not a metric per path.
+    assert sorted(queries) == ["numbers", "unknown"]
+    assert queries["unknown"]["count"] == 2
+
+
+def test_unmatched_metrics(server):
+    with socket.create_connection(server.server_address) as connection:
+        connection.sendall(b"GARBAGE\r\n\r\n")
+        # Answered without a status line as HTTP/0.9.
+        assert b"Bad request syntax" in connection.makefile("rb").read()
+    assert recorded("unmatched", 1)
+    credentials = "admin:%s" % (localweb.users["admin"])
+    headers = {
+        "Authorization": "Basic %s" % (base64.b64encode(credentials.encode()).decode())
+    }
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/admin/metrics", headers=headers)
+    response = connection.getresponse()
+    metrics = json.loads(response.read())["metrics"]
+    assert metrics["route"]["unmatched"]["codes"] == {"400": 1}
+    connection.close()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "GET", "/service/admin/metrics?format=prometheus", headers=headers
+    )
+    response = connection.getresponse()
+    assert response.status == 200
+    text = response.read().decode()
+    assert 'suapp_responses_total{kind="route",name="unmatched",code="400"} 1' in text
+    connection.close()
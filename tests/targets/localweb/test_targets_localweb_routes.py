@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import http.client
+import json
+import os
+import sys
+
+sys.path.append(os.getcwd())
+import suapp.targets.localweb as localweb
+from suapp.targets.localweb.routes import Route, RouteTable
+
+
+def test_route_table_find():
+    routes = RouteTable()
+    routes.add(Route("/service/admin/sessions", "do_service_admin_sessions"))
+    routes.add(Route("/service/query/", "do_service_query"))
+    routes.add(Route("/service/", "do_service_not_found"))
+    routes.add(Route("/", "do_page"))
+    (route, rest) = routes.find("/service/admin_sessions")
+    assert route.handler == "do_service_admin_sessions"
+    (route, rest) = routes.find("/service/Admin/Sessions")
+    assert route.handler == "do_service_admin_sessions"
+    (route, rest) = routes.find("/service/query/mymodule.items")
+    assert (route.handler, rest) == ("do_service_query", "mymodule.items")
+    (route, rest) = routes.find("/service/does/not/exist")
+    assert (route.handler, rest) == ("do_service_not_found", "does/not/exist")
+    (route, rest) = routes.find("/index.html")
+    assert (route.handler, rest) == ("do_page", "index.html")
+    assert RouteTable().find("/index.html") == (None, "/index.html")
+
+
+def test_handler_routes():
+    routes = localweb.LocalWebHandler.routes
+    (route, rest) = routes.find("/service/public/logon")
+    assert route.handler == "do_service_public_logon"
+    (route, rest) = routes.find("/img/logo.png")
+    assert route.static and route.mime is None and rest == "logo.png"
+    (route, rest) = routes.find("/favicon.ico")
+    assert route.static and route.mime == "image/x-icon"
+
+
+class EchoHandler(localweb.LocalWebHandler):
+    def do_service_public_test_hello(self, session, fields, json_object):
+        return (200, localweb.json_mime, {"result": True})
+
+
+@localweb.service("/service/public/test/echo", handler_class=EchoHandler)
+def echo(handler, session, fields, json_object):
+    return (200, localweb.json_mime, {"result": True, "fields": fields})
+
+
+def test_subclass_routes():
+    (route, rest) = EchoHandler.routes.find("/service/public/test/echo")
+    assert route.handler is echo
+    (route, rest) = EchoHandler.routes.find("/service/public/test/hello")
+    assert route.handler == "do_service_public_test_hello"
+    # Not on the LocalWebHandler.
+    (route, rest) = localweb.LocalWebHandler.routes.find("/service/public/test/echo")
+    assert route.handler == "do_service_not_found"
+    (route, rest) = localweb.LocalWebHandler.routes.find("/service/public/test/hello")
+    assert route.handler == "do_service_not_found"
+    # The routes of the parent added later are seen by the subclass.
+    table = RouteTable()
+    child = table.child()
+    table.add(Route("/later", "do_later"))
+    assert child.find("/later")[0].handler == "do_later"
+
+
+@pytest.fixture
+def server():
+    server = localweb.PooledHTTPServer(("127.0.0.1", 0), EchoHandler, workers=2)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+
+
+def test_service(server):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/service/public/test/echo?a=1")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {"result": True, "fields": {"a": ["1"]}}
+    connection.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+import suapp.jandw
+import suapp.targets.localweb as localweb
+from suapp.targets.localweb.sessions import SQLiteSessionBackend
+
+
+@pytest.fixture
+def session_file(tmp_path):
+    return str(tmp_path / "sessions.sqlite")
+
+
+def store(session_file, jeeves="jeeves", **kwargs):
+    result = localweb.SessionStore(backend=SQLiteSessionBackend(session_file), **kwargs)
+    result.rehydrate["jeeves"] = lambda session: jeeves
+    result.rehydrate["drone"] = localweb.rehydrate_drone
+    return result
+
+
+def test_backend(session_file):
+    backend = SQLiteSessionBackend(session_file)
+    assert backend.load("x") is None
+    assert backend.save("x", {"userid": "admin"}, 10.0) == 1
+    assert backend.save("x", {"userid": "user"}, 20.0) == 2
+    assert backend.load("x") == ({"userid": "user"}, 20.0, 2)
+    backend.touch("x", 30.0)
+    assert backend.load("x")[1] == 30.0
+    assert backend.expire(25.0) == 0
+    assert backend.expire(35.0) == 1
+    assert backend.load("x") is None
+
+
+def test_shared_sessions(session_file):
+    first = store(session_file)
+    second = store(session_file)
+    session = first.new(jeeves=object())
+    session["userid"] = "admin"
+    first.save(session)
+    # The other process (store) loads it and rehydrates the jeeves.
+    shared = second[session.id]
+    assert shared is not session
+    assert shared["userid"] == "admin"
+    assert shared["jeeves"] == "jeeves"
+    assert "drone" not in shared
+    # Changes are seen by the other.
+    shared["userid"] = "user"
+    second.save(shared)
+    assert first[session.id]["userid"] == "user"
+    # As is logging off.
+    del second[session.id]
+    with pytest.raises(KeyError):
+        first[session.id]
+
+
+def test_restart(session_file):
+    session = store(session_file).new(jeeves=object(), userid="admin")
+    assert store(session_file)[session.id]["userid"] == "admin"
+
+
+def test_evicted_session_reloaded(session_file):
+    sessions = store(session_file, max_sessions=1)
+    first = sessions.new(userid="admin")
+    sessions.new()
+    assert sessions.stats()["evicted"] == 1
+    assert sessions[first.id]["userid"] == "admin"
+
+
+def test_expired(session_file):
+    sessions = store(session_file, timeout=60)
+    session = sessions.new()
+    sessions.backend.touch(session.id, time.time() - 120)
+    dict.__setitem__(session, "last-used", time.time() - 120)
+    with pytest.raises(KeyError):
+        sessions[session.id]
+    assert sessions.backend.load(session.id) is None
+
+
+def test_reap_keeps_shared_session(session_file):
+    first = store(session_file, timeout=60)
+    second = store(session_file, timeout=60)
+    session = first.new(userid="admin")
+    # Not used by the first for a while, but still by the second.
+    dict.__setitem__(session, "last-used", time.time() - 120)
+    assert second[session.id]["userid"] == "admin"
+    assert first.reap() == 0
+    assert session.id not in first
+    assert first.stats()["evicted"] == 1
+    assert first[session.id]["userid"] == "admin"
+    # Once expired in the backend it is removed from there.
+    second.backend.touch(session.id, time.time() - 120)
+    assert second.reap() == 1
+    assert second.backend.load(session.id) is None
+
+
+def test_shared_drone(session_file):
+    jeeves = suapp.jandw.Jeeves()
+    jeeves.flow = {"": {"TABLE": suapp.jandw.Drone("TABLE", "table vertex")}}
+    first = store(session_file, jeeves=jeeves)
+    second = store(session_file, jeeves=jeeves)
+    session = first.new()
+    dataobject = {"session": session, "params": {"OUT": ["TABLE"]}}
+    session["drone"] = jeeves.whichDrone("", "TABLE").get_new_instance_clone(
+        dataobject, jeeves.MODE_MODAL
+    )
+    dataobject["tables"] = {"test": {"ID": "testid"}}
+    first.save(session)
+    # The other process clones the drone again with the same dataobject.
+    shared = second[session.id]
+    drone = shared["drone"]
+    assert drone is not session["drone"]
+    assert (drone.name, drone.tovertex, drone.mode) == (
+        "TABLE",
+        "table vertex",
+        jeeves.MODE_MODAL,
+    )
+    assert drone.dataobject["session"] is shared
+    assert drone.dataobject["params"] == {"OUT": ["TABLE"]}
+    assert drone.dataobject["tables"] == {"test": {"ID": "testid"}}
+
+
+def test_fork_merge():
+    session = localweb.Session("x")
+    dict.update(session, {"userid": "admin", "a": 1, "b": 2})
+    first = session.fork()
+    second = session.fork()
+    first["a"] = 10
+    del first["b"]
+    second["c"] = 3
+    assert dict(session) == {"userid": "admin", "a": 1, "b": 2}
+    session.merge(first)
+    session.merge(second)
+    assert dict(session) == {"userid": "admin", "a": 10, "c": 3}
+    assert session.dirty
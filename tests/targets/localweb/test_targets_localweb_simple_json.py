@@ -6,6 +6,8 @@ import json
 import os
 import sys
 
+import pony.orm
+
 sys.path.append(os.getcwd())
 import suapp.orm
 import suapp.simple_json as simple_json
@@ -75,3 +77,110 @@ def test_dict_with_orm_objects_indented():
 def test_no_serializable():
     with pytest.raises(TypeError):
         simple_json.dumps(UnSerializableSomething())
+
+
+def test_orm_objects_fields():
+    assert json.loads(simple_json.dumps(x_orm, fields=[])) == {
+        "0": {"_pk_": "zero"},
+        "1": {"_pk_": "one"},
+        "2": {"_pk_": "two"},
+    }
+    assert json.loads(simple_json.dumps(x_orm[0], fields=["name", "other"])) == {
+        "_pk_": "zero",
+        "name": "zero",
+    }
+
+
+def test_entity_fields():
+    db = pony.orm.Database()
+
+    class Document(db.Entity):
+        code = pony.orm.Required(str)
+        text = pony.orm.Optional(pony.orm.LongStr, lazy=True)
+
+    db.bind("sqlite", ":memory:")
+    db.generate_mapping(create_tables=True)
+    with pony.orm.db_session:
+        Document(code="a", text="long " * 1000)
+    with pony.orm.db_session:
+        documents = list(Document.select())
+        assert json.loads(simple_json.dumps(documents, fields=["code"])) == [
+            {"_pk_": 1, "code": "a"}
+        ]
+        # The lazy column was not loaded.
+        assert Document.text not in documents[0]._vals_
+        assert "text" in json.loads(simple_json.dumps(documents))[0]
+        assert Document.text in documents[0]._vals_
+
+
+def test_compiled_serializers():
+    db = pony.orm.Database()
+
+    class Parent(db.Entity):
+        name = pony.orm.Required(str)
+        children = pony.orm.Set("Child")
+
+    class Child(db.Entity):
+        parent = pony.orm.Required(Parent)
+        number = pony.orm.Required(int)
+        pony.orm.PrimaryKey(parent, number)
+
+    db.bind("sqlite", ":memory:")
+    db.generate_mapping(create_tables=True)
+    with pony.orm.db_session:
+        parent = Parent(name="p")
+        for i in range(3):
+            Child(parent=parent, number=i)
+    simple_json.serializers.clear()
+    with pony.orm.db_session:
+        assert json.loads(simple_json.dumps(list(Parent.select()))) == [
+            {"id": 1, "name": "p", "children": {}, "_pk_": 1}
+        ]
+        assert json.loads(simple_json.dumps(list(Child.select()))) == [
+            {"parent": 1, "number": i, "_pk_": [1, i]} for i in range(3)
+        ]
+        assert json.loads(simple_json.dumps(list(Child.select()), fields=["x"])) == [
+            {"_pk_": [1, i]} for i in range(3)
+        ]
+    # Once per class (and fields), not per object.
+    assert len(simple_json.serializers) == 3
+
+
+def test_ui_orm_overrides():
+    db = pony.orm.Database()
+
+    class Person(db.Entity):
+        name = pony.orm.Required(str)
+        secret = pony.orm.Optional(str)
+        age = pony.orm.Optional(int)
+
+    class UiPerson(suapp.orm.UiOrmObject):
+        # Overriding the columns of the entity.
+        secret = "hidden"
+
+        def __init__(self, orm=None):
+            self._ui_orm = orm
+            self.ui_init()
+
+        @property
+        def name(self):
+            return self._ui_orm.name.upper()
+
+    db.bind("sqlite", ":memory:")
+    db.generate_mapping(create_tables=True)
+    simple_json.serializers.clear()
+    with pony.orm.db_session:
+        Person(name="jan peeters", secret="s3cret", age=42)
+    with pony.orm.db_session:
+        person = UiPerson(Person[1])
+        assert json.loads(simple_json.dumps(person)) == {
+            "id": 1,
+            "name": "JAN PEETERS",
+            "secret": "hidden",
+            "age": 42,
+            "_pk_": 1,
+        }
+        assert json.loads(simple_json.dumps(person, fields=["name"])) == {
+            "name": "JAN PEETERS",
+            "_pk_": 1,
+        }
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import email.utils
+import http.client
+import os
+import sys
+import time
+import zlib
+
+sys.path.append(os.getcwd())
+import suapp.targets.localweb as localweb
+from suapp.targets.localweb.static import StaticFileCache
+
+
+@pytest.fixture
+def static_root(tmpdir):
+    tmpdir.mkdir("css").join("small.css").write("body {}")
+    tmpdir.mkdir("js").join("large.js").write("x" * 100)
+    tmpdir.join("favicon.ico").write("ico")
+    tmpdir.join("secret.txt").write("secret")
+    return tmpdir
+
+
+def test_static_file_cache(static_root):
+    cache = StaticFileCache(str(static_root), max_size=50, rescan_interval=0)
+    small = cache.get("/css/small.css")
+    assert small.content == b"body {}"
+    assert small.mtime == os.stat(str(static_root.join("css", "small.css"))).st_mtime
+    large = cache.get("/js/large.js")
+    assert large.content is None
+    assert large.size == 100
+    assert cache.get("/favicon.ico").content == b"ico"
+    assert cache.get("/secret.txt") is None
+    assert cache.get("/css/../secret.txt") is None
+    # Changing a file gives a new ETag.
+    etag = small.etag
+    static_root.join("css", "small.css").write("body { margin: 0 }")
+    os.utime(str(static_root.join("css", "small.css")), (1, 1))
+    assert cache.get("/css/small.css").etag != etag
+    assert cache.get("/css/small.css").content == b"body { margin: 0 }"
+
+
+def test_not_modified(static_root):
+    cache = StaticFileCache(str(static_root))
+    small = cache.get("/css/small.css")
+    assert small.not_modified(if_none_match=small.etag)
+    assert small.not_modified(if_none_match='"other", %s' % (small.etag))
+    assert not small.not_modified(if_none_match='"other"')
+    assert small.not_modified(
+        if_modified_since=email.utils.formatdate(small.mtime + 10, usegmt=True)
+    )
+    assert not small.not_modified(
+        if_modified_since=email.utils.formatdate(small.mtime - 10, usegmt=True)
+    )
+    assert not small.not_modified(if_modified_since="garbage")
+
+
+@pytest.fixture(params=[{}, {"static_max_size": 10}])
+def server(request):
+    localweb.LocalWebHandler.configure(request.param)
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), localweb.LocalWebHandler, workers=2
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+    localweb.LocalWebHandler.configure({})
+
+
+def test_static_validators(server):
+    path = os.path.join(os.path.dirname(localweb.__file__), "css", "site.css")
+    with open(path, "rb") as fh:
+        content = fh.read()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/css/site.css")
+    response = connection.getresponse()
+    assert response.read() == content
+    etag = response.getheader("ETag")
+    last_modified = response.getheader("Last-Modified")
+    assert last_modified == email.utils.formatdate(
+        int(os.stat(path).st_mtime), usegmt=True
+    )
+    connection.close()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/css/site.css", headers={"If-None-Match": etag})
+    response = connection.getresponse()
+    assert response.status == 304
+    assert response.read() == b""
+    connection.close()
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(
+        "GET",
+        "/css/site.css",
+        headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+    )
+    response = connection.getresponse()
+    assert response.status == 200
+    assert response.read() == content
+    connection.close()
+
+
+def test_precompress(static_root):
+    cache = StaticFileCache(str(static_root), precompress=True)
+    small = cache.get("/css/small.css")
+    sidecar = static_root.join("css", "small.css.gz")
+    assert sidecar.check()
+    assert os.stat(str(sidecar)).st_mtime == small.mtime
+    assert small.gzip.etag != small.etag
+    assert zlib.decompress(small.gzip.content, 31) == b"body {}"
+    assert cache.get("/css/small.css.gz") is None
+    # Not for other files.
+    assert cache.get("/favicon.ico").gzip is None
+    # A stale sidecar is regenerated.
+    static_root.join("css", "small.css").write("body { margin: 0 }")
+    os.utime(str(static_root.join("css", "small.css")), (1, 1))
+    cache.scan()
+    small = cache.get("/css/small.css")
+    assert zlib.decompress(small.gzip.content, 31) == b"body { margin: 0 }"
+
+
+def test_stale_sidecar_ignored(static_root):
+    static_root.join("css", "small.css.gz").write("stale")
+    cache = StaticFileCache(str(static_root))
+    assert cache.get("/css/small.css").gzip is None
+
+
+def test_serve_sidecar(static_root):
+    localweb.LocalWebHandler.configure({})
+    localweb.LocalWebHandler.static_files = StaticFileCache(
+        str(static_root), precompress=True
+    )
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), localweb.LocalWebHandler, workers=2
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    try:
+        for accept_encoding, expected in [("gzip", "gzip"), ("identity", None)]:
+            connection = http.client.HTTPConnection(*server.server_address)
+            connection.request(
+                "GET", "/css/small.css", headers={"Accept-Encoding": accept_encoding}
+            )
+            response = connection.getresponse()
+            body = response.read()
+            assert response.getheader("Content-Encoding") == expected
+            assert response.getheader("Vary") == "Accept-Encoding"
+            if expected:
+                body = zlib.decompress(body, 31)
+            assert body == b"body {}"
+            connection.close()
+    finally:
+        thread.shutdown()
+        localweb.LocalWebHandler.configure({})
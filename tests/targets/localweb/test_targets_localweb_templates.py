@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import collections
+import http.client
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+import suapp.targets.localweb as localweb
+from suapp.targets.localweb.templates import CompiledTemplate, TemplateDirectory
+
+
+def test_compiled_template():
+    template = CompiledTemplate("<title>%(title)s</title>100%%<b>%(body)s</b>")
+    assert template.segments == ["<title>", None, "</title>100%<b>", None, "</b>"]
+    assert template.slots == [(1, "title"), (3, "body")]
+    values = {"title": "%(body)s", "body": "x"}
+    assert template.render(values) == "<title>%(body)s</title>100%<b>x</b>"
+
+
+def test_compiled_template_splice():
+    template = CompiledTemplate("<t>%(title)s</t>%(body)s.").splice(
+        "body", CompiledTemplate("<h1>%(title)s</h1>%(main)s")
+    )
+    assert template.segments == ["<t>", None, "</t><h1>", None, "</h1>", None, "."]
+    assert template.render({"title": "T", "main": "M"}) == "<t>T</t><h1>T</h1>M."
+
+
+def test_html_templating_engine():
+    engine = localweb.HtmlTemplatingEngine("<title>%(title)s</title>\n%(body)s")
+    menu = collections.OrderedDict()
+    menu["Help"] = collections.OrderedDict([("About", "ABOUT")])
+    html = engine.html(None, "Hello", "<p>main</p>", menu=menu, shortname="Test")
+    assert html.startswith("<title>Hello</title>\n<!-- Fixed navbar // -->\n")
+    assert '<a class="navbar-brand" href="/">Test</a>' in html
+    assert '<li><a href="/?OUT=ABOUT">About</a></li>' in html
+    assert "<h1>Hello</h1>" in html
+    assert "\t\t\t\t<main>\n\t\t\t\t\t<p>main</p>\n\t\t\t\t</main>" in html
+    assert "\t\t\t\t<main>\n\t\t\t\t</main>" in engine.html(None, "Hello", None)
+    # The same menu structure is only rendered once.
+    same_menu = {"Help": {"About": "ABOUT"}}
+    assert (
+        engine.html(None, "Hello", "<p>main</p>", menu=same_menu, shortname="Test")
+        == html
+    )
+    assert len(engine.menus) == 2
+    engine.html_template = "<title>%(title)s</title>"
+    assert engine.html(None, "Hello", None) == "<title>Hello</title>"
+
+
+def test_template_directory(tmpdir):
+    tmpdir.join("hello.html").write("Hello %(name)s")
+    templates = TemplateDirectory(str(tmpdir), check_interval=0.2)
+    template = templates.get("hello.html")
+    assert template.render({"name": "you"}) == "Hello you"
+    assert templates.get("hello.html") is template
+    assert templates.get("missing.html") is None
+    assert templates.get("../hello.html") is None
+    tmpdir.join("hello.html").write("Hi %(name)s!")
+    # Only checked again after the check_interval.
+    assert templates.get("hello.html") is template
+    time.sleep(0.2)
+    assert templates.get("hello.html").render({"name": "you"}) == "Hi you!"
+
+
+def test_html_templating_engine_directory(tmpdir):
+    engine = localweb.HtmlTemplatingEngine()
+    engine.template_directory = TemplateDirectory(str(tmpdir), check_interval=0)
+    assert "navbar" in engine.html(None, "Hello", None)
+    tmpdir.join("layout.html").write("<title>%(title)s</title>%(body)s")
+    html = engine.html(None, "Hello", None)
+    assert html.startswith("<title>Hello</title><!-- Fixed navbar // -->")
+    tmpdir.join("page.html").write("<h1>%(title)s</h1>%(main)s")
+    assert engine.html(None, "Hello", "main") == (
+        "<title>Hello</title><h1>Hello</h1>\t\t\t\t\tmain\n"
+    )
+    assert engine.fragment(["missing.html", "page.html"], {"title": "T"}) == (
+        "<h1>T</h1>"
+    )
+    assert engine.fragment(["missing.html"], {}) is None
+
+
+@pytest.fixture
+def server():
+    server = localweb.PooledHTTPServer(
+        ("127.0.0.1", 0), localweb.LocalWebHandler, workers=2
+    )
+    thread = localweb.ServerThread(server)
+    thread.start()
+    yield server
+    thread.shutdown()
+    localweb.LocalWebHandler.html_template_engine.template_directory = None
+
+
+def test_error_page_template(server, tmpdir):
+    tmpdir.join("error.html").write("<p>Error %(code)s: %(message)s</p>")
+    engine = localweb.LocalWebHandler.html_template_engine
+    engine.template_directory = TemplateDirectory(str(tmpdir))
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("GET", "/")
+    response = connection.getresponse()
+    assert response.status == 403
+    # The 401 is sent as 403, but gets the error page of the 401.
+    assert "<p>Error 401: Unauthorized</p>" in response.read().decode("utf-8")
+    connection.close()
+
+
+class ErrorHandler(localweb.LocalWebHandler):
+    @localweb.route("/public/error", auth=0, mime="text/plain; charset=utf-8")
+    def do_public_error(self, session, fields, json_object):
+        return (400, "text/plain; charset=utf-8", "<b>Bad</b> & wrong")
+
+
+def test_error_page_escaped(tmpdir):
+    tmpdir.join("error.html").write("<p>Error %(code)s: %(message)s</p>")
+    engine = localweb.LocalWebHandler.html_template_engine
+    engine.template_directory = TemplateDirectory(str(tmpdir))
+    server = localweb.PooledHTTPServer(("127.0.0.1", 0), ErrorHandler, workers=1)
+    thread = localweb.ServerThread(server)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request("GET", "/public/error")
+        response = connection.getresponse()
+        body = response.read().decode("utf-8")
+        connection.close()
+    finally:
+        thread.shutdown()
+        engine.template_directory = None
+    assert response.status == 400
+    assert "<p>Error 400: &lt;b&gt;Bad&lt;/b&gt; &amp; wrong</p>" in body
+    assert "<b>Bad</b>" not in body
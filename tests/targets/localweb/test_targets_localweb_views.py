@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import os
+import sys
+import types
+
+sys.path.append(os.getcwd())
+import suapp.jandw
+import suapp.targets.localweb as localweb
+
+
+class Item:
+    def __init__(self, pk, name):
+        self._pk_ = pk
+        self.name = name
+
+
+class ItemsJeeves(suapp.jandw.Jeeves):
+    def do_query(self, name, scope=None, params=None):
+        self.queried.append(name)
+        return [Item(1, "one"), Item(2, "two")]
+
+
+@pytest.fixture
+def jeeves():
+    jeeves = ItemsJeeves()
+    jeeves.queried = []
+    jeeves.app = types.SimpleNamespace(
+        configuration={"httpd": {"service_url": "/service"}}
+    )
+    jeeves.queries = {"items": ("Item.select()", {"pagenum": 1, "pagesize": 10})}
+    jeeves.views = {
+        "ITEMS": {
+            "name": "Items",
+            "tabs": {0: {"title": "All"}, 1: {"title": "Other"}},
+            "sections": {
+                0: {
+                    "title": "List",
+                    "lines": {"query": "items", "elements": {0: {"value": ".name"}}},
+                }
+            },
+        }
+    }
+    return jeeves
+
+
+def inflow(jeeves, pagesize):
+    drone = suapp.jandw.Drone("ITEMS", None)
+    drone.dataobject = {"session": {}, "params": {"pagesize": [pagesize]}}
+    return localweb.View().inflow(jeeves, drone)
+
+
+def test_view_plan(jeeves):
+    localweb.View.plans.clear()
+    title, html = inflow(jeeves, "7")
+    assert title == "Items"
+    assert '<li class="active"><a data-toggle="tab" href="#tab0">All</a></li>' in html
+    assert '"/service/query/items?pagenum=1&pagesize=7"' in html
+    assert '.appendTo("#section1_0")' in html
+    # The browser gets the objects.
+    assert jeeves.queried == []
+    plan = localweb.View.plans[("ITEMS", False, "client")]
+    # The query parts are filled in for every request.
+    title, html = inflow(jeeves, "8")
+    assert '"/service/query/items?pagenum=1&pagesize=8"' in html
+    assert localweb.View.plans[("ITEMS", False, "client")] is plan
+    # Replacing the definition compiles a new plan.
+    jeeves.views.update({"ITEMS": dict(jeeves.views["ITEMS"], name="Things")})
+    title, html = inflow(jeeves, "8")
+    assert title == "Things"
+    assert localweb.View.plans[("ITEMS", False, "client")] is not plan
+
+
+def test_view_plan_server(jeeves):
+    jeeves.views["ITEMS"]["render"] = "server"
+    jeeves.views["ITEMS"]["sections"][0]["lines"]["elements"][1] = {
+        "value": "Open",
+        "type": "button",
+        "outmessage": "RECORD",
+    }
+    title, html = inflow(jeeves, "7")
+    # Once per tab: the objects are in the html.
+    assert jeeves.queried == ["items", "items"]
+    assert "<script>" not in html
+    assert '<p id="Item_1"><span class="label">one</span><form' in html
+    assert '<input type="hidden" name="key" value="2" />' in html
+
+
+def test_view_plan_same_elements(jeeves):
+    localweb.View.plans.clear()
+    jeeves.do_query = lambda name, scope=None, params=None: [
+        Item(1, "Jan Peeters"),
+        Item(2, '<b>"Bob" & Co</b>'),
+    ]
+    elements = jeeves.views["ITEMS"]["sections"][0]["lines"]["elements"]
+    elements[1] = {"value": ".name", "type": "button", "outmessage": "SHOW"}
+    elements[2] = {"value": "It's", "type": "label"}
+    title, html = inflow(jeeves, "7")
+    # Every element, the attributes escaped by the browser.
+    assert (
+        '<span class="label">\' + suappEscape(data["objects"][elementid]["name"]) + \''
+        "</span><form"
+    ) in html
+    assert (
+        '<input type="submit" value="\' + '
+        'suappEscape(data["objects"][elementid]["name"]) + \'" />'
+    ) in html
+    assert '<span class="label">It&#x27;s</span></p>' in html
+    jeeves.views["ITEMS"]["render"] = "server"
+    title, html = inflow(jeeves, "7")
+    assert '<p id="Item_1"><span class="label">Jan Peeters</span><form' in html
+    assert '<input type="submit" value="Jan Peeters" />' in html
+    assert (
+        '<span class="label">&lt;b&gt;&quot;Bob&quot; &amp; Co&lt;/b&gt;</span>' in html
+    )
+    assert 'value="&lt;b&gt;&quot;Bob&quot; &amp; Co&lt;/b&gt;"' in html
+    assert "<b>" not in html
+    assert '<span class="label">It&#x27;s</span></p>' in html
+
+
+def test_view_plan_tabs_query(jeeves):
+    def do_query(name, scope=None, params=None):
+        jeeves.queried.append(name)
+        if name == "tabs":
+            return [{}, {}]
+        return [Item(1, "one"), Item(2, "two")]
+
+    jeeves.do_query = do_query
+    jeeves.queries["tabs"] = ("Tab.select()", {})
+    jeeves.views["ITEMS"]["tabs"] = {"query": "tabs", "title": "Tab"}
+    title, html = inflow(jeeves, "7")
+    assert '<a data-toggle="tab" href="#tab1">Tab</a></li>' in html
+    # Only once: the browser only gets the objects of the lines.
+    assert jeeves.queried == ["tabs"]
+    assert "/service/query/tabs" not in html
+    assert html.count("/service/query/items") == 2
@@ -8,8 +8,12 @@ import os
 import os.path
 import re
 import sys
+import types
+
+import pony.orm
 
 sys.path.append(os.getcwd())
+import suapp.orm
 from suapp.jandw import *
 
 
@@ -92,3 +96,217 @@ march to the drones.
             assert " ".join(line) in expected
         else:
             assert " ".join(line) == expected
+
+
+@pytest.fixture
+def counted_query():
+    calls = []
+
+    def query(params=None):
+        calls.append(params)
+        return list(range(params["pagesize"]))
+
+    flow = Jeeves()
+    flow.queries = {
+        "numbers": (query, {"pagesize": 3}),
+        "cached": (query, {"pagesize": 3}, {"ttl": 60, "entities": ["Number"]}),
+    }
+    return (flow, calls)
+
+
+def test_query_not_cached(counted_query):
+    (flow, calls) = counted_query
+    list(flow.do_query("numbers", params={}))
+    list(flow.do_query("numbers", params={}))
+    assert len(calls) == 2
+    assert flow.query_cache.stats()["hits"] == 0
+
+
+def test_query_cache(counted_query):
+    (flow, calls) = counted_query
+    assert len(list(flow.do_query("cached", params={}))) == 3
+    assert len(list(flow.do_query("cached", params={"pagesize": "3"}))) == 3
+    assert len(list(flow.do_query("cached", params={"pagesize": "5"}))) == 5
+    assert len(calls) == 2
+    assert flow.query_cache.stats() == {
+        "size": 2,
+        "max_size": 256,
+        "hits": 1,
+        "misses": 2,
+    }
+    # A commit of another entity keeps the cached results.
+    suapp.orm.bump_data_versions(["Other"])
+    list(flow.do_query("cached", params={}))
+    assert len(calls) == 2
+    suapp.orm.bump_data_versions(["Number"])
+    list(flow.do_query("cached", params={}))
+    assert len(calls) == 3
+
+
+def test_query_cache_lru():
+    cache = QueryCache(max_size=2)
+    cache.put("a", 60, suapp.orm.data_version(), [1])
+    cache.put("b", 60, suapp.orm.data_version(), [2])
+    assert cache.get("a") == [1]
+    cache.put("c", 60, suapp.orm.data_version(), [3])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1]
+    # Expired
+    cache.put("d", -1, suapp.orm.data_version(), [4])
+    assert cache.get("d") is None
+
+
+@pytest.fixture(scope="module")
+def fetch_module():
+    db = pony.orm.Database()
+
+    class Person(db.Entity):
+        name = pony.orm.Required(str)
+        notes = pony.orm.Set("Note")
+        tags = pony.orm.Set("Tag")
+
+    class Note(db.Entity):
+        person = pony.orm.Required(Person)
+        text = pony.orm.Required(str)
+
+    class Pair(db.Entity):
+        first = pony.orm.Required(int)
+        second = pony.orm.Required(str)
+        pony.orm.PrimaryKey(first, second)
+
+    class Tag(db.Entity):
+        person = pony.orm.Required(Person)
+        label = pony.orm.Required(str)
+        pony.orm.PrimaryKey(person, label)
+
+    class UiPerson(suapp.orm.UiOrmObject):
+        _ui_class = Person
+
+        def __init__(self, orm=None):
+            self._ui_orm = orm
+
+    class UiNote(suapp.orm.UiOrmObject):
+        def __init__(self, orm=None):
+            self._ui_orm = orm
+
+    class UiTag(suapp.orm.UiOrmObject):
+        def __init__(self, orm=None):
+            self._ui_orm = orm
+
+    # UiOrmObject.uize looks for them in the module of Note and Tag.
+    setattr(sys.modules[Note.__module__], "UiNote", UiNote)
+    setattr(sys.modules[Tag.__module__], "UiTag", UiTag)
+    db.bind("sqlite", ":memory:")
+    db.generate_mapping(create_tables=True)
+    with pony.orm.db_session:
+        for i in range(1, 6):
+            Person(id=i, name="person %s" % (i))
+            Pair(first=i, second="p%s" % (i))
+        for i in range(25):
+            Note(person=Person[1], text="note %02d" % (i % 10))
+        for label in ("b", "a", "c"):
+            Tag(person=Person[2], label=label)
+    module = types.ModuleType("fetch_many_test")
+    module.Person = Person
+    module.Pair = Pair
+    module.Note = Note
+    module.Tag = Tag
+    module.UiPerson = UiPerson
+    sys.modules[module.__name__] = module
+    yield module.__name__
+    del sys.modules[module.__name__]
+
+
+@pytest.mark.parametrize("table", ["Person", "UiPerson"])
+def test_fetch_many(fetch_module, table):
+    flow = Jeeves()
+    flow.fetch_many_chunk = 2
+    with pony.orm.db_session:
+        results = flow.do_fetch_many(
+            fetch_module, table, ["4", "1", "99", "x", "4", ["2"], "5"]
+        )
+        names = [r.name if r is not None else None for r in results]
+    assert names == [
+        "person 4",
+        "person 1",
+        None,
+        None,
+        "person 4",
+        "person 2",
+        "person 5",
+    ]
+    if table == "UiPerson":
+        assert isinstance(results[0], suapp.orm.UiOrmObject)
+
+
+def test_fetch_many_composite_key(fetch_module):
+    flow = Jeeves()
+    with pony.orm.db_session:
+        results = flow.do_fetch_many(
+            fetch_module, "Pair", [["3", "p3"], ["1", "p2"], ["1", "p1"], ["2"]]
+        )
+        keys = [r.get_pk() if r is not None else None for r in results]
+    assert keys == [(3, "p3"), None, (1, "p1"), None]
+
+
+def test_query_cache_sessions(fetch_module):
+    module = sys.modules[fetch_module]
+
+    def last_notes(params=None):
+        return module.Note.select().order_by(pony.orm.desc(module.Note.id))[:3]
+
+    def all_tags(params=None):
+        return module.Tag.select().order_by(module.Tag.label)[:]
+
+    flow = Jeeves()
+    flow.queries = {
+        "notes": (last_notes, {}, {"ttl": 60, "entities": ["Note"]}),
+        "tags": (all_tags, {}, {"ttl": 60, "entities": ["Tag"]}),
+    }
+    with pony.orm.db_session:
+        assert [note.id for note in flow.do_query("notes", params={})] == [25, 24, 23]
+        labels = [tag.label for tag in flow.do_query("tags", params={})]
+        assert labels == ["a", "b", "c"]
+    # Using the cached results in another db_session.
+    with pony.orm.db_session:
+        notes = [(n.id, n.text) for n in flow.do_query("notes", params={})]
+        assert notes == [(25, "note 04"), (24, "note 03"), (23, "note 02")]
+        tags = [(t.person.name, t.label) for t in flow.do_query("tags", params={})]
+        assert tags == [("person 2", "a"), ("person 2", "b"), ("person 2", "c")]
+    assert flow.query_cache.stats()["hits"] == 2
+
+
+def test_fetch_set_paged(fetch_module):
+    flow = Jeeves()
+    with pony.orm.db_session:
+        notes = list(flow.do_fetch_set(fetch_module, "Person", "1", "notes"))
+        assert len(notes) == 25
+        assert flow.do_count_set(fetch_module, "Person", "1", "notes") == 25
+    with pony.orm.db_session:
+        page = flow.do_fetch_set(
+            fetch_module, "Person", "1", "notes", pagenum=2, pagesize=10
+        )
+        assert [note.id for note in page] == list(range(11, 21))
+        page = flow.do_fetch_set(
+            fetch_module, "Person", "1", "notes", pagenum="3", pagesize="10"
+        )
+        assert [note.id for note in page] == list(range(21, 26))
+        page = flow.do_fetch_set(
+            fetch_module, "Person", "1", "notes", pagesize=3, order_by="-text"
+        )
+        # Within the same text by primary key.
+        assert [(note.text, note.id) for note in page] == [
+            ("note 09", 10),
+            ("note 09", 20),
+            ("note 08", 9),
+        ]
+        # Only the count, the set isn't loaded.
+        assert not notes_loaded(fetch_module)
+        with pytest.raises(ValueError):
+            flow.do_fetch_set(fetch_module, "Person", "1", "notes", order_by="nope")
+
+
+def notes_loaded(module_name):
+    person = sys.modules[module_name].Person[1]
+    notes = person._vals_.get(person.__class__.notes)
+    return notes is not None and notes.is_fully_loaded
@@ -100,3 +100,22 @@ def test_ui_attributes(orm_objects):
     x = "This is me."
     ui_orm_object._ui_x = x
     assert ui_orm_object._ui_x is x
+
+
+def test_commit_data_versions(orm_objects):
+    (pony_entity_object, ui_orm_object) = orm_objects
+    suapp.orm.track_data_versions(pony_entity_object._database_)
+    # Twice does not bump twice.
+    suapp.orm.track_data_versions(pony_entity_object._database_)
+    entities = ["TestOrm", pony_entity_object.__class__.__name__, "Other"]
+    before = suapp.orm.data_version(entities)
+    ui_orm_object.one = 11
+    ui_orm_object.commit()
+    after = suapp.orm.data_version(entities)
+    assert after[0] == before[0] + 1
+    assert after[1] == before[1] + 1
+    assert after[2] == before[2]
+    # Also when committing with PonyORM directly.
+    pony_entity_object.two = 22
+    pony.orm.commit()
+    assert suapp.orm.data_version(entities)[0] == after[0] + 1